@@ -0,0 +1,116 @@
+"""assets.py -- content-hash fingerprinting of static assets
+
+Copyright 2015  by Eckhart Arnold
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+
+import utility
+from precompress import COMPRESSED_SUFFIXES
+
+
+MANIFEST_NAME = "asset-manifest.json"
+HASH_LENGTH = 8
+
+
+##############################################################################
+#
+# fingerprinting
+#
+##############################################################################
+
+
+def fingerprinted_name(path, digest):
+    """Returns the fingerprinted version of `path`, e.g.
+    'css/styles.css' -> 'css/styles.0123abcd.css'."""
+    base, ext = os.path.splitext(path)
+    return base + "." + digest[:HASH_LENGTH] + ext
+
+
+def asset_files(site_path, entry, generated):
+    """Yields the paths (relative to `site_path`) of all files of the static
+    entry `entry` in the build directory, except for files in the set
+    `generated` and precompressed siblings of other files."""
+    top = os.path.join(site_path, entry)
+    if os.path.isfile(top):
+        yield entry
+        return
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.relpath(os.path.join(dirpath, name), site_path)
+            path = path.replace(os.path.sep, "/")
+            if path in generated:
+                continue
+            base, ext = os.path.splitext(name)
+            if ext in COMPRESSED_SUFFIXES and base in filenames:
+                continue
+            yield path
+
+
+def fingerprint_assets(site_path, entries, hashes, exclude=()):
+    """Creates fingerprinted copies 'name.<hash>.ext' of all files of the
+    static `entries` (list of paths relative to `site_path`) in the build
+    directory and writes the asset manifest, which maps the original paths
+    to the fingerprinted paths, to `site_path`/asset-manifest.json.
+
+    The original files are kept, so that relative references between
+    assets (e.g. images referenced from stylesheets) remain valid.
+    Fingerprinted copies are only created for files that have changed;
+    outdated fingerprinted copies are removed.
+
+    Args:
+        site_path (str): The build directory of the site
+        entries (list): The static entries that shall be fingerprinted
+        hashes (utility.HashCache): The hash cache of the build
+        exclude (set): Paths of files that are already fingerprinted, e.g.
+            bundles
+
+    Returns:
+        dict. The asset manifest
+    """
+    manifest_name = os.path.join(site_path, MANIFEST_NAME)
+    old_manifest = utility.load_json(manifest_name, {})
+    generated = set(old_manifest.values())
+    manifest = {}
+    for entry in entries:
+        for path in asset_files(site_path, entry, generated | set(exclude)):
+            fullpath = os.path.join(site_path, path)
+            target = fingerprinted_name(path, hashes.hash(fullpath))
+            fulltarget = os.path.join(site_path, target)
+            if not os.path.exists(fulltarget):
+                utility.link_or_copy(fullpath, fulltarget, "reflink")
+            manifest[path] = target
+    stale = generated - set(manifest.values())
+    for path in stale:
+        for suffix in ("",) + COMPRESSED_SUFFIXES:
+            fullpath = os.path.join(site_path, path + suffix)
+            if os.path.exists(fullpath):
+                os.remove(fullpath)
+    if manifest != old_manifest:
+        utility.save_json(manifest_name, manifest)
+    return manifest
+
+
+def lookup(manifest, url):
+    """Returns the fingerprinted version of the site relative `url`, if
+    it is contained in the asset `manifest` or `url` itself otherwise. Query
+    strings and fragments are preserved."""
+    cut = min((i for i in (url.find("?"), url.find("#")) if i >= 0),
+              default=len(url))
+    path = url[:cut]
+    if path in manifest:
+        return manifest[path] + url[cut:]
+    return url
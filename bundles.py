@@ -0,0 +1,132 @@
+"""bundles.py -- bundling of stylesheets and scripts of static entries
+
+Copyright 2015  by Eckhart Arnold
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import hashlib
+import os
+import posixpath
+import re
+
+import assets
+import criticalcss
+import utility
+
+
+# separators between the members of a bundle; the semicolon protects
+# against scripts that do not end with a semicolon
+SEPARATORS = {".css": b"\n", ".js": b";\n"}
+
+RX_CHARSET = re.compile(r'@charset\s+"([^"]*)"\s*;\s*', re.IGNORECASE)
+RX_IMPORT = re.compile(r"@import\b", re.IGNORECASE)
+
+
+def join_stylesheets(name, members, parts):
+    """Returns the bundle `name` made of the stylesheets `parts` (bytes) of
+    the `members`. Relative urls of members from other directories than the
+    bundle are rebased to the directory of the bundle. A @charset rule is
+    moved to the top of the bundle. As @import rules are only valid at the
+    beginning of a stylesheet, only the first member may contain them.
+    Raises a ValueError for @import rules in other members and for
+    conflicting charsets."""
+    charsets = {}
+    sheets = []
+    bundle_dir = posixpath.dirname(name) or "."
+    for i, (member, part) in enumerate(zip(members, parts)):
+        css = part.decode("utf-8", "surrogateescape")
+        m = RX_CHARSET.match(css)
+        if m:
+            charsets.setdefault(m.group(1).lower(), m.group(1))
+            css = css[m.end():]
+        if i > 0 and RX_IMPORT.match(css):
+            raise ValueError("Member %s of bundle %s starts with @import, "
+                             "which is only valid at the beginning of the "
+                             "bundle" % (member, name))
+        base = posixpath.relpath(posixpath.dirname(member) or ".",
+                                 bundle_dir)
+        if base != ".":
+            css = criticalcss.rebase_css_urls(css, base + "/")
+        sheets.append(css)
+    if len(charsets) > 1:
+        raise ValueError("Members of bundle %s have different charsets: %s"
+                         % (name, ", ".join(sorted(charsets.values()))))
+    head = ['@charset "%s";' % value for value in charsets.values()]
+    return "\n".join(head + sheets).encode("utf-8", "surrogateescape")
+
+
+def build_bundles(site_path, bundles, hashes, record_name):
+    """Builds the `bundles` (a dictionary that maps the names of bundles to
+    lists of their members, all given as paths relative to `site_path`)
+    from the files of the members in the build directory, i.e. after
+    they have been preprocessed (and thereby minified). Each bundle is
+    written to a fingerprinted file, e.g. 'css/site.css' to
+    'css/site.0123abcd.css'. A bundle is only built again, if one of its
+    members has changed. Outdated bundle files are removed.
+
+    Args:
+        site_path (str): The build directory of the site
+        bundles (dict): The bundles as configured in __site-config.yaml
+        hashes (utility.HashCache): The hash cache of the build
+        record_name (str): The json file that keeps the record of the
+            bundles that have been built
+
+    Returns:
+        dict. The bundle manifest that maps each member to the tuple
+        (name of the bundle, path of the fingerprinted bundle)
+    """
+    record = utility.load_json(record_name, {})
+    current = {}
+    manifest = {}
+    for name, members in bundles.items():
+        paths = [os.path.join(site_path, member) for member in members]
+        missing = [member for member, path in zip(members, paths)
+                   if not os.path.isfile(path)]
+        if missing:
+            raise FileNotFoundError("Members %s of bundle %s do not exist in "
+                                    "%s" % (", ".join(missing), name,
+                                            site_path))
+        signature = [hashes.hash(path) for path in paths]
+        previous = record.get(name)
+        if previous and previous[0] == signature and \
+                os.path.exists(os.path.join(site_path, previous[1])):
+            target = previous[1]
+        else:
+            ext = os.path.splitext(name)[1].lower()
+            parts = []
+            for path in paths:
+                with open(path, "rb") as f:
+                    parts.append(f.read().strip())
+            if ext == ".css":
+                data = join_stylesheets(name, members, parts)
+            else:
+                data = SEPARATORS.get(ext, b"\n").join(parts)
+            target = assets.fingerprinted_name(
+                name, hashlib.md5(data).hexdigest())
+            print("Building bundle " + target)
+            os.makedirs(os.path.dirname(os.path.join(site_path, target)),
+                        exist_ok=True)
+            with open(os.path.join(site_path, target), "wb") as f:
+                f.write(data)
+        current[name] = [signature, target]
+        for member in members:
+            manifest[member] = (name, target)
+    for name, (signature, target) in record.items():
+        if current.get(name, [None, None])[1] != target:
+            for suffix in ("",) + assets.COMPRESSED_SUFFIXES:
+                path = os.path.join(site_path, target + suffix)
+                if os.path.exists(path):
+                    os.remove(path)
+    utility.save_json(record_name, current)
+    return manifest
@@ -0,0 +1,161 @@
+"""changes.py -- the state of a built site and the change manifest that
+    records the differences to the previous build
+
+Copyright 2015  by Eckhart Arnold
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+The change manifest is a json file with the keys
+
+    base:          the id (see `state_id()`) of the state of the previous
+                   build or None
+    id:            the id of the state of this build
+    added:         the new files, {path: [md5-hash, size]}
+    changed:       the changed files, {path: [md5-hash, size]}
+    removed:       the sorted list of the files that have been removed
+    added_dirs:    the sorted list of the new directories
+    removed_dirs:  the sorted list of the directories that have been removed
+    state:         the state of this build (see `tree_state()`)
+
+All paths are relative to the site directory. `upload.upload_tree()`
+takes the state from the manifest instead of scanning the site again, and
+the changes may serve as a purge list for a CDN (see `purge_urls()`):
+
+    python changes.py __cache/changes.json https://www.example.org
+"""
+
+import concurrent.futures
+import json
+import os
+import sys
+
+import serverconfig
+import utility
+from precompress import COMPRESSED_SUFFIXES
+
+
+# trees with at least this many files are hashed on a pool of threads
+PARALLEL_HASHING = 64
+
+
+def tree_state(root, hashes=None, workers=None):
+    """Returns the state of the directory tree at `root`, i.e. a dictionary
+    with the keys 'files', which maps the paths of all files (relative to
+    `root`) to lists [md5-hash, size], and 'dirs', the sorted list of the
+    relative paths of all directories.
+
+    Files are only hashed if they are not yet contained in the hash cache
+    `hashes` (a `utility.HashCache`) with the same size and modification
+    time. Large trees are hashed on a pool of `workers` threads.
+    """
+    if hashes is None:
+        hashes = utility.HashCache(None)
+    entries, dirs = [], []
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel_dir = os.path.relpath(dirpath, root)
+        if rel_dir == ".":
+            rel_dir = ""
+        dirs.extend(os.path.join(rel_dir, name) for name in dirnames)
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            entries.append((os.path.join(rel_dir, name), path,
+                            os.stat(path)))
+
+    def digest(entry):
+        return hashes.hash(entry[1], entry[2])
+
+    if len(entries) >= PARALLEL_HASHING and workers != 1:
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            digests = list(executor.map(digest, entries))
+    else:
+        digests = [digest(entry) for entry in entries]
+    files = {rel: [md5, st.st_size]
+             for (rel, path, st), md5 in zip(entries, digests)}
+    return {"files": files, "dirs": sorted(dirs)}
+
+
+def state_id(state):
+    """Returns an id of `state` (or of a manifest of the same form), that
+    changes whenever a file or directory is added, changed or removed."""
+    return utility.md5(json.dumps({"files": state["files"],
+                                   "dirs": sorted(state["dirs"])},
+                                  sort_keys=True))
+
+
+def compare_states(old, new):
+    """Returns the change manifest from the state `old` (or None, if there
+    is no previous state) to the state `new`."""
+    old_files = old["files"] if old else {}
+    old_dirs = set(old["dirs"]) if old else set()
+    new_files, new_dirs = new["files"], set(new["dirs"])
+    return {"base": state_id(old) if old else None,
+            "id": state_id(new),
+            "added": {path: new_files[path]
+                      for path in new_files.keys() - old_files.keys()},
+            "changed": {path: entry for path, entry in new_files.items()
+                        if path in old_files and old_files[path] != entry},
+            "removed": sorted(old_files.keys() - new_files.keys()),
+            "added_dirs": sorted(new_dirs - old_dirs),
+            "removed_dirs": sorted(old_dirs - new_dirs),
+            "state": new}
+
+
+def update_changes(filename, site_path, hashes=None):
+    """Determines the state of the site at `site_path`, compares it with
+    the state that is recorded in the change manifest `filename` of the
+    previous build, writes the new change manifest to `filename` and
+    returns it."""
+    previous = utility.load_json(filename)
+    old = previous.get("state") if isinstance(previous, dict) else None
+    changes = compare_states(old, tree_state(site_path, hashes))
+    utility.save_json(filename, changes)
+    return changes
+
+
+def load_changes(filename):
+    """Returns the change manifest stored in `filename` or None, if there
+    is none."""
+    changes = utility.load_json(filename)
+    if not isinstance(changes, dict) or "state" not in changes:
+        return None
+    return changes
+
+
+def purge_urls(changes, base_url=""):
+    """Returns the sorted list of the urls that must be purged from a CDN
+    after the `changes` have been deployed: the urls of all changed and
+    removed files, plus the directory urls of changed index pages. Server
+    configuration files and precompressed siblings are left out, because
+    they are never requested by their own url."""
+    urls = set()
+    for path in list(changes["changed"]) + changes["removed"]:
+        name = os.path.basename(path)
+        if name in serverconfig.SERVER_FILES or \
+                name.endswith(COMPRESSED_SUFFIXES):
+            continue
+        urls.add(base_url + "/" + path)
+        if name == "index.html":
+            urls.add(base_url + "/" + path[:-len(name)])
+    return sorted(urls)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python changes.py CHANGE_MANIFEST [BASE_URL]")
+        sys.exit(1)
+    change_manifest = load_changes(sys.argv[1])
+    if change_manifest is None:
+        print("No change manifest found at " + sys.argv[1])
+        sys.exit(1)
+    for url in purge_urls(change_manifest, *sys.argv[2:]):
+        print(url)
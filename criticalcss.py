@@ -0,0 +1,272 @@
+"""criticalcss.py -- extracting the rules of a stylesheet that are used by a
+    particular page
+
+Copyright 2015  by Eckhart Arnold
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import re
+import threading
+
+import htmlrewriter
+import minify
+import utility
+
+
+##############################################################################
+#
+# parsing stylesheets
+#
+##############################################################################
+
+# at-rules whose blocks contain further rules rather than declarations
+NESTING_AT_RULES = {"@media", "@supports", "@document", "@layer"}
+
+RX_CSS_SCAN = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|[{};]')
+
+
+def matching_brace(css, pos):
+    """Returns the position of the brace that closes the block starting at
+    `pos` (the position after the opening brace)."""
+    depth = 1
+    for m in RX_CSS_SCAN.finditer(css, pos):
+        token = m.group()
+        if token == "{":
+            depth += 1
+        elif token == "}":
+            depth -= 1
+            if depth == 0:
+                return m.start()
+    return len(css)
+
+
+def parse_css(css):
+    """Parses the stylesheet `css` (which must not contain comments) into a
+    list of rules (prelude, block). The block is None for statements like
+    '@import ...;', a list of rules for nesting at-rules like @media and
+    the declarations as a string otherwise."""
+    rules = []
+    start = 0
+    for m in RX_CSS_SCAN.finditer(css):
+        if m.start() < start:
+            continue    # inside a block that has already been consumed
+        token = m.group()
+        if token == ";":
+            rules.append((css[start:m.end()].strip(), None))
+            start = m.end()
+        elif token == "{":
+            prelude = css[start:m.start()].strip()
+            close = matching_brace(css, m.end())
+            block = css[m.end():close]
+            if prelude.split(None, 1)[0].lower() in NESTING_AT_RULES:
+                block = parse_css(block)
+            rules.append((prelude, block))
+            start = close + 1
+        elif token == "}":
+            start = m.end()
+    return rules
+
+
+def render_css(rules):
+    """Returns the stylesheet for the list of `rules` (see `parse_css()`)."""
+    parts = []
+    for prelude, block in rules:
+        if block is None:
+            parts.append(prelude)
+        elif isinstance(block, list):
+            parts.append(prelude + "{" + render_css(block) + "}")
+        else:
+            parts.append(prelude + "{" + block + "}")
+    return "".join(parts)
+
+
+##############################################################################
+#
+# matching selectors
+#
+##############################################################################
+
+RX_PSEUDO = re.compile(r"::?[\w-]+(?:\([^()]*\))?")
+RX_ATTRIBUTE_SELECTOR = re.compile(r"\[\s*([\w-]+)[^\]]*\]")
+RX_ID_OR_CLASS = re.compile(r"([#.])([\w-]+)")
+RX_TYPE_SELECTOR = re.compile(r"[a-zA-Z][\w-]*")
+
+
+def split_selectors(prelude):
+    """Splits a selector list at the commas that are not enclosed in
+    parentheses or brackets."""
+    selectors, depth, start = [], 0, 0
+    for i, c in enumerate(prelude):
+        if c in "([":
+            depth += 1
+        elif c in ")]":
+            depth -= 1
+        elif c == "," and depth == 0:
+            selectors.append(prelude[start:i].strip())
+            start = i + 1
+    selectors.append(prelude[start:].strip())
+    return selectors
+
+
+def selector_features(selector):
+    """Returns the set of features (see `page_features()`) that a page must
+    contain for `selector` to match or None, if the selector cannot be
+    analysed. Pseudo classes and elements are ignored, so that the result
+    errs on the side of keeping rules."""
+    if "\\" in selector or "|" in selector:
+        return None
+    previous = None
+    while previous != selector:     # nested pseudo classes, inner first
+        previous, selector = selector, RX_PSEUDO.sub("", selector)
+    features = set()
+    for m in RX_ATTRIBUTE_SELECTOR.finditer(selector):
+        features.add("[" + m.group(1).lower())
+    selector = RX_ATTRIBUTE_SELECTOR.sub(" ", selector)
+    for m in RX_ID_OR_CLASS.finditer(selector):
+        features.add(m.group(1) + m.group(2))
+    selector = RX_ID_OR_CLASS.sub(" ", selector)
+    for word in re.split(r"[\s>+~*()]+", selector):
+        if RX_TYPE_SELECTOR.fullmatch(word):
+            features.add(word.lower())
+    return features
+
+
+def page_features(data):
+    """Returns the set of features of the HTML page `data` that selectors
+    can refer to: tag names, '.class', '#id' and '[attribute'."""
+    features = {"html", "head", "body"}
+    for token in htmlrewriter.tokenize(data):
+        if token.kind != htmlrewriter.STARTTAG:
+            continue
+        features.add(token.name)
+        attributes = htmlrewriter.tag_attributes(
+            data[token.start:token.end])
+        for name, value in attributes.items():
+            features.add("[" + name)
+            if name == "class" and value:
+                features.update("." + cls for cls in value.split())
+            elif name == "id" and value:
+                features.add("#" + value)
+    return features
+
+
+def prune_rules(rules, features):
+    """Returns the rules that may apply to a page with the given set of
+    `features`. At-rules other than those that contain rules (e.g.
+    @font-face or @keyframes) are always kept."""
+    pruned = []
+    for prelude, block in rules:
+        if isinstance(block, list):
+            block = prune_rules(block, features)
+            if block:
+                pruned.append((prelude, block))
+        elif block is None or prelude.startswith("@"):
+            pruned.append((prelude, block))
+        else:
+            selectors = []
+            for selector in split_selectors(prelude):
+                required = selector_features(selector)
+                if required is None or required <= features:
+                    selectors.append(selector)
+            if selectors:
+                pruned.append((",".join(selectors), block))
+    return pruned
+
+
+def stylesheet_features(rules):
+    """Returns the set of all features that the selectors of `rules`
+    refer to."""
+    features = set()
+    for prelude, block in rules:
+        if isinstance(block, list):
+            features |= stylesheet_features(block)
+        elif block is not None and not prelude.startswith("@"):
+            for selector in split_selectors(prelude):
+                features |= selector_features(selector) or set()
+    return features
+
+
+RX_CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]*)\1\s*\)""")
+
+
+def rebase_css_urls(css, base):
+    """Prefixes all relative URLs in url()-expressions of `css` with the
+    URL `base`, so that they still point to the same files, if `css` is
+    moved from a stylesheet into a page or into a bundle."""
+    def rebase(m):
+        url = m.group(2)
+        if not url or url.startswith(("/", "#", "data:")) \
+                or utility.RX_EXTERNAL_URL.match(url):
+            return m.group()
+        return "url(%s%s%s)" % (m.group(1), base + url, m.group(1))
+    return RX_CSS_URL.sub(rebase, css)
+
+
+##############################################################################
+#
+# critical css
+#
+##############################################################################
+
+
+class CriticalCSS:
+    """Class CriticalCSS computes the subsets of stylesheets that are used
+    by pages. Pages are reduced to the signature of those features that the
+    stylesheet refers to, so that pages built from the same layout usually
+    share one subset, which is computed only once. Subsets are kept in the
+    json file `filename` (if not None), keyed by the hash of the stylesheet
+    and the signature.
+
+    Args:
+        filename (str): The json file of the record of subsets or None
+        hashes (utility.HashCache): The hash cache of the build or None
+    """
+
+    def __init__(self, filename=None, hashes=None):
+        self.filename = filename
+        self.hashes = hashes
+        self.record = utility.load_json(filename, {}) \
+            if filename is not None else {}
+        self.used = set()
+        self.stylesheets = {}   # hash -> (rules, features)
+        self.lock = threading.Lock()
+
+    def stylesheet(self, path, key):
+        if key not in self.stylesheets:
+            with open(path, encoding="utf-8") as f:
+                rules = parse_css(minify.minify_css(f.read()))
+            self.stylesheets[key] = (rules, stylesheet_features(rules))
+        return self.stylesheets[key]
+
+    def subset(self, path, features):
+        """Returns the subset of the stylesheet at `path` for a page with
+        the set of `features` (see `page_features()`)."""
+        key = self.hashes.hash(path) if self.hashes is not None \
+            else utility.md5_file(path)
+        with self.lock:
+            rules, used_features = self.stylesheet(path, key)
+            signature = utility.md5(*sorted(features & used_features))
+            record_key = key + ":" + signature
+            if record_key not in self.record:
+                self.record[record_key] = \
+                    render_css(prune_rules(rules, features))
+            self.used.add(record_key)
+            return self.record[record_key]
+
+    def save(self):
+        """Saves the subsets that have been used in this build."""
+        if self.filename is not None:
+            utility.save_json(self.filename, {
+                key: value for key, value in self.record.items()
+                if key in self.used})
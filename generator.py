@@ -15,14 +15,26 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import collections
 import os
 import re
 import shutil
 import subprocess
-
+import urllib.parse
+
+import assets
+import bundles
+import changes
+import criticalcss
+import htmlrewriter
+import images
 import loader
+import minify
+import precompress
+import serverconfig
 from locale_strings import extract_locale, remove_locale
 import sitetree
+import tools
 import utility
 
 
@@ -62,6 +74,20 @@ def is_static_entry(name, site_path, config, folder_config):
         loader.fullpath(name, site_path) in config.get('static_entries', set())
 
 
+def static_link_mode(name, site_path, config):
+    """Returns the link mode for the static entry `name` (see
+    sitetree.StaticEntry). The link mode is configured with `static_links`,
+    which is either a single link mode for all static entries or a
+    dictionary that maps static entries to link modes, e.g.
+    `static_links: {media: auto, default: copy}`.
+    """
+    modes = config.get('static_links', 'copy')
+    if not isinstance(modes, dict):
+        return modes
+    return modes.get(name, modes.get(loader.fullpath(name, site_path),
+                                     modes.get('default', 'copy')))
+
+
 def get_basename(filepath):
     """Returns the filename without path, extension, locale information or
     order number.
@@ -143,7 +169,8 @@ def scan_directory(path, loaders, injected_metadata={}, organizers=[],
             continue
         elif is_static_entry(name, site_path, config,
                              folder.metadata['folderconfig']):
-            folder[name] = sitetree.StaticEntry(name)
+            folder[name] = sitetree.StaticEntry(
+                name, static_link_mode(name, site_path, config))
         elif name.startswith('_'):
             if os.path.isdir(name):
                 data_dirs.append(name)
@@ -233,17 +260,34 @@ def scan_directory(path, loaders, injected_metadata={}, organizers=[],
 # writers
 #
 
-def remove_trailing_spaces(root, content):
-    """Returns a version of text where all trailing spaces are removed"""
-    return re.sub(" +\n", "\n", content)
+RX_TRAILING_SPACES = re.compile(" +\n")
 
 
-def fillin_URL_templates(root, content):
-    """Replaces URLs in href attributes that start with 'STATIC:' or
-    'TOPLEVEL:' with proper relative URLs.
-    TOPLEVEL means 'the highest level in the same language branch'
-    STATIC means 'the root level of the site'
-    """
+@htmlrewriter.streaming_writer
+def remove_trailing_spaces(rewriter):
+    """Removes all trailing spaces from the lines of the page."""
+    def remove(text, token, page):
+        if " \n" in text:
+            return RX_TRAILING_SPACES.sub("\n", text)
+        return text
+    rewriter.register(remove, htmlrewriter.ALL_KINDS)
+
+
+RX_URL_TEMPLATES = re.compile(
+    '(href|src|content) *= *"(STATIC|TOPLEVEL):/?([^"]*)')
+
+
+def site_root(folder):
+    """Returns the top level folder of the site tree that contains
+    `folder`."""
+    while folder.parent:
+        folder = folder.parent
+    return folder
+
+
+def url_prefixes(root):
+    """Returns the relative URLs of the 'TOPLEVEL' and the 'STATIC' directory
+    as seen from folder `root`."""
     steps = []
     while root.parent:
         steps.append("..")
@@ -251,133 +295,680 @@ def fillin_URL_templates(root, content):
     toplevel = "/".join(steps) + "/"
     steps.append("..")
     static = "/".join(steps) + "/"
+    return toplevel, static
 
-    content = re.sub('href *= *"STATIC:/?', 'href="' + static, content)
-    content = re.sub('src *= *"STATIC:/?', 'src="' + static, content)
-    content = re.sub('content *= *"STATIC:/?', 'content="' + static, content)
-    content = re.sub('href *= *"TOPLEVEL:/?', 'href="' + toplevel, content)
-    content = re.sub('src *= *"TOPLEVEL:/?', 'src="' + toplevel, content)
-    content = re.sub('content *= *"TOPLEVEL:/?', 'content="' + toplevel, content)
-    return content
 
+@htmlrewriter.streaming_writer
+def fillin_URL_templates(rewriter):
+    """Replaces URLs in href, src and content attributes that start with
+    'STATIC:' or 'TOPLEVEL:' with proper relative URLs. This includes URLs
+    in comments (e.g. conditional comments) and in inline scripts or styles.
+    TOPLEVEL means 'the highest level in the same language branch'
+    STATIC means 'the root level of the site'
 
-def add_img_width_height(root, content):
-    """Adds with and height attributes to image tags.
+    If static assets have been fingerprinted, STATIC-URLs of fingerprinted
+    assets are replaced by the URLs of the fingerprinted versions.
     """
-    # TODO: program this function
-    pass
+    def fillin(text, token, page):
+        if "STATIC:" not in text and "TOPLEVEL:" not in text:
+            return text
+        toplevel, static = url_prefixes(page.root)
+        manifest = site_root(page.root).metadata.get('asset_manifest', {})
+
+        def replace(match):
+            attr, kind, url = match.groups()
+            if kind == "TOPLEVEL":
+                return attr + '="' + toplevel + url
+            return attr + '="' + static + assets.lookup(manifest, url)
+
+        return RX_URL_TEMPLATES.sub(replace, text)
+
+    rewriter.register(fillin, (htmlrewriter.STARTTAG, htmlrewriter.COMMENT,
+                               htmlrewriter.RAWTEXT))
+
+
+def static_source(folder, url):
+    """Returns the path of the source file that `url` refers to, or None if
+    `url` does not refer to a file of a static entry of the site tree.
+    `url` is either relative to the pages in `folder`, starts with a slash
+    (i.e. is relative to the root level of the site) or is a 'STATIC:'- or
+    'TOPLEVEL:'-URL.
+    """
+    url = url.split("#")[0].split("?")[0]
+    static_level = False    # pages live in the language branches
+    if url.startswith("STATIC:") or url.startswith("/"):
+        folder, static_level = site_root(folder), True
+        url = url[7:] if url.startswith("STATIC:") else url
+    elif url.startswith("TOPLEVEL:"):
+        folder, url = site_root(folder), url[9:]
+    elif utility.RX_EXTERNAL_URL.match(url):
+        return None
+    parts = [part for part in urllib.parse.unquote(url).split("/")
+             if part not in ("", ".")]
+    for i, part in enumerate(parts):
+        if part == "..":
+            if folder.parent:
+                folder = folder.parent
+            elif not static_level:
+                static_level = True
+            else:
+                return None
+            continue
+        item = folder.get(part)
+        if isinstance(item, sitetree.Folder):
+            folder = item
+        elif isinstance(item, sitetree.StaticEntry) and static_level:
+            path = os.path.join(item.entrypath, *parts[i + 1:])
+            return path if os.path.isfile(path) else None
+        else:
+            return None
+    return None
+
+
+def image_sizes(folder):
+    """Returns the record of image dimensions (images.ImageSizes) of the
+    site that `folder` belongs to."""
+    return site_root(folder).metadata.setdefault('image_sizes',
+                                                 images.ImageSizes())
+
+
+def img_width_height_writer(lazy_loading=False, eager_images=2):
+    """Returns a streaming writer that adds width and height attributes to
+    image tags that have neither, so that browsers can lay out pages before
+    the images have been loaded. The dimensions are read from the headers
+    of the images in the static entries of the site tree.
+
+    Args:
+        lazy_loading (bool): Add loading="lazy" to the image tags of a
+            page, except for the first `eager_images` images, which are
+            assumed to be above the fold.
+        eager_images (int): The number of images per page that are
+            loaded immediately.
+    """
+    def add_attributes(text, token, page):
+        attributes = htmlrewriter.tag_attributes(text)
+        additions = []
+        if "width" not in attributes and "height" not in attributes \
+                and attributes.get("src"):
+            path = static_source(page.root, attributes["src"])
+            size = image_sizes(page.root).size(path) if path else None
+            if size:
+                additions.append('width="%i" height="%i"' % size)
+        if lazy_loading:
+            page.state["img_count"] = page.state.get("img_count", 0) + 1
+            if page.state["img_count"] > eager_images \
+                    and "loading" not in attributes:
+                additions.append('loading="lazy"')
+        if not additions:
+            return text
+        end = len(text) - (2 if htmlrewriter.is_selfclosing(text) else 1)
+        return text[:end].rstrip() + " " + " ".join(additions) + text[end:]
+
+    def register(rewriter):
+        rewriter.register(add_attributes, htmlrewriter.STARTTAG, ["img"])
+
+    register.__name__ = "add_img_width_height"
+    return htmlrewriter.streaming_writer(register)
+
+
+add_img_width_height = img_width_height_writer()
+
+
+def site_relative(folder, url):
+    """Returns the path relative to the root level of the site that `url`
+    (as seen from the pages in `folder`) points to or None, if `url` does
+    not point into the static part of the site."""
+    url = url.split("#")[0].split("?")[0]
+    if url.startswith("STATIC:"):
+        return url[7:].lstrip("/")
+    if url.startswith("/") and not url.startswith("//"):
+        return url[1:]
+    static = url_prefixes(folder)[1]
+    if url.startswith(static):
+        return os.path.normpath(url[len(static):]).replace(os.path.sep, "/")
+    return None
+
+
+RX_SCRIPT_END = re.compile(r"</script", re.IGNORECASE)
+
+
+@htmlrewriter.streaming_writer
+def bundle_tags(rewriter):
+    """Replaces the stylesheet links and script tags of a page that refer to
+    members of a bundle (see `create_bundles()`) by a single link or
+    script tag for the bundle. The tag for the bundle takes the place of
+    the first member on the page; the tags of further members of the same
+    bundle are removed.
+    """
+    def bundle_of(url, page):
+        manifest = site_root(page.root).metadata.get('bundle_manifest', {})
+        path = site_relative(page.root, url) if url else None
+        return manifest.get(path) if path else None
+
+    def replace(text, attribute, bundle, page):
+        name, target = bundle
+        emitted = page.state.setdefault("bundles", set())
+        if name in emitted:
+            return ""
+        emitted.add(name)
+        return re.sub(r"""(\s%s\s*=\s*)("[^"]*"|'[^']*'|[^\s>]+)""" %
+                      attribute, lambda m: m.group(1) + '"STATIC:' +
+                      target + '"', text, count=1, flags=re.IGNORECASE)
+
+    def link(text, token, page):
+        attributes = htmlrewriter.tag_attributes(text)
+        if "stylesheet" not in (attributes.get("rel") or "").lower().split():
+            return text
+        bundle = bundle_of(attributes.get("href"), page)
+        return replace(text, "href", bundle, page) if bundle else text
+
+    def script(text, token, page):
+        bundle = bundle_of(htmlrewriter.tag_attributes(text).get("src"),
+                           page)
+        if not bundle:
+            return text
+        m = RX_SCRIPT_END.search(page.data, token.end)
+        if not m or page.data[token.end:m.start()].strip():
+            return text     # a script with content is not touched
+        text = replace(text, "src", bundle, page)
+        page.state["drop_script_end"] = not text
+        return text
+
+    def script_end(text, token, page):
+        if page.state.pop("drop_script_end", False):
+            return ""
+        return text
+
+    rewriter.register(link, htmlrewriter.STARTTAG, ["link"])
+    rewriter.register(script, htmlrewriter.STARTTAG, ["script"])
+    rewriter.register(script_end, htmlrewriter.ENDTAG, ["script"])
+
+
+def critical_css(folder):
+    """Returns the record of stylesheet subsets (criticalcss.CriticalCSS) of
+    the site that `folder` belongs to."""
+    return site_root(folder).metadata.setdefault('critical_css',
+                                                 criticalcss.CriticalCSS())
+
+
+def critical_css_writer(max_size=16384):
+    """Returns a streaming writer that inlines the rules of the local
+    stylesheets of a page that the page actually uses (as far as can be
+    told from its tags, classes, ids and attributes) into the page and
+    loads the complete stylesheets asynchronously, so that stylesheets no
+    longer block the rendering of the page. Stylesheets whose used rules
+    exceed `max_size` bytes and stylesheets for print media are left
+    alone.
+
+    The number of inlined stylesheets is counted in the writer's
+    `statistics` attribute and the writer's `report()` function returns a
+    summary.
+    """
+    statistics = collections.Counter()
+
+    def inline_stylesheet(text, token, page):
+        attributes = htmlrewriter.tag_attributes(text)
+        href = attributes.get("href")
+        media = attributes.get("media")
+        if "stylesheet" not in (attributes.get("rel") or "").lower().split() \
+                or not href or media not in (None, "all", "screen"):
+            return text
+        path = static_source(page.root, href)
+        if not path:
+            return text
+        if "features" not in page.state:
+            page.state["features"] = criticalcss.page_features(page.data)
+        css = critical_css(page.root).subset(path, page.state["features"])
+        if len(css) > max_size:
+            return text
+        base = href.split("#")[0].split("?")[0].rsplit("/", 1)[0] + "/" \
+            if "/" in href else ""
+        toplevel, static = url_prefixes(page.root)
+        if base.startswith("STATIC:"):
+            base = static + base[7:].lstrip("/")
+        elif base.startswith("TOPLEVEL:"):
+            base = toplevel + base[9:].lstrip("/")
+        css = criticalcss.rebase_css_urls(css, base).replace("</", "<\\/")
+        statistics['inlined'] += 1
+        statistics['bytes'] += len(css)
+        style = '<style media="%s">' % media if media else "<style>"
+        preload = htmlrewriter.build_tag("link", collections.OrderedDict([
+            ("rel", "preload"), ("href", href), ("as", "style"),
+            ("onload", "this.onload=null;this.rel='stylesheet'")]))
+        return style + css + "</style>" + preload + \
+            "<noscript>" + text + "</noscript>"
+
+    def register(rewriter):
+        rewriter.register(inline_stylesheet, htmlrewriter.STARTTAG, ["link"])
+
+    register.__name__ = "critical_css"
+    writer = htmlrewriter.streaming_writer(register)
+    writer.statistics = statistics
+    writer.report = lambda: "Inlined the used rules of %i stylesheets " \
+        "(%i bytes)" % (statistics['inlined'], statistics['bytes'])
+    return writer
+
+
+SPRITE_SHEET = "sprites.svg"    # name of the sprite sheet in the site root
+RX_SRC_ATTRIBUTE = re.compile(r"""(\ssrc\s*=\s*)("[^"]*"|'[^']*'|[^\s>]+)""",
+                              re.IGNORECASE)
+
+
+def sprite_sheet(folder):
+    """Returns the sprite sheet (images.SpriteSheet) of the site that
+    `folder` belongs to."""
+    return site_root(folder).metadata.setdefault('sprite_sheet',
+                                                 images.SpriteSheet())
+
+
+def small_images_writer(inline_threshold=1024, sprite_threshold=8192):
+    """Returns a streaming writer that saves requests for small images of
+    the static entries: Images of up to `inline_threshold` bytes are
+    inlined into the page as data URIs. SVG images of up to
+    `sprite_threshold` bytes are collected in the sprite sheet 'sprites.svg'
+    in the root directory of the site and the image tags are replaced by
+    '<svg><use href=".../sprites.svg#id"/></svg>'. Image tags with a srcset
+    are left alone.
+
+    The number of replaced image tags is counted in the writer's
+    `statistics` attribute and the writer's `report()` function returns a
+    summary.
+    """
+    statistics = collections.Counter()
+
+    def use_tag(attributes, path, symbol_id, page):
+        svg_attributes = collections.OrderedDict(
+            (key, attributes[key]) for key in ("id", "class", "style")
+            if key in attributes)
+        width, height = attributes.get("width"), attributes.get("height")
+        if not width and not height:
+            size = image_sizes(page.root).size(path)
+            if size:
+                width, height = size
+        if width:
+            svg_attributes["width"] = width
+        if height:
+            svg_attributes["height"] = height
+        if attributes.get("alt"):
+            svg_attributes["role"] = "img"
+            svg_attributes["aria-label"] = attributes["alt"]
+        else:
+            svg_attributes["aria-hidden"] = "true"
+        return htmlrewriter.build_tag("svg", svg_attributes) + \
+            '<use href="STATIC:%s#%s"/></svg>' % (SPRITE_SHEET, symbol_id)
+
+    def replace_image(text, token, page):
+        attributes = htmlrewriter.tag_attributes(text)
+        src = attributes.get("src")
+        if not src or src.startswith("data:") or "srcset" in attributes:
+            return text
+        path = static_source(page.root, src)
+        if not path:
+            return text
+        size = os.path.getsize(path)
+        if size <= inline_threshold:
+            statistics['inlined'] += 1
+            uri = images.data_uri(path)
+            return RX_SRC_ATTRIBUTE.sub(
+                lambda m: m.group(1) + '"' + uri + '"', text, count=1)
+        if size <= sprite_threshold and path.lower().endswith(".svg"):
+            symbol_id = sprite_sheet(page.root).add(path)
+            if symbol_id:
+                statistics['sprites'] += 1
+                return use_tag(attributes, path, symbol_id, page)
+        return text
+
+    def register(rewriter):
+        rewriter.register(replace_image, htmlrewriter.STARTTAG, ["img"])
+
+    register.__name__ = "small_images"
+    writer = htmlrewriter.streaming_writer(register)
+    writer.statistics = statistics
+    writer.report = lambda: "Inlined %i and replaced %i image tags by " \
+        "sprites" % (statistics['inlined'], statistics['sprites'])
+    return writer
 
 
 STOCK_WRITERS = [remove_trailing_spaces, fillin_URL_templates]
 
 
+def configured_writers(config, debug=False):
+    """Returns the list of writers for a build with the configuration
+    `config`. The HTML minifier is only added for production builds, i.e.
+    if `debug` is False.
+
+    The HTML minifier is switched on with `minify_html: true` in the
+    __site-config.yaml file. Alternatively, `minify_html` can be a
+    dictionary of keyword arguments for `minify.html_minifier()`, e.g.
+    `minify_html: {remove_quotes: false}`. Likewise, `img_width_height`
+    switches on adding the dimensions of images to image tags (see
+    `img_width_height_writer()`), `small_images` the inlining of small
+    images and SVG sprites (see `small_images_writer()`) and `critical_css`
+    the inlining of the used parts of stylesheets (see
+    `critical_css_writer()`). If `bundles` are declared, tags for members
+    of bundles are replaced (see `bundle_tags()`).
+    """
+    writers = list(STOCK_WRITERS)
+    # these writers must see the STATIC:-URLs before they are filled in
+    if config.get('bundles'):
+        writers.insert(writers.index(fillin_URL_templates), bundle_tags)
+    for key, factory in (('img_width_height', img_width_height_writer),
+                         ('small_images', small_images_writer),
+                         ('critical_css', critical_css_writer)):
+        options = config.get(key, False)
+        if options:
+            writers.insert(writers.index(fillin_URL_templates), factory(
+                **(options if isinstance(options, dict) else {})))
+    if not debug:
+        options = config.get('minify_html', False)
+        if options:
+            writers.append(minify.html_minifier(
+                **(options if isinstance(options, dict) else {})))
+    return writers
+
+
 #
 # preprocessors
 #
 
-STOCK_PREPROCESSORS = {}    # preprocessors to be used for production code
-DEBUG_PREPROCESSORS = {}    # preprocessors to be used while debugging
+STOCK_PREPROCESSORS = tools.Preprocessors()  # used for production code
+DEBUG_PREPROCESSORS = tools.Preprocessors()  # used while debugging
 
-try:
-    dump = subprocess.check_output(["cleancss", "--help"],
-                                   stderr=subprocess.STDOUT)
 
-    def css_compressor(src, dst):
-        """Minifies a css stylesheet with cleancss
-        (https://github.com/jakubpawlowicz/clean-css) at location `src` and
-        writes the result to `dst`. Returns the destination path.
-        """
-        css = subprocess.check_output(["cleancss", src],
-                                      stderr=subprocess.STDOUT)
+def css_compressor(src, dst):
+    """Minifies a css stylesheet with cleancss
+    (https://github.com/jakubpawlowicz/clean-css) at location `src` and
+    writes the result to `dst`. Returns the destination path.
+    """
+    css = tools.run_tool("cleancss", [], src)
+    with open(dst, "wb") as css_file:
+        css_file.write(css)
+    return dst
+
+
+def css_compressor_batch(jobs):
+    """Minifies all stylesheets in the list of (src, dst)-pairs `jobs`
+    with a single call of cleancss. Returns the list of destination
+    paths."""
+    try:
+        outputs = tools.run_tool_batch(
+            "cleancss", ["--batch", "--batch-suffix", ".min"],
+            [src for src, dst in jobs], ".min")
+    except subprocess.CalledProcessError:
+        # older versions of cleancss do not support batch processing
+        return [css_compressor(src, dst) for src, dst in jobs]
+    for (src, dst), css in zip(jobs, outputs):
         with open(dst, "wb") as css_file:
             css_file.write(css)
-        return dst
+    return [dst for src, dst in jobs]
 
-    STOCK_PREPROCESSORS[".css"] = css_compressor
 
-except FileNotFoundError:
-    pass
+css_compressor.batch = css_compressor_batch
+STOCK_PREPROCESSORS.register(".css", css_compressor, "cleancss")
 
 
-try:
-    dump = subprocess.check_output(["closure", "--help"])
+def css_minifier(src, dst):
+    """Minifies a css stylesheet at location `src` in-process (see
+    minify.minify_css()) and writes the result to `dst`. Returns the
+    destination path.
+    """
+    return minify.minify_file("css", src, dst)
 
-    def js_compressor(src, dst):
-        """Minifies a javascript file with the closure compiler
-        (https://developers.google.com/closure/compiler/) at location `src`
-        and writes the result to `dst`. Returns the destination path.
-        """
-        if src.find(".min.") < 0:
-            jsmin = subprocess.check_output(["closure", src])
-        else:
-            with open(src, "rb") as f:
-                jsmin = f.read()
-        with open(dst, "wb") as jsmin_file:
-            jsmin_file.write(jsmin)
-        return dst
 
-    STOCK_PREPROCESSORS[".js"] = js_compressor
+css_minifier.batch = lambda jobs: minify.minify_files("css", jobs)
+STOCK_PREPROCESSORS.register(".css", css_minifier)
 
 
-except FileNotFoundError:
-    pass
+def js_compressor(src, dst):
+    """Minifies a javascript file with the closure compiler
+    (https://developers.google.com/closure/compiler/) at location `src`
+    and writes the result to `dst`. Returns the destination path.
+    """
+    if src.find(".min.") < 0:
+        jsmin = tools.run_tool("closure", [], src)
+    else:
+        with open(src, "rb") as f:
+            jsmin = f.read()
+    with open(dst, "wb") as jsmin_file:
+        jsmin_file.write(jsmin)
+    return dst
+
+
+STOCK_PREPROCESSORS.register(".js", js_compressor, "closure")
+
+
+def js_minifier(src, dst):
+    """Minifies a javascript file at location `src` in-process (see
+    minify.minify_js()) and writes the result to `dst`. Returns the
+    destination path.
+    """
+    return minify.minify_file("js", src, dst)
+
+
+# the builtin javascript minifier is not a fallback for closure, but must be
+# chosen explicitly (see `configured_preprocessors()`)
+js_minifier.batch = lambda jobs: minify.minify_files("js", jobs)
+
+
+def less_preprocessor(src, dst, debug):
+    """Preprocesses less stylesheet with less.js (http://lesscss.org/) at
+    location src and writes the result to 'dst'. Resturns the destination
+    path.
+    """
+    dst_name = os.path.splitext(dst)[0] + '.css'
+    css = tools.run_tool("lessc", [""], src)
+    with open(dst_name, "wb") as css_file:
+        css_file.write(css)
+    if not debug and ".css" in STOCK_PREPROCESSORS:
+        dst_name = STOCK_PREPROCESSORS[".css"](dst_name, dst_name)
+    return dst_name
+
 
+STOCK_PREPROCESSORS.register(
+    ".less", lambda src, dst: less_preprocessor(src, dst, False), "lessc")
+DEBUG_PREPROCESSORS.register(
+    ".less", lambda src, dst: less_preprocessor(src, dst, True), "lessc")
 
+
+# lesscpy only second choice, because version 0.10.2 is still buggy :(
 try:
-    dump = subprocess.check_output(["lessc", "--help"])
+    import six
+    import lesscpy
 
-    def less_preprocessor(src, dst, debug):
-        """Preprocesses less stylesheet with less.js (http://lesscss.org/) at
-        location src and writes the result to 'dst'. Resturns the destination
-        path.
+    def lesscpy_preprocessor(src, dst):
+        """Preprocesses less stylesheet with lesscpy
+        (https://pypi.python.org/pypi/lesscpy) at location src and writes
+        the result to 'dst'.
         """
+        with open(src) as less_file:
+            less_data = less_file.read()
+            css = lesscpy.compile(six.StringIO(less_data), minify=True)
         dst_name = os.path.splitext(dst)[0] + '.css'
-        css = subprocess.check_output(["lessc", "", src])
-        with open(dst_name, "wb") as css_file:
+        with open(dst_name, "w") as css_file:
             css_file.write(css)
-        if not debug and ".css" in STOCK_PREPROCESSORS:
-            dst_name = STOCK_PREPROCESSORS[".css"](dst_name, dst_name)
         return dst_name
 
-    STOCK_PREPROCESSORS[".less"] = \
-        lambda src, dst: less_preprocessor(src, dst, False)
-    DEBUG_PREPROCESSORS[".less"] = \
-        lambda src, dst: less_preprocessor(src, dst, True)
+    STOCK_PREPROCESSORS.register(".less", lesscpy_preprocessor)
+    DEBUG_PREPROCESSORS.register(".less", lesscpy_preprocessor)
 
-except FileNotFoundError:
+except ImportError:
     pass
 
 
-if ".less" not in STOCK_PREPROCESSORS:
-    # lesscpy only second choice, because version 0.10.2 is still buggy :(
-    try:
-        import six
-        import lesscpy
-
-        def lesscpy_preprocessor(src, dst):
-            """Preprocesses less stylesheet with lesscpy
-            (https://pypi.python.org/pypi/lesscpy) at location src and writes
-            the result to 'dst'.
-            """
-            with open(src) as less_file:
-                less_data = less_file.read()
-                css = lesscpy.compile(six.StringIO(less_data), minify=True)
-            dst_name = os.path.splitext(dst)[0] + '.css'
-            with open(dst_name, "w") as css_file:
-                css_file.write(css)
-            return dst_name
-
-        STOCK_PREPROCESSORS[".less"] = lesscpy_preprocessor
-        DEBUG_PREPROCESSORS[".less"] = lesscpy_preprocessor
-
-    except ImportError:
-        pass
+# minifiers that can be picked per extension with the `minifiers` key of
+# the __site-config.yaml file: name -> (preprocessor, required tool)
+MINIFIERS = {
+    ".css": {"cleancss": (css_compressor, "cleancss"),
+             "builtin": (css_minifier, None)},
+    ".js": {"closure": (js_compressor, "closure"),
+            "builtin": (js_minifier, None)}
+}
+
+
+def configured_preprocessors(config, debug=False):
+    """Returns the preprocessors for a build with the configuration
+    `config`.
+
+    By default, stylesheets and scripts are minified with the external
+    tools cleancss and closure if they are installed. Without cleancss,
+    stylesheets are minified with the builtin minifier, without closure,
+    scripts are copied unaltered. A particular minifier (or none) can be
+    chosen per extension in the __site-config.yaml file, e.g.
+    `minifiers: {.css: builtin, .js: builtin}`.
+
+    With `optimize_images: true`, PNG and SVG images are optimised
+    losslessly (see `images.image_optimizer()`).
+    """
+    if debug:
+        return DEBUG_PREPROCESSORS
+    selection = config.get('minifiers', {})
+    optimize_images = config.get('optimize_images', False)
+    if not selection and not optimize_images:
+        return STOCK_PREPROCESSORS
+    preprocessors = STOCK_PREPROCESSORS.copy()
+    if optimize_images:
+        optimizer = images.image_optimizer()
+        for ext in (".png", ".svg"):
+            preprocessors.register(ext, optimizer)
+    for ext, name in selection.items():
+        choices = MINIFIERS.get(ext, {})
+        if name != "none" and name not in choices:
+            raise ValueError("Unknown minifier %s for %s files. Choose one "
+                             "of: %s" % (name, ext,
+                                         ", ".join(list(choices) + ["none"])))
+        preprocessors.unregister(ext)
+        if name != "none":
+            preprocessors.register(ext, *choices[name])
+    return preprocessors
+
 
 #
 # site creation
 #
 
 
+def get_cache_path(site_path, config):
+    """Returns the directory where persistent build caches (hashes etc.) are
+    kept and creates it if it does not yet exist. Unless configured
+    otherwise with `cache_path`, this is the directory '__cache' next to
+    the build directory `site_path`.
+    """
+    path = config.get('cache_path', os.path.join(
+        os.path.dirname(os.path.abspath(site_path)), '__cache'))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def create_bundles(root, site_path, cache_path, hashes, config):
+    """Builds the bundles of stylesheets and scripts declared under
+    `bundles` in the configuration, e.g.
+    `bundles: {css/site.css: [css/reset.css, css/styles.css]}`, and stores
+    the bundle manifest in the metadata of the `root` folder, where it is
+    picked up by `bundle_tags()`. Returns the set of paths of the bundles.
+    """
+    declared = config.get('bundles', {})
+    if not declared:
+        return set()
+    manifest = bundles.build_bundles(site_path, declared, hashes,
+                                     os.path.join(cache_path, 'bundles.json'))
+    root.metadata['bundle_manifest'] = manifest
+    return {target for name, target in manifest.values()}
+
+
+def fingerprint_static_entries(root, site_path, static_paths, hashes,
+                               config, exclude=()):
+    """Fingerprints the static entries listed under `fingerprint` in the
+    configuration (or all static entries if `fingerprint` is `true`) and
+    stores the asset manifest in the metadata of the `root` folder, where
+    it is picked up by `fillin_URL_templates()`. Files in `exclude` are
+    not fingerprinted.
+    """
+    selection = config.get('fingerprint', False)
+    if not selection:
+        return
+    if selection is not True:
+        static_paths = [path for path in static_paths
+                        if path in selection or
+                        os.path.basename(path) in selection]
+    print("Fingerprinting static entries: " + ", ".join(static_paths))
+    root.metadata['asset_manifest'] = assets.fingerprint_assets(
+        site_path, static_paths, hashes, exclude)
+
+
+def precompress_site(site_path, cache_path, hashes, config):
+    """Writes precompressed siblings of the files in the build directory, if
+    `precompress` is configured. `precompress` can either be `true` or a
+    dictionary with the keys `level`, `brotli_quality` and `extensions`.
+    """
+    options = config.get('precompress', False)
+    if not options:
+        return
+    options = dict(options) if isinstance(options, dict) else {}
+    extensions = set(options.pop('extensions',
+                                 precompress.COMPRESSIBLE_EXTENSIONS))
+    print("Precompressing files")
+    count, saved = precompress.precompress_site(site_path, cache_path,
+                                                hashes, extensions=extensions,
+                                                **options)
+    print("Precompressed %i changed files, saving %i bytes" % (count, saved))
+
+
+def negotiate_root_language(site_path, config):
+    """Lets the web server deliver the root index in the language of the
+    visitor, if `language_negotiation` is configured. It can either be
+    `true` or a dictionary with the key `default` (the language for
+    visitors that accept none of the site's languages; the first language
+    by default). Unless a `root_index` is configured, a minimal root
+    index.html that picks the language in the browser is written for
+    static hosts. Returns True, if this root index.html has been written
+    (or is still up to date).
+    """
+    options = config.get('language_negotiation', False)
+    languages = [lang for lang in config.get('languages', [])
+                 if lang != 'ANY']
+    if not options or not languages:
+        return False
+    options = options if isinstance(options, dict) else {}
+    fallback = 'root_index' not in config
+    written = serverconfig.write_language_negotiation(
+        site_path, languages, options.get('default', languages[0]),
+        fallback=fallback)
+    for name in written:
+        print("Writing language negotiation file " + name)
+    return fallback
+
+
+def write_server_config(root, site_path, config, bundle_paths):
+    """Writes the caching rules for the web server to the .htaccess and/or
+    the _headers file of the site, if `server_headers` is configured.
+    `server_headers` can either be `true` or a dictionary with the keys
+    `page_ttl`, `asset_ttl`, `immutable_ttl` and `formats`. Fingerprinted
+    assets and bundles are marked as immutable.
+    """
+    options = config.get('server_headers', False)
+    if not options:
+        return
+    options = options if isinstance(options, dict) else {}
+    fingerprinted = set(root.metadata.get('asset_manifest', {}).values())
+    fingerprinted |= set(bundle_paths)
+    written = serverconfig.write_caching_headers(site_path, fingerprinted,
+                                                 **options)
+    for name in written:
+        print("Writing caching rules to " + name)
+
+
+def record_changes(site_path, cache_path, hashes):
+    """Writes the change manifest '__cache/changes.json', which records the
+    files that have been added, changed or removed since the last build
+    (see module `changes`). The uploader takes the state of the site from
+    it instead of scanning the site again."""
+    manifest = changes.update_changes(
+        os.path.join(cache_path, 'changes.json'), site_path, hashes)
+    print("Changes since the last build: %i added, %i changed, %i removed" %
+          (len(manifest['added']), len(manifest['changed']),
+           len(manifest['removed'])))
+
+
 def create_site(root, site_path, metadata, writers=STOCK_WRITERS,
                 preprocessors=STOCK_PREPROCESSORS):
     """Writes a a website or folder of a website stored in a sitetree structure
@@ -389,7 +980,9 @@ def create_site(root, site_path, metadata, writers=STOCK_WRITERS,
         writers(list): A list of writer functions
             (root, current_content) -> content that can manipulate content
             (like replace special tokens or keywords like "STATIC") just before
-            writing them to the disk.
+            writing them to the disk. Successive streaming writers (see
+            module htmlrewriter) are merged, so that they share a single
+            pass over each page.
         preprocessors(dicstionary): A dictionary of external preprocessors
             (file extension -> preprocessor) that preprocesses files before
             writing them. Other than writers, preprocessors work directly on
@@ -398,14 +991,39 @@ def create_site(root, site_path, metadata, writers=STOCK_WRITERS,
             programm.
     """
     assert isinstance(root, sitetree.Folder)
+    config = metadata.get('config', {})
+    site_path = os.path.abspath(site_path)
+    cache_path = get_cache_path(site_path, config)
+    hashes = utility.HashCache(os.path.join(cache_path, 'hashes.json'))
+    tools.TOOL_CACHE.path = os.path.join(cache_path, 'preprocessed')
+    tools.TOOL_REGISTRY.reset(os.path.join(cache_path, 'tools.json'))
+    root.metadata['image_sizes'] = images.ImageSizes(
+        os.path.join(cache_path, 'image-sizes.json'), hashes)
+    images.OPTIMIZER_CACHE.path = os.path.join(cache_path, 'optimized')
+    root.metadata['sprite_sheet'] = images.SpriteSheet(
+        os.path.join(cache_path, 'sprites.json'), hashes)
+    root.metadata['critical_css'] = criticalcss.CriticalCSS(
+        os.path.join(cache_path, 'critical-css.json'), hashes)
+    reporting_writers = [wr for wr in writers if hasattr(wr, 'report')]
+    writers = htmlrewriter.combine_writers(writers)
     sitemap = utility.Sitemap(metadata.get('config', {}).get('sitemap_exclude', []))
     all_languages = root.metadata.get('config', {}).get('languages', ['ANY'])
 
+    static_paths = []
+    static_manifest = utility.SyncManifest(
+        os.path.join(cache_path, 'static-manifest.json'),
+        [metadata.get('debug', False)] +
+        [config.get(key) for key in ('minifiers', 'optimize_images',
+                                     'static_links')])
+    sync_options = config.get('static_sync', {})
+
     def create_static_entries(root, path):
         for entry in root:
             if isinstance(root[entry], sitetree.StaticEntry):
                 print("Copying static dir or file: " + entry)
-                sitemap.extend(root[entry].copy_entry(path, preprocessors))
+                sitemap.extend(root[entry].copy_entry(
+                    path, preprocessors, static_manifest, **sync_options))
+                static_paths.append(os.path.join(path, entry))
             elif isinstance(root[entry], sitetree.Folder):
                 create_static_entries(root[entry], os.path.join(path, entry))
 
@@ -458,13 +1076,25 @@ def create_site(root, site_path, metadata, writers=STOCK_WRITERS,
                                         "changefreq": cfreq,
                                         "priority": "%1.1f" % float(pri)})
 
-    shutil.copy2(metadata.get('config', {}).get('root_index', '__root.html'),
-                 os.path.join(site_path, "index.html"))
-
+    root_index = os.path.abspath(config.get('root_index', '__root.html'))
     with utility.create_and_enter_dir(site_path):
         create_static_entries(root, "")
+        static_manifest.save()
+        utility.shutdown_process_pool()
+        used = preprocessors.used() if hasattr(preprocessors, 'used') \
+            else set(preprocessors.values())
+        for pp in used:
+            if hasattr(pp, 'report'):
+                print(pp.report())
+        bundle_paths = create_bundles(root, site_path, cache_path, hashes,
+                                      config)
+        fingerprint_static_entries(root, site_path, static_paths, hashes,
+                                   config, bundle_paths)
         for lang in all_languages:
             create_branch(root, lang, lang, writers)
+        # the sitemap needs the root index
+        if not negotiate_root_language(site_path, config):
+            shutil.copy2(root_index, "index.html")
 
         base_url = metadata.get('config', {}).get('base_url', '')
         assert base_url[-1:] != "/"
@@ -472,6 +1102,20 @@ def create_site(root, site_path, metadata, writers=STOCK_WRITERS,
         print("Writing sitemap.xml")
         sitemap.write('sitemap.xml', base_url)
 
+    if root.metadata['sprite_sheet'].write(
+            os.path.join(site_path, SPRITE_SHEET)):
+        print("Updating sprite sheet " + SPRITE_SHEET)
+    root.metadata['critical_css'].save()
+    for wr in reporting_writers:
+        print(wr.report())
+
+    precompress_site(site_path, cache_path, hashes, config)
+    utility.shutdown_process_pool()
+    write_server_config(root, site_path, config, bundle_paths)
+    record_changes(site_path, cache_path, hashes)
+    root.metadata['image_sizes'].save()
+    hashes.save()
+
 
 
 ##############################################################################
@@ -485,13 +1129,15 @@ def generate_site(path, metadata):
     """Generates the site from the source at 'path'.
     """
     tree = scan_directory(path, loader.STOCK_LOADERS, metadata)
-    preprocessors = DEBUG_PREPROCESSORS if metadata.get("debug", False) \
-        else STOCK_PREPROCESSORS
+    preprocessors = configured_preprocessors(metadata.get('config', {}),
+                                             metadata.get("debug", False))
     assert os.path.isdir(path)
     sitepath = os.path.join(path, '__site')
     if not os.path.exists(sitepath):
         os.mkdir(sitepath)
     else:
         assert os.path.isdir(sitepath)
-    create_site(tree, os.path.join(path, '__site'), metadata, STOCK_WRITERS,
+    writers = configured_writers(metadata.get('config', {}),
+                                 metadata.get("debug", False))
+    create_site(tree, os.path.join(path, '__site'), metadata, writers,
                 preprocessors)
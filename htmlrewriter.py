@@ -0,0 +1,357 @@
+"""htmlrewriter.py -- incremental HTML tokenizer and single pass rewriting
+    of web pages for writers and postprocessors
+
+Copyright 2015  by Eckhart Arnold
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import functools
+import re
+
+from utility import RX_HTML_COMMENTS
+
+
+##############################################################################
+#
+# tokenizer
+#
+##############################################################################
+
+TEXT = "text"           # ordinary text between tags
+RAWTEXT = "rawtext"     # unparsed content of script, style or textarea
+STARTTAG = "starttag"   # e.g. <a href="...">, <br />
+ENDTAG = "endtag"       # e.g. </a>
+COMMENT = "comment"     # e.g. <!-- ... -->, including conditional comments
+DECL = "decl"           # e.g. <!DOCTYPE html>, <?xml ...?>, <![endif]>
+
+ALL_KINDS = (TEXT, RAWTEXT, STARTTAG, ENDTAG, COMMENT, DECL)
+
+RAWTEXT_ELEMENTS = {"script", "style", "textarea"}
+PREFORMATTED_ELEMENTS = {"pre"}
+
+RX_MARKUP = re.compile(
+    "(?P<comment>" + RX_HTML_COMMENTS.pattern + ")"
+    r"|(?P<endtag></(?P<endname>[a-zA-Z][\w:.-]*)\s*>)"
+    r"|(?P<starttag><(?P<startname>[a-zA-Z][\w:.-]*)"
+    r"""(?:"[^"]*"|'[^']*'|[^'">])*>)"""
+    r"|(?P<decl><[!?][^>]*>)",
+    re.DOTALL)
+
+RX_TAGNAME = re.compile(r"</?([a-zA-Z][\w:.-]*)")
+
+
+class Token(collections.namedtuple("Token", ["kind", "start", "end", "name"])):
+
+    """A token of an HTML page. Tokens do not contain any string data, but
+    only the offsets `start` and `end` of the token within the page.
+
+    Attributes:
+        kind (str): One of TEXT, RAWTEXT, STARTTAG, ENDTAG, COMMENT, DECL
+        start (int): Offset of the first character of the token
+        end (int): Offset of the first character after the token
+        name (str): The lower case tag name for STARTTAG and ENDTAG tokens,
+            the name of the enclosing element for RAWTEXT tokens, "pre"
+            for TEXT tokens within preformatted elements, None otherwise.
+    """
+
+    __slots__ = ()
+
+
+def tokenize(data, pos=0):
+    """Yields the tokens of the HTML page `data` starting at offset `pos`.
+    Other than a full fledged HTML parser, the tokenizer does not build a
+    tree, does not check for well-formedness and never fails. Anything
+    that does not look like a tag, comment or declaration is yielded as
+    text.
+
+    The content of script, style and textarea elements is yielded as a
+    single RAWTEXT token, so that tag-like strings inside scripts are
+    never mistaken for tags. Comments (see `utility.RX_HTML_COMMENTS`)
+    are yielded as a whole as COMMENT tokens.
+
+    Example:
+        >>> [(t.kind, t.name) for t in tokenize("<p>Text</p><!-- <a> -->")]
+        [('starttag', 'p'), ('text', None), ('endtag', 'p'),
+         ('comment', None)]
+    """
+    pre_depth = 0
+    length = len(data)
+    while pos < length:
+        match = RX_MARKUP.search(data, pos)
+        if not match:
+            yield Token(TEXT, pos, length, "pre" if pre_depth else None)
+            return
+        start, end = match.start(), match.end()
+        if start > pos:
+            yield Token(TEXT, pos, start, "pre" if pre_depth else None)
+        kind = match.lastgroup
+        if kind == "endtag" or kind == "endname":
+            name = match.group("endname").lower()
+            if name in PREFORMATTED_ELEMENTS and pre_depth > 0:
+                pre_depth -= 1
+            yield Token(ENDTAG, start, end, name)
+        elif kind == "starttag" or kind == "startname":
+            name = match.group("startname").lower()
+            yield Token(STARTTAG, start, end, name)
+            if name in PREFORMATTED_ELEMENTS and data[end - 2] != "/":
+                pre_depth += 1
+            elif name in RAWTEXT_ELEMENTS and data[end - 2] != "/":
+                close = re.compile("</" + name + r"\s*>", re.IGNORECASE)
+                m = close.search(data, end)
+                raw_end = m.start() if m else length
+                if raw_end > end:
+                    yield Token(RAWTEXT, end, raw_end, name)
+                end = raw_end
+        elif kind == "comment":
+            yield Token(COMMENT, start, end, None)
+        else:
+            yield Token(DECL, start, end, None)
+        pos = end
+
+
+##############################################################################
+#
+# attribute handling for single tags
+#
+##############################################################################
+
+RX_TAG_ATTRIBUTES = re.compile(
+    r"""\s([^\s"'<>/=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+)))?""")
+
+
+def tag_attributes(tag):
+    """Returns an ordered dictionary of the attributes of the start tag `tag`
+    (a string like '<img src="a.png" alt="A">'). Attribute names are
+    converted to lower case, attributes without value are mapped to None.
+    """
+    m = RX_TAGNAME.match(tag)
+    assert m, "Not a tag: " + tag[:40]
+    end = len(tag) - 1
+    attributes = collections.OrderedDict()
+    for match in RX_TAG_ATTRIBUTES.finditer(tag, m.end(), end):
+        value = match.group(2)
+        if value is None:
+            value = match.group(3)
+        if value is None:
+            value = match.group(4)
+        attributes[match.group(1).lower()] = value
+    return attributes
+
+
+def build_tag(name, attributes, selfclosing=False):
+    """Returns a start tag with the given `name` and `attributes`. This is
+    the inverse of `tag_attributes()`.
+    """
+    parts = [name]
+    for key, value in attributes.items():
+        if value is None:
+            parts.append(key)
+        else:
+            parts.append('%s="%s"' % (key, value))
+    return "<" + " ".join(parts) + (" />" if selfclosing else ">")
+
+
+def is_selfclosing(tag):
+    """Returns True, if the tag string `tag` ends with '/>'."""
+    return tag.endswith("/>")
+
+
+##############################################################################
+#
+# rewriting
+#
+##############################################################################
+
+
+class PageContext:
+
+    """The context of a single rewriting pass over one page. A fresh
+    PageContext is handed to the handlers for every page.
+
+    Attributes:
+        root: Whatever has been passed to `HTMLRewriter.rewrite()` as root,
+            usually the sitetree.Folder that contains the page.
+        data (str): The complete (unmodified) page.
+        state (dict): Scratch space for handlers that need to keep track of
+            things while the page is being processed, e.g. counters.
+    """
+
+    def __init__(self, root, data):
+        self.root = root
+        self.data = data
+        self.state = {}
+
+
+class HTMLRewriter:
+
+    """Rewrites HTML pages in a single pass. Handlers are registered for
+    particular kinds of tokens (and, optionally, particular tag names) and
+    receive the text of the token, the token itself and the PageContext.
+    They return the replacement for the token text, which may just be the
+    unaltered text. If several handlers are registered for the same
+    token, they are chained in the order of their registration.
+
+    Only the tokens for which handlers are registered are sliced out of the
+    page and only those that have changed are copied into the result. If
+    nothing changes, the very same page string is returned.
+
+    Element handlers receive a complete element from its start tag up to
+    and including the matching end tag (e.g. "<h1>...</h1>"). The tokens in
+    between are not passed to any other handlers. Elements are not nested,
+    i.e. the first end tag with the same name closes the element.
+
+    Example:
+        >>> rw = HTMLRewriter()
+        >>> rw.register(lambda text, token, page: text.upper(), TEXT)
+        >>> rw.rewrite("<p>text</p>")
+        '<p>TEXT</p>'
+    """
+
+    def __init__(self):
+        self.handlers = {kind: [] for kind in ALL_KINDS}
+        self.tag_handlers = {STARTTAG: {}, ENDTAG: {}}
+        self.element_handlers = {}
+        self.registered = 0     # number of registrations, for ordering
+        self.merged = {}        # (kind, name) -> merged list of handlers
+
+    def register(self, handler, kinds, names=None):
+        """Registers `handler` for tokens of the given `kinds` (a kind or a
+        sequence of kinds). For STARTTAG and ENDTAG tokens the handler can be
+        restricted to a set of lower case tag `names`.
+        """
+        if isinstance(kinds, str):
+            kinds = (kinds,)
+        self.registered += 1
+        self.merged = {}
+        for kind in kinds:
+            if names is not None and kind in self.tag_handlers:
+                for name in names:
+                    self.tag_handlers[kind].setdefault(name, []).\
+                        append((self.registered, handler))
+            else:
+                self.handlers[kind].append((self.registered, handler))
+
+    def register_element(self, handler, names):
+        """Registers `handler` for complete elements with any of the given
+        lower case tag `names`."""
+        for name in names:
+            self.element_handlers.setdefault(name, []).append(handler)
+
+    def token_handlers(self, token):
+        """Returns the list of handlers that apply to `token` in the order
+        of their registration."""
+        key = (token.kind, token.name)
+        if key not in self.merged:
+            handlers = self.handlers[token.kind]
+            named = self.tag_handlers.get(token.kind)
+            if named and token.name in named:
+                handlers = sorted(handlers + named[token.name],
+                                  key=lambda item: item[0])
+            self.merged[key] = [handler for _, handler in handlers]
+        return self.merged[key]
+
+    def rewrite(self, data, root=None):
+        """Runs all registered handlers over the page `data` and returns the
+        rewritten page.
+        """
+        page = PageContext(root, data)
+        pieces = []
+        last = 0
+        tokens = tokenize(data)
+        for token in tokens:
+            if token.kind == STARTTAG and token.name in self.element_handlers:
+                handlers = self.element_handlers[token.name]
+                end = len(data)
+                for t in tokens:
+                    if t.kind == ENDTAG and t.name == token.name:
+                        end = t.end
+                        break
+                token = Token(token.kind, token.start, end, token.name)
+            else:
+                handlers = self.token_handlers(token)
+            if not handlers:
+                continue
+            original = data[token.start:token.end]
+            text = original
+            for handler in handlers:
+                text = handler(text, token, page)
+            if text != original:
+                pieces.append(data[last:token.start])
+                pieces.append(text)
+                last = token.end
+        if not pieces:
+            return data
+        pieces.append(data[last:])
+        return "".join(pieces)
+
+
+##############################################################################
+#
+# writers
+#
+##############################################################################
+
+
+def streaming_writer(register_func):
+    """Decorator that turns a function which registers handlers on an
+    HTMLRewriter into a writer (root, content) -> content.
+
+    Other than ordinary writers, streaming writers can be combined with
+    other streaming writers (see `combine_writers()`), so that a page is
+    tokenized only once for all of them.
+    """
+    @functools.wraps(register_func)
+    def writer(root, content):
+        rewriter = HTMLRewriter()
+        register_func(rewriter)
+        return rewriter.rewrite(content, root)
+
+    writer.register = register_func
+    return writer
+
+
+def is_streaming_writer(writer):
+    return hasattr(writer, 'register')
+
+
+def combine_writers(writers):
+    """Returns a list of writers where each run of successive streaming
+    writers in `writers` has been merged into a single streaming writer.
+    Ordinary writers are passed through as they are.
+    """
+    combined = []
+    run = []
+
+    def merge(run):
+        if len(run) == 1:
+            return run[0]
+
+        def register_all(rewriter):
+            for wr in run:
+                wr.register(rewriter)
+        register_all.__name__ = "+".join(wr.__name__ for wr in run)
+        return streaming_writer(register_all)
+
+    for wr in writers:
+        if is_streaming_writer(wr):
+            run.append(wr)
+        else:
+            if run:
+                combined.append(merge(run))
+                run = []
+            combined.append(wr)
+    if run:
+        combined.append(merge(run))
+    return combined
@@ -0,0 +1,483 @@
+"""images.py -- reading the dimensions of images from their file headers,
+    lossless optimisation of PNG and SVG images, SVG sprite sheets and
+    inlining of small images
+
+Copyright 2015  by Eckhart Arnold
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import base64
+import collections
+import hashlib
+import os
+import re
+import struct
+import threading
+import urllib.parse
+import zlib
+
+import htmlrewriter
+import minify
+import tools
+import utility
+
+
+##############################################################################
+#
+# image dimensions
+#
+##############################################################################
+
+HEADER_SIZE = 64 * 1024     # bytes read for finding the dimensions
+
+RX_SVG_TAG = re.compile(rb"<svg\b[^>]*>", re.IGNORECASE)
+RX_SVG_LENGTH = re.compile(r"\s*([0-9]*\.?[0-9]+)\s*(px)?\s*$")
+
+
+def png_size(data):
+    if data.startswith(b"\x89PNG\r\n\x1a\n") and data[12:16] == b"IHDR":
+        return struct.unpack(">II", data[16:24])
+    return None
+
+
+def gif_size(data):
+    if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        return struct.unpack("<HH", data[6:10])
+    return None
+
+
+def jpeg_size(data):
+    if not data.startswith(b"\xff\xd8"):
+        return None
+    pos = 2
+    while pos + 9 <= len(data):
+        if data[pos] != 0xff:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xff:          # padding
+            pos += 1
+            continue
+        if 0xd0 <= marker <= 0xd9 or marker == 0x01:   # no segment length
+            pos += 2
+            continue
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+            return width, height
+        pos += 2 + struct.unpack(">H", data[pos + 2:pos + 4])[0]
+    return None
+
+
+def webp_size(data):
+    if data[:4] != b"RIFF" or data[8:12] != b"WEBP" or len(data) < 30:
+        return None
+    chunk = data[12:16]
+    if chunk == b"VP8 ":
+        width, height = struct.unpack("<HH", data[26:30])
+        return width & 0x3fff, height & 0x3fff
+    if chunk == b"VP8L":
+        bits = struct.unpack("<I", data[21:25])[0]
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    if chunk == b"VP8X":
+        return (int.from_bytes(data[24:27], "little") + 1,
+                int.from_bytes(data[27:30], "little") + 1)
+    return None
+
+
+def svg_size(data):
+    """Returns the size of an svg image as given by the width and height
+    attributes of its root element or, if these are missing or relative,
+    by its viewBox."""
+    m = RX_SVG_TAG.search(data)
+    if not m:
+        return None
+    attributes = htmlrewriter.tag_attributes(
+        m.group().decode("utf-8", errors="replace"))
+    lengths = [RX_SVG_LENGTH.match(attributes.get(key) or "")
+               for key in ("width", "height")]
+    if all(lengths):
+        return tuple(round(float(length.group(1))) for length in lengths)
+    viewbox = (attributes.get("viewbox") or "").replace(",", " ").split()
+    if len(viewbox) == 4:
+        try:
+            return tuple(round(float(value)) for value in viewbox[2:])
+        except ValueError:
+            pass
+    return None
+
+
+SNIFFERS = [png_size, gif_size, jpeg_size, webp_size, svg_size]
+
+
+def image_size(path):
+    """Returns the tuple (width, height) of the image at `path`, which is
+    read from the header of the file without decoding the image, or None
+    if `path` is not a PNG, GIF, JPEG, WebP or SVG image or if its size
+    cannot be determined."""
+    with open(path, "rb") as f:
+        data = f.read(HEADER_SIZE)
+    for sniffer in SNIFFERS:
+        try:
+            size = sniffer(data)
+        except struct.error:
+            size = None
+        if size and all(size):
+            return tuple(size)
+    return None
+
+
+class ImageSizes:
+    """Class ImageSizes keeps a persistent record of image dimensions in
+    the json file `filename`, keyed by the hashes of the image files, so
+    that the headers of images are only read once for each version of an
+    image.
+
+    Args:
+        filename (str): The json file of the record or None for a record
+            that is not stored.
+        hashes (utility.HashCache): The hash cache of the build or None, in
+            which case the images are hashed on every lookup.
+    """
+
+    def __init__(self, filename=None, hashes=None):
+        self.filename = filename
+        self.hashes = hashes
+        self.sizes = utility.load_json(filename, {}) \
+            if filename is not None else {}
+        self.changed = False
+
+    def size(self, path):
+        """Returns the tuple (width, height) of the image at `path` or None,
+        if it cannot be determined."""
+        key = self.hashes.hash(path) if self.hashes is not None \
+            else utility.md5_file(path)
+        if key not in self.sizes:
+            self.sizes[key] = image_size(path)
+            self.changed = True
+        size = self.sizes[key]
+        return tuple(size) if size else None
+
+    def save(self):
+        if self.changed and self.filename is not None:
+            utility.save_json(self.filename, self.sizes)
+            self.changed = False
+
+
+##############################################################################
+#
+# lossless optimisation
+#
+##############################################################################
+
+OPTIMIZER_VERSION = "1"     # change when the optimisers change their output
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+ZLIB_STRATEGIES = [zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED]
+
+
+def png_chunks(data):
+    """Yields the chunks of the PNG image `data` as tuples (type, data)."""
+    pos = len(PNG_SIGNATURE)
+    while pos + 12 <= len(data):
+        length, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        yield kind, data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+
+
+def png_chunk(kind, data):
+    return struct.pack(">I4s", len(data), kind) + data + \
+        struct.pack(">I", zlib.crc32(kind + data))
+
+
+def optimize_png(data):
+    """Returns the PNG image `data` with its image data (the IDAT chunks)
+    deflated again at maximum compression into a single IDAT chunk. All
+    other chunks are kept as they are. If this does not make the image any
+    smaller, `data` is returned unaltered."""
+    if not data.startswith(PNG_SIGNATURE):
+        return data
+    chunks = list(png_chunks(data))
+    kinds = [kind for kind, _ in chunks]
+    if b"IDAT" not in kinds or b"IEND" not in kinds:
+        return data
+    try:
+        raw = zlib.decompress(b"".join(chunk for kind, chunk in chunks
+                                       if kind == b"IDAT"))
+    except zlib.error:
+        return data
+    deflated = []
+    for strategy in ZLIB_STRATEGIES:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+        deflated.append(compressor.compress(raw) + compressor.flush())
+    idat = png_chunk(b"IDAT", min(deflated, key=len))
+    result = [PNG_SIGNATURE]
+    for kind, chunk in chunks:
+        if kind != b"IDAT":
+            result.append(png_chunk(kind, chunk))
+        elif idat:
+            result.append(idat)
+            idat = b""
+    result = b"".join(result)
+    return result if len(result) < len(data) else data
+
+
+EDITOR_NAMESPACES = ("inkscape", "sodipodi")
+RX_SVG_EDITOR_ELEMENTS = re.compile(
+    r"<(%s):([\w.-]+)\b[^>]*?(?:/>|>.*?</\1:\2\s*>)|"
+    r"<metadata\b[^>]*?(?:/>|>.*?</metadata\s*>)" %
+    "|".join(EDITOR_NAMESPACES), re.DOTALL)
+RX_SVG_EDITOR_ATTRIBUTES = re.compile(
+    r"""\s(?:%s):[\w.-]+\s*=\s*(?:"[^"]*"|'[^']*')""" %
+    "|".join(EDITOR_NAMESPACES))
+RX_SVG_NAMESPACE = re.compile(
+    r"""\sxmlns:([\w.-]+)\s*=\s*(?:"[^"]*"|'[^']*')""")
+RX_XML_COMMENT = re.compile(r"<!--.*?-->", re.DOTALL)
+RX_SVG_STARTTAG = re.compile(r"<[a-zA-Z][^>]*>")
+RX_SPACE_BETWEEN_TAGS = re.compile(r">\s+<")
+
+
+def optimize_svg(svg):
+    """Returns the svg image `svg` (a string) without editor (Inkscape and
+    sodipodi) elements, attributes and namespaces, metadata, comments and
+    superfluous whitespace. Whitespace between tags is kept, if the image
+    contains text."""
+    svg = RX_XML_COMMENT.sub("", svg)
+    svg = RX_SVG_EDITOR_ELEMENTS.sub("", svg)
+    svg = RX_SVG_EDITOR_ATTRIBUTES.sub("", svg)
+    for prefix in set(RX_SVG_NAMESPACE.findall(svg)):
+        used = re.search(r"[<\s]%s:" % re.escape(prefix),
+                         RX_SVG_NAMESPACE.sub("", svg))
+        if not used:
+            svg = re.sub(r"""\sxmlns:%s\s*=\s*(?:"[^"]*"|'[^']*')""" %
+                         re.escape(prefix), "", svg)
+    svg = RX_SVG_STARTTAG.sub(
+        lambda m: minify.minify_tag(m.group(), remove_quotes=False), svg)
+    if not re.search(r"<(text|tspan|textPath)\b|xml:space", svg):
+        svg = RX_SPACE_BETWEEN_TAGS.sub("><", svg)
+    return svg.strip()
+
+
+def optimize_image(ext, data):
+    """Returns the optimised version of the image `data` (bytes) of the type
+    given by the file extension `ext` ('.png' or '.svg')."""
+    if ext == ".png":
+        return optimize_png(data)
+    try:
+        svg = data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data
+    optimized = optimize_svg(svg).encode("utf-8")
+    return optimized if len(optimized) < len(data) else data
+
+
+# Outputs of the optimiser, keyed by the content hash of the images. The
+# path of the cache is set to the cache directory of the build by
+# generator.create_site()
+OPTIMIZER_CACHE = tools.ToolCache()
+
+
+def image_optimizer():
+    """Returns a preprocessor (see utility.sync_tree()) for PNG and SVG
+    images that optimises images losslessly (see `optimize_png()` and
+    `optimize_svg()`). The images of a batch are optimised in parallel by
+    the pool of worker processes. Results are cached by the content hash
+    of the images, so that an image is only optimised once.
+
+    The bytes saved are counted in the preprocessor's `statistics`
+    attribute and its `report()` function returns a summary.
+    """
+    statistics = collections.Counter()
+    lock = threading.Lock()
+
+    def optimize_batch(jobs):
+        sources, todo = [], []
+        for src, dst in jobs:
+            with open(src, "rb") as f:
+                data = f.read()
+            key = utility.md5("optimize_image", OPTIMIZER_VERSION,
+                              hashlib.md5(data).hexdigest())
+            sources.append((data, key))
+            if OPTIMIZER_CACHE.get(key) is None:
+                todo.append((os.path.splitext(src)[1].lower(), data, key))
+        if len(todo) > 1:
+            pool = utility.process_pool()
+            futures = [pool.submit(optimize_image, ext, data)
+                       for ext, data, key in todo]
+            results = [future.result() for future in futures]
+        else:
+            results = [optimize_image(ext, data) for ext, data, key in todo]
+        optimized = {key: result
+                     for (ext, data, key), result in zip(todo, results)}
+        for key, result in optimized.items():
+            OPTIMIZER_CACHE.put(key, result)
+        for (src, dst), (data, key) in zip(jobs, sources):
+            result = optimized.get(key)
+            if result is None:
+                result = OPTIMIZER_CACHE.get(key)
+            with open(dst, "wb") as f:
+                f.write(result)
+            with lock:     # batches are processed by several threads
+                statistics['files'] += 1
+                statistics['bytes_saved'] += len(data) - len(result)
+        return [dst for src, dst in jobs]
+
+    def optimizer(src, dst):
+        return optimize_batch([(src, dst)])[0]
+
+    optimizer.batch = optimize_batch
+    optimizer.statistics = statistics
+    optimizer.report = lambda: "Image optimisation of %i files saved " \
+        "%i bytes" % (statistics['files'], statistics['bytes_saved'])
+    return optimizer
+
+
+##############################################################################
+#
+# sprite sheets and inlining
+#
+##############################################################################
+
+MIME_TYPES = {".png": "image/png", ".gif": "image/gif", ".jpg": "image/jpeg",
+              ".jpeg": "image/jpeg", ".webp": "image/webp",
+              ".svg": "image/svg+xml"}
+
+RX_SVG_ROOT = re.compile(r"<svg\b[^>]*>(.*)</svg\s*>", re.DOTALL)
+RX_SVG_ID = re.compile(r"""(\sid\s*=\s*["'])([^"']+)""")
+RX_SVG_ID_REFERENCE = re.compile(r"""(url\(\s*['"]?#|href\s*=\s*["']#)"""
+                                 r"""([^"')\s]+)""")
+
+
+def data_uri(path):
+    """Returns a data URI with the content of the image at `path`. SVG
+    images are optimised (see `optimize_svg()`) and percent-encoded, other
+    images are base64-encoded."""
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, "rb") as f:
+        data = f.read()
+    if ext == ".svg":
+        svg = optimize_svg(data.decode("utf-8"))
+        return "data:image/svg+xml," + urllib.parse.quote(svg, safe=" /:=;,")
+    return "data:%s;base64,%s" % (MIME_TYPES.get(ext, "image/" + ext[1:]),
+                                  base64.b64encode(data).decode("ascii"))
+
+
+def svg_symbol(svg, symbol_id):
+    """Converts the svg image `svg` (a string) into a symbol element with
+    the id `symbol_id` for a sprite sheet. The ids within the image are
+    prefixed with `symbol_id`, so that they do not clash with the ids of
+    other symbols. Returns a tuple (symbol, dictionary of namespace
+    declarations) or None, if `svg` cannot be converted."""
+    svg = optimize_svg(svg)
+    m = RX_SVG_ROOT.search(svg)
+    if not m:
+        return None
+    attributes = htmlrewriter.tag_attributes(RX_SVG_TAG.search(
+        svg.encode("utf-8")).group().decode("utf-8"))
+    viewbox = attributes.get("viewbox")
+    if not viewbox:
+        size = svg_size(svg.encode("utf-8"))
+        if not size:
+            return None
+        viewbox = "0 0 %i %i" % size
+    namespaces = {key: value for key, value in attributes.items()
+                  if key.startswith("xmlns:")}
+    content = RX_SVG_ID.sub(lambda m: m.group(1) + symbol_id + "-" +
+                            m.group(2), m.group(1))
+    content = RX_SVG_ID_REFERENCE.sub(lambda m: m.group(1) + symbol_id +
+                                      "-" + m.group(2), content)
+    return ('<symbol id="%s" viewBox="%s">%s</symbol>' %
+            (symbol_id, viewbox, content), namespaces)
+
+
+class SpriteSheet:
+    """Class SpriteSheet collects svg images as symbols of a single sprite
+    sheet, so that many small images can be fetched with one request and
+    referenced by '<svg><use href="sheet.svg#symbol-id"/></svg>'.
+
+    The symbols are kept in the json file `filename`, keyed by the hashes
+    of the images, so that each version of an image is converted only once.
+
+    Args:
+        filename (str): The json file of the symbol record or None
+        hashes (utility.HashCache): The hash cache of the build or None
+    """
+
+    def __init__(self, filename=None, hashes=None):
+        self.filename = filename
+        self.hashes = hashes
+        self.record = utility.load_json(filename, {}) \
+            if filename is not None else {}
+        self.symbols = {}   # symbol id -> hash of the image
+        self.lock = threading.Lock()
+
+    def symbol_id(self, path):
+        name = re.sub(r"[^\w-]", "-", os.path.splitext(
+            os.path.basename(path))[0])
+        return "%s-%s" % (name, utility.md5(os.path.abspath(path))[:6])
+
+    def add(self, path):
+        """Adds the svg image at `path` to the sprite sheet and returns the
+        id of its symbol or None, if the image cannot be used as a
+        symbol."""
+        key = self.hashes.hash(path) if self.hashes is not None \
+            else utility.md5_file(path)
+        symbol_id = self.symbol_id(path)
+        record_key = symbol_id + ":" + key
+        with self.lock:
+            if record_key not in self.record:
+                with open(path, encoding="utf-8") as f:
+                    self.record[record_key] = svg_symbol(f.read(), symbol_id)
+            if self.record[record_key] is None:
+                return None
+            self.symbols[symbol_id] = record_key
+            return symbol_id
+
+    def render(self):
+        """Returns the sprite sheet with all symbols added so far."""
+        namespaces = {"xmlns": "http://www.w3.org/2000/svg"}
+        symbols = []
+        for symbol_id in sorted(self.symbols):
+            symbol, symbol_namespaces = self.record[self.symbols[symbol_id]]
+            namespaces.update(symbol_namespaces)
+            symbols.append(symbol)
+        return "<svg %s>%s</svg>" % (
+            " ".join('%s="%s"' % item for item in sorted(namespaces.items())),
+            "".join(symbols))
+
+    def write(self, path):
+        """Writes the sprite sheet to `path`, unless it is unchanged, and
+        saves the record of symbols, which is pruned to the symbols that
+        are in use. If no symbols are in use, a sprite sheet left at `path`
+        by an earlier build is removed. Returns True, if the sprite sheet
+        has been written or removed."""
+        if self.filename is not None:
+            used = set(self.symbols.values())
+            utility.save_json(self.filename, {
+                key: value for key, value in self.record.items()
+                if key in used})
+        if not self.symbols:
+            try:
+                os.remove(path)
+                return True
+            except FileNotFoundError:
+                return False
+        sheet = self.render()
+        try:
+            with open(path, encoding="utf-8") as f:
+                if f.read() == sheet:
+                    return False
+        except FileNotFoundError:
+            pass
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(sheet)
+        return True
@@ -31,6 +31,7 @@ import markdown
 import yaml
 
 from bibloader import bibtex_loader
+from htmlrewriter import HTMLRewriter
 from jinja2_loader import jinja2_loader
 import locale_strings
 from permalinks import permalinks
@@ -247,6 +248,13 @@ def gather_postprocessors(metadata):
 
     Example: If the metadata contains the directive `PERMALINKS: H1-H3` then
     this generates the postprocessor call `permalinks(data, "H1-H3", metadata)`
+
+    Postprocessors that have a `register` attribute, i.e. a function
+    (rewriter, args, metadata) that registers handlers on an
+    htmlrewriter.HTMLRewriter, are run together in a single pass over the
+    content chunk instead of being called one after the other, if they
+    follow each other in the list of postprocessors (see
+    `htmlrewriter.combine_writers()`).
     """
     post_processors = POSTPROCESSORS.copy()
     post_processor_list = [key[len("POSTPROCESSOR_"):] for key in metadata
@@ -263,9 +271,25 @@ def gather_postprocessors(metadata):
             metadata['POSTPROCESSOR_' + key] = post_processors[key]
     post_processor_list += [key for key in POSTPROCESSORS if key in metadata]
 
+    # successive postprocessors that can register handlers on an
+    # HTMLRewriter share a single pass over the data
+    steps = []
+    rewriter = None
+    for key in post_processor_list:
+        pp = post_processors[key]
+        if hasattr(pp, 'register'):
+            if rewriter is None:
+                rewriter = HTMLRewriter()
+                steps.append(rewriter.rewrite)
+            pp.register(rewriter, metadata.get(key, ""), metadata)
+        else:
+            rewriter = None
+            steps.append(lambda data, pp=pp, args=metadata.get(key, ""):
+                         pp(data, args, metadata))
+
     def postprocessor(data):
-        for key in post_processor_list:
-            data = post_processors[key](data, metadata.get(key, ""), metadata)
+        for step in steps:
+            data = step(data)
         return data
     return postprocessor
 
@@ -0,0 +1,384 @@
+"""minify.py -- in-process minification of generated web pages,
+    stylesheets and scripts
+
+Copyright 2015  by Eckhart Arnold
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import os
+import re
+
+import htmlrewriter
+from htmlrewriter import TEXT, STARTTAG, ENDTAG, COMMENT, RX_TAGNAME, \
+    RX_TAG_ATTRIBUTES
+import utility
+
+
+##############################################################################
+#
+# HTML minification
+#
+##############################################################################
+
+# Whitespace-only text between two of these tags is never rendered and can
+# be dropped entirely. Elements that are frequently displayed inline via
+# stylesheets (li, td, dt, ...) are deliberately missing from this list.
+BLOCK_ELEMENTS = {
+    "html", "head", "body", "meta", "link", "title", "base", "style",
+    "div", "p", "ul", "ol", "dl", "nav", "header", "footer", "main",
+    "section", "article", "aside", "h1", "h2", "h3", "h4", "h5", "h6",
+    "table", "thead", "tbody", "tfoot", "tr", "form", "fieldset",
+    "blockquote", "figure", "figcaption", "hr", "address"
+}
+
+RX_WHITESPACE = re.compile(r"[ \t\r\n\f]+")   # not \s, which matches &nbsp;
+RX_UNQUOTED_VALUE = re.compile(r"[\w.:#-]+$")
+RX_CONDITIONAL_COMMENT = re.compile(r"<!--\s*(\[if\s|<!\[endif\]|#)",
+                                    re.IGNORECASE)
+
+
+def collapse_whitespace(text):
+    """Collapses all runs of whitespace in `text` to a single newline, if
+    the run contained a newline, or to a single blank otherwise."""
+    return RX_WHITESPACE.sub(
+        lambda m: "\n" if "\n" in m.group() else " ", text)
+
+
+def is_conditional_comment(comment):
+    """Returns True, if `comment` is a conditional comment (e.g.
+    '<!--[if IE]>...<![endif]-->') or a server side include, both of which
+    must survive minification."""
+    return bool(RX_CONDITIONAL_COMMENT.match(comment))
+
+
+def minify_tag(tag, remove_quotes=True):
+    """Returns a minified version of the start tag `tag`: Superfluous
+    whitespace is removed and, if `remove_quotes` is True, quotes around
+    attribute values that do not need them are dropped. Tags that cannot be
+    parsed completely are returned unaltered.
+    """
+    m = RX_TAGNAME.match(tag)
+    selfclosing = tag.endswith("/>")
+    end = len(tag) - (2 if selfclosing else 1)
+    parts = [m.group()]
+    pos = m.end()
+    unquoted = False
+    for match in RX_TAG_ATTRIBUTES.finditer(tag, pos, end):
+        if tag[pos:match.start()].strip():
+            return tag
+        name, dq, sq, uq = match.groups()
+        unquoted = False
+        if dq is None and sq is None and uq is None:
+            parts.append(name)
+        else:
+            value = dq if dq is not None else sq if sq is not None else uq
+            if remove_quotes and RX_UNQUOTED_VALUE.match(value):
+                parts.append(name + "=" + value)
+                unquoted = True
+            elif dq is not None or (uq is not None and '"' not in value):
+                parts.append('%s="%s"' % (name, value))
+            else:
+                parts.append("%s='%s'" % (name, value))
+        pos = match.end()
+    if tag[pos:end].strip():
+        return tag
+    if selfclosing:
+        # a slash directly after an unquoted value would become part of it
+        return " ".join(parts) + (" />" if unquoted else "/>")
+    return " ".join(parts) + ">"
+
+
+def html_minifier(remove_comments=True, collapse_spaces=True,
+                  remove_quotes=True):
+    """Returns a streaming writer (see module htmlrewriter) that minifies
+    web pages. The content of pre, textarea, script and style elements as
+    well as conditional comments are left untouched.
+
+    The bytes saved are counted in the writer's `statistics` attribute
+    and the writer's `report()` function returns a summary.
+
+    Args:
+        remove_comments (bool): Remove all comments except for conditional
+            comments and server side includes.
+        collapse_spaces (bool): Collapse runs of whitespace in text and
+            drop whitespace-only text between block level elements.
+        remove_quotes (bool): Remove quotes from attribute values where
+            they are not needed and superfluous whitespace within tags.
+    """
+    statistics = collections.Counter()
+
+    def count(original, minified):
+        statistics['bytes_saved'] += len(original) - len(minified)
+        return minified
+
+    def minify_comment(text, token, page):
+        if is_conditional_comment(text):
+            return text
+        return count(text, "")
+
+    def minify_text(text, token, page):
+        if token.name:      # preformatted text
+            return text
+        if not text.strip(" \t\r\n\f"):
+            data = page.data
+            previous = page.state.get("previous_tag", "")
+            nxt = RX_TAGNAME.match(data, token.end) \
+                if data.startswith("<", token.end) else None
+            if previous in BLOCK_ELEMENTS and nxt \
+                    and nxt.group(1).lower() in BLOCK_ELEMENTS:
+                return count(text, "")
+        return count(text, collapse_whitespace(text))
+
+    def remember_tag(text, token, page):
+        page.state["previous_tag"] = token.name
+        return text
+
+    def minify_starttag(text, token, page):
+        return count(text, minify_tag(text, remove_quotes))
+
+    def minify_endtag(text, token, page):
+        return count(text, "</" + token.name + ">") \
+            if text[-2:-1].isspace() else text
+
+    def register(rewriter):
+        if remove_comments:
+            rewriter.register(minify_comment, COMMENT)
+        if collapse_spaces:
+            rewriter.register(minify_text, TEXT)
+            rewriter.register(remember_tag, (STARTTAG, ENDTAG))
+        if remove_quotes:
+            rewriter.register(minify_starttag, STARTTAG)
+            rewriter.register(minify_endtag, ENDTAG)
+
+    register.__name__ = "minify_html"
+    writer = htmlrewriter.streaming_writer(register)
+    writer.statistics = statistics
+    writer.report = lambda: "HTML minification saved %i bytes" % \
+        statistics['bytes_saved']
+    return writer
+
+
+##############################################################################
+#
+# CSS minification
+#
+##############################################################################
+
+# Parts of a stylesheet that must not be altered: strings, unquoted urls
+# and comments (which are handled separately)
+RX_CSS_OPAQUE = re.compile(r'"(?:\\.|[^"\\\n])*"|'
+                           r"'(?:\\.|[^'\\\n])*'|"
+                           r"/\*.*?(?:\*/|$)|"
+                           r"url\(\s*[^)\"'\s]*\s*\)", re.DOTALL)
+RX_CSS_SPACE_AROUND = re.compile(r" ?([{};,>~]) ?")
+
+
+def minify_css_code(code):
+    """Minifies a piece of css code that does not contain any strings,
+    urls or comments."""
+    code = RX_WHITESPACE.sub(" ", code)
+    code = RX_CSS_SPACE_AROUND.sub(r"\1", code)
+    code = code.replace(": ", ":").replace(";}", "}")
+    return code
+
+
+def minify_css(css):
+    """Returns a minified version of the stylesheet `css`: Comments (except
+    for '/*! ... */'-comments) and superfluous whitespace and semicolons
+    are removed. Spaces around '+' and '-' as well as before '(' and ':' are
+    left alone, because they can be significant in calc() expressions,
+    media queries and selectors.
+    """
+    parts = []
+    code = []
+    pos = 0
+    for match in RX_CSS_OPAQUE.finditer(css):
+        code.append(css[pos:match.start()])
+        opaque = match.group()
+        pos = match.end()
+        if opaque.startswith("/*") and not opaque.startswith("/*!"):
+            code.append(" ")
+            continue
+        parts.append(minify_css_code("".join(code)))
+        parts.append(opaque)
+        code = []
+    code.append(css[pos:])
+    parts.append(minify_css_code("".join(code)))
+    return "".join(parts).strip()
+
+
+##############################################################################
+#
+# JavaScript minification
+#
+##############################################################################
+
+# Keywords after which a slash starts a regular expression, not a division
+JS_REGEX_KEYWORDS = {"return", "typeof", "instanceof", "in", "of", "new",
+                     "delete", "void", "throw", "case", "do", "else",
+                     "yield", "await"}
+# Blanks adjacent to these characters can be dropped. '+', '-' and '/' are
+# deliberately missing, because 'a + +b' or 'a / /re/' must keep them.
+JS_PUNCTUATION = set("{}()[];,=:<>?&|*%!~^.")
+RX_JS_WORD = re.compile(r"[\w$\\]+|[^\x00-\x7f]+")
+RX_JS_SPACE = re.compile(r"[ \t\r\n\f\v\u00a0\ufeff]+")
+
+
+def js_regex_end(js, pos):
+    """Returns the position after the regular expression literal starting at
+    `pos` or -1, if there is no valid regular expression literal."""
+    i = pos + 1
+    in_class = False
+    while i < len(js):
+        c = js[i]
+        if c == "\\":
+            i += 1
+        elif c == "\n":
+            return -1
+        elif c == "[":
+            in_class = True
+        elif c == "]":
+            in_class = False
+        elif c == "/" and not in_class:
+            m = RX_JS_WORD.match(js, i + 1)     # flags
+            return m.end() if m else i + 1
+        i += 1
+    return -1
+
+
+def js_string_end(js, pos):
+    """Returns the position after the string or template literal starting
+    at `pos`."""
+    quote = js[pos]
+    i = pos + 1
+    while i < len(js):
+        c = js[i]
+        if c == "\\":
+            i += 1
+        elif c == quote:
+            return i + 1
+        elif c == "\n" and quote != "`":
+            return i
+        i += 1
+    return len(js)
+
+
+def minify_js(js):
+    """Returns a conservatively minified version of the script `js`:
+    Comments (except for '/*! ... */' and '@license' comments) are removed,
+    runs of blank space are collapsed and blanks next to punctuation are
+    dropped. Line breaks are kept (though empty lines are removed), so that
+    automatic semicolon insertion works as before. Identifiers are not
+    renamed and no code is rewritten.
+    """
+    out = []
+    last = ""           # last significant token
+    pending = ""        # whitespace that has not been emitted, yet
+    i = 0
+    n = len(js)
+
+    def emit(text):
+        nonlocal pending
+        if pending and out:
+            if "\n" in pending:
+                out.append("\n")
+            elif not (out[-1][-1] in JS_PUNCTUATION or
+                      text[0] in JS_PUNCTUATION) or \
+                    (text[0] == "." and out[-1][0].isdigit()):
+                # '1 .toString()' must not become '1.toString()'
+                out.append(" ")
+        pending = ""
+        out.append(text)
+
+    while i < n:
+        c = js[i]
+        if c in "\"'`":
+            end = js_string_end(js, i)
+            emit(js[i:end])
+            last = "string"
+            i = end
+        elif js.startswith("//", i):
+            end = js.find("\n", i)
+            i = n if end < 0 else end
+        elif js.startswith("/*", i):
+            end = js.find("*/", i + 2)
+            end = n if end < 0 else end + 2
+            comment = js[i:end]
+            if comment.startswith("/*!") or "@license" in comment:
+                emit(comment)
+            else:
+                pending += "\n" if "\n" in comment else " "
+            i = end
+        elif c == "/" and (not last or last in JS_REGEX_KEYWORDS or
+                           (not RX_JS_WORD.match(last) and
+                            last not in (")", "]", "string"))):
+            end = js_regex_end(js, i)
+            if end < 0:
+                emit(c)
+                last = c
+                i += 1
+            else:
+                emit(js[i:end])
+                last = "regex"
+                i = end
+        elif RX_JS_SPACE.match(c):
+            m = RX_JS_SPACE.match(js, i)
+            pending += m.group()
+            i = m.end()
+        else:
+            m = RX_JS_WORD.match(js, i)
+            token = m.group() if m else c
+            emit(token)
+            last = token
+            i += len(token)
+    return "".join(out)
+
+
+##############################################################################
+#
+# minifying files in parallel
+#
+##############################################################################
+
+MINIFIERS = {"css": minify_css, "js": minify_js}
+PARALLEL_THRESHOLD = 256 * 1024     # minimum bytes for using worker processes
+
+
+def minify_file(kind, src, dst):
+    """Minifies the file `src` with the minifier `kind` (see MINIFIERS) and
+    writes the result to `dst`. Files with '.min.' in their name are
+    considered as already minified and are copied unaltered. Returns the
+    destination path."""
+    with open(src, encoding="utf-8") as f:
+        content = f.read()
+    if ".min." not in os.path.basename(src):
+        content = MINIFIERS[kind](content)
+    with open(dst, "w", encoding="utf-8") as f:
+        f.write(content)
+    return dst
+
+
+def minify_files(kind, jobs):
+    """Minifies all files in the list of (src, dst)-pairs `jobs` and returns
+    the list of destination paths. Unless the files are small, they are
+    minified in parallel by the pool of worker processes (see
+    utility.process_pool())."""
+    size = sum(os.path.getsize(src) for src, dst in jobs)
+    if len(jobs) > 1 and size >= PARALLEL_THRESHOLD:
+        pool = utility.process_pool()
+        futures = [pool.submit(minify_file, kind, src, dst)
+                   for src, dst in jobs]
+        return [future.result() for future in futures]
+    return [minify_file(kind, src, dst) for src, dst in jobs]
@@ -18,9 +18,9 @@ limitations under the License.
 
 import re
 
+from htmlrewriter import HTMLRewriter
 from sitetree import translate
-from utility import segment_data, matching_segment_range, RX_HTML_COMMENTS, \
-    set_attributes, get_attributes
+from utility import set_attributes, get_attributes
 
 
 RX_PERMALINK_CLASS = re.compile('class *?= *?["\']permalink["\']',
@@ -87,20 +87,9 @@ def silent_permalink(heading, target, metadata):
     return heading[:start] + link + heading[start:end] + '</a>' + heading[end:]
 
 
-def permalinks(html, args, metadata):
-    """Add permalinks to the headings specified by 'args' in 'html'.
-
-    Args:
-        html (string): The web page to which permalinks shall be added.
-        args (string): Range of headings to which the permalinks shall be
-            added, e.g. "H1-H3" or "H1, H3-H5"
-        metadata(dictionary): The metadata dictionary for the current page.
-            the keys 'permalink_type' and 'permalink_sign' will be
-            interpreted if present. 'permalink_type' must be the name
-            of a function (heading, target, metadata) -> heading with permalink
-
-    Returns:
-        string. The same web page with permalinks added.
+def register_permalinks(rewriter, args, metadata):
+    """Registers a handler on the HTMLRewriter `rewriter` that adds
+    permalinks to the headings specified by 'args'. See `permalinks()`.
     """
 
     def parse_args(args):
@@ -134,25 +123,38 @@ def permalinks(html, args, metadata):
         text = RX_ENTITIES.sub("", RX_TAG.sub("", heading[start:end]))
         return re.sub(r"\W", " ", text).strip().replace(" ", "-")
 
+    def add_permalink(heading, token, page):
+        if permalink_exists(heading):
+            return heading
+        attributes = get_attributes(heading, 0)
+        if "id" not in attributes:
+            attributes['id'] = gen_id(heading)
+        heading = set_attributes(heading, 0, attributes)
+        pm_func = eval(metadata.get("permalink_type", "visible_permalink"))
+        return pm_func(heading, attributes['id'], metadata)
+
     headings = parse_args(args)
-    hstr = "".join([str(h) for h in headings])
-    rx_htags = re.compile("<h[%s].*?>.*?</h[%s]>" %
-                          (hstr, hstr), re.IGNORECASE | re.DOTALL)
-
-    def add_permalinks(segment):
-        parts = segment_data(segment, rx_htags)
-        for i in matching_segment_range(parts, rx_htags):
-            if not permalink_exists(parts[i]):
-                attributes = get_attributes(parts[i], 0)
-                if "id" not in attributes:
-                    attributes['id'] = gen_id(parts[i])
-                parts[i] = set_attributes(parts[i], 0, attributes)
-                pm_func = eval(metadata.get("permalink_type",
-                                            "visible_permalink"))
-                parts[i] = pm_func(parts[i], attributes['id'], metadata)
-        return "".join(parts)
-
-    segments = segment_data(html, RX_HTML_COMMENTS)
-    for i in matching_segment_range(segments, RX_HTML_COMMENTS, invert=True):
-        segments[i] = add_permalinks(segments[i])
-    return "".join(segments)
+    rewriter.register_element(add_permalink, ["h%i" % h for h in headings])
+
+
+def permalinks(html, args, metadata):
+    """Add permalinks to the headings specified by 'args' in 'html'.
+
+    Args:
+        html (string): The web page to which permalinks shall be added.
+        args (string): Range of headings to which the permalinks shall be
+            added, e.g. "H1-H3" or "H1, H3-H5"
+        metadata(dictionary): The metadata dictionary for the current page.
+            the keys 'permalink_type' and 'permalink_sign' will be
+            interpreted if present. 'permalink_type' must be the name
+            of a function (heading, target, metadata) -> heading with permalink
+
+    Returns:
+        string. The same web page with permalinks added.
+    """
+    rewriter = HTMLRewriter()
+    register_permalinks(rewriter, args, metadata)
+    return rewriter.rewrite(html)
+
+
+permalinks.register = register_permalinks
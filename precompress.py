@@ -0,0 +1,139 @@
+"""precompress.py -- create precompressed .gz and .br siblings of the files
+    of the generated site, so that web servers can deliver them without
+    compressing on every request.
+
+Copyright 2015  by Eckhart Arnold
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import gzip
+import os
+
+import utility
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE_EXTENSIONS = {".html", ".htm", ".css", ".js", ".svg", ".xml",
+                           ".json", ".txt"}
+
+# the file names of precompressed siblings, which are not requested by
+# their own url
+COMPRESSED_SUFFIXES = (".gz", ".br")
+
+
+def compress_file(path, level=9, brotli_quality=11):
+    """Writes gzip (and, if the brotli module is available, brotli)
+    compressed versions of the file at `path` to `path` + ".gz" (and
+    `path` + ".br"). Compressed versions that are not smaller than the
+    original are not kept. Returns a tuple (path, bytes saved, list of the
+    suffixes of the compressed versions that have been written).
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    versions = [(".gz", gzip.compress(data, level, mtime=0))]
+    if brotli is not None:
+        versions.append((".br", brotli.compress(data,
+                                                quality=brotli_quality)))
+    saved = 0
+    written = []
+    for ext, compressed in versions:
+        if len(compressed) < len(data):
+            with open(path + ext, "wb") as f:
+                f.write(compressed)
+            saved = max(saved, len(data) - len(compressed))
+            written.append(ext)
+        elif os.path.exists(path + ext):
+            os.remove(path + ext)
+    return path, saved, written
+
+
+def remove_siblings(path):
+    """Removes the compressed siblings of the file at `path`."""
+    for ext in COMPRESSED_SUFFIXES:
+        if os.path.exists(path + ext):
+            os.remove(path + ext)
+
+
+def compressible_files(site_path, extensions=COMPRESSIBLE_EXTENSIONS):
+    """Yields the paths of all files below `site_path` that have one of the
+    given `extensions`."""
+    for dirpath, dirnames, filenames in os.walk(site_path):
+        for name in filenames:
+            if os.path.splitext(name)[1].lower() in extensions:
+                yield os.path.join(dirpath, name)
+
+
+def precompress_site(site_path, cache_path, hashes, level=9,
+                     brotli_quality=11, extensions=COMPRESSIBLE_EXTENSIONS):
+    """Creates precompressed siblings for all compressible files of the
+    site at `site_path`. Files are only compressed if their content has
+    changed since the last run or if one of their compressed siblings has
+    gone missing. The siblings of files that have been removed (or are no
+    longer compressible) are removed as well. Compression runs in parallel
+    on the worker processes of utility.process_pool().
+
+    Args:
+        site_path (str): The build directory of the site
+        cache_path (str): The directory where the record of already
+            compressed files is kept
+        hashes (utility.HashCache): The hash cache of the build
+        level (int): The gzip compression level (1-9)
+        brotli_quality (int): The brotli compression quality (0-11)
+        extensions (set): Extensions of the files that shall be compressed
+
+    Returns:
+        tuple (number of compressed files, bytes saved)
+    """
+    record_name = os.path.join(cache_path, "precompressed.json")
+    record = utility.load_json(record_name, {})
+    settings = [level, brotli_quality if brotli is not None else None]
+
+    todo = {}
+    current = {}
+    for path in compressible_files(site_path, extensions):
+        key = os.path.relpath(path, site_path)
+        signature = [hashes.hash(path)] + settings
+        previous = record.get(key)
+        if previous and previous[:-1] == signature and \
+                isinstance(previous[-1], list) and \
+                all(os.path.exists(path + ext) for ext in previous[-1]):
+            current[key] = previous
+        else:
+            todo[key] = signature
+
+    results = []
+    if len(todo) > 1:
+        pool = utility.process_pool()
+        futures = [pool.submit(compress_file, os.path.join(site_path, key),
+                               level, brotli_quality)
+                   for key in todo]
+        results = [future.result() for future in futures]
+    elif todo:
+        key = next(iter(todo))
+        results = [compress_file(os.path.join(site_path, key), level,
+                                 brotli_quality)]
+
+    saved = 0
+    for path, bytes_saved, written in results:
+        key = os.path.relpath(path, site_path)
+        current[key] = todo[key] + [written]
+        saved += bytes_saved
+    for key in record.keys() - current.keys():
+        remove_siblings(os.path.join(site_path, key))
+    utility.save_json(record_name, current)
+    return len(todo), saved
@@ -0,0 +1,390 @@
+"""serverconfig.py -- generating web server configuration (Apache .htaccess
+    and _headers files for static hosting services) from the build
+
+Copyright 2015  by Eckhart Arnold
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import posixpath
+import re
+
+import precompress
+
+
+PAGE_EXTENSIONS = {".html", ".htm"}
+SERVER_FILES = {".htaccess", "_headers", "index.var"}
+MAX_HEADERS_RULES = 100     # rules per _headers file on Cloudflare Pages
+
+# content types of precompressed siblings, which Apache would otherwise
+# deliver as application/gzip
+MIME_TYPES = {".html": "text/html", ".htm": "text/html", ".css": "text/css",
+              ".js": "application/javascript", ".svg": "image/svg+xml",
+              ".xml": "application/xml", ".json": "application/json",
+              ".txt": "text/plain"}
+
+
+##############################################################################
+#
+# generated blocks
+#
+##############################################################################
+
+
+def update_block(path, name, content):
+    """Writes `content` as the block `name` to the configuration file at
+    `path`. Generated blocks are enclosed in the comment lines
+    '# BEGIN name' and '# END name', so that they can be replaced in later
+    builds without touching anything else in the file, e.g. hand-written
+    rules. The file is only written if it changes. Returns True, if the
+    file has been written.
+    """
+    begin, end = "# BEGIN %s\n" % name, "# END %s\n" % name
+    block = begin + content.rstrip("\n") + "\n" + end if content else ""
+    try:
+        with open(path, encoding="utf-8") as f:
+            old = f.read()
+    except FileNotFoundError:
+        old = ""
+    m = re.search(re.escape(begin) + ".*?" + re.escape(end), old, re.DOTALL)
+    if m:
+        new = old[:m.start()] + block + old[m.end():]
+    elif block:
+        new = old + ("\n" if old and not old.endswith("\n") else "") + block
+    else:
+        new = old
+    if new == old:
+        return False
+    if new:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(new)
+    elif os.path.exists(path):
+        os.remove(path)
+    return True
+
+
+##############################################################################
+#
+# caching headers
+#
+##############################################################################
+
+
+def site_files(site_path):
+    """Yields the paths (relative to `site_path`, with forward slashes) of
+    all files of the site except for precompressed siblings and server
+    configuration files."""
+    for dirpath, dirnames, filenames in os.walk(site_path):
+        dirnames.sort()
+        for name in sorted(filenames):
+            base, ext = os.path.splitext(name)
+            if name in SERVER_FILES or (ext in precompress.COMPRESSED_SUFFIXES
+                                        and base in filenames):
+                continue
+            path = os.path.relpath(os.path.join(dirpath, name), site_path)
+            yield path.replace(os.path.sep, "/")
+
+
+def cache_control(path, fingerprinted, page_ttl, asset_ttl, immutable_ttl):
+    """Returns the value of the Cache-Control header for the site relative
+    `path`."""
+    if path in fingerprinted:
+        return "public, max-age=%i, immutable" % immutable_ttl
+    if os.path.splitext(path)[1].lower() in PAGE_EXTENSIONS:
+        return "public, max-age=%i, must-revalidate" % page_ttl
+    return "public, max-age=%i" % asset_ttl
+
+
+def htaccess_caching(fingerprinted, page_ttl, asset_ttl, immutable_ttl):
+    """Returns the Apache configuration for caching: Pages and other files
+    get short and medium lifetimes, the fingerprinted files (a set of site
+    relative paths) are cached forever. ETags are derived from size and
+    modification time only (not from the inode, which differs between
+    servers), which the build keeps stable for unchanged files. Requests
+    from browsers that accept brotli or gzip are answered with the
+    precompressed siblings of files, if they exist."""
+    extensions = "|".join(sorted(ext[1:] for ext in
+                                 precompress.COMPRESSIBLE_EXTENSIONS))
+    lines = [
+        "FileETag MTime Size",
+        "<IfModule mod_headers.c>",
+        '  Header set Cache-Control "public, max-age=%i"' % asset_ttl,
+        '  <FilesMatch "\\.(html|htm)(\\.gz|\\.br)?$">',
+        '    Header set Cache-Control "public, max-age=%i, must-revalidate"'
+        % page_ttl,
+        "  </FilesMatch>"]
+    names = sorted({re.escape(os.path.basename(path))
+                    for path in fingerprinted})
+    for i in range(0, len(names), 50):
+        lines += [
+            '  <FilesMatch "^(%s)(\\.gz|\\.br)?$">' % "|".join(names[i:i + 50]),
+            '    Header set Cache-Control "public, max-age=%i, immutable"'
+            % immutable_ttl,
+            "  </FilesMatch>"]
+    lines += [
+        '  <FilesMatch "\\.(%s)(\\.gz|\\.br)?$">' % extensions,
+        "    Header append Vary Accept-Encoding",
+        "  </FilesMatch>",
+        "</IfModule>",
+        "<IfModule mod_rewrite.c>",
+        "  RewriteEngine On",
+        "  RewriteCond %{HTTP:Accept-Encoding} br",
+        "  RewriteCond %{REQUEST_FILENAME}.br -f",
+        "  RewriteRule ^(.*)$ $1.br [L]",
+        "  RewriteCond %{HTTP:Accept-Encoding} gzip",
+        "  RewriteCond %{REQUEST_FILENAME}.gz -f",
+        "  RewriteRule ^(.*)$ $1.gz [L]",
+        "</IfModule>"]
+    for ext in sorted(precompress.COMPRESSIBLE_EXTENSIONS):
+        lines.append('<FilesMatch "\\%s\\.(gz|br)$">' % ext)
+        lines.append('  ForceType %s' % MIME_TYPES.get(
+            ext, "application/octet-stream"))
+        lines.append("</FilesMatch>")
+    lines += ["AddEncoding gzip .gz", "AddEncoding br .br"]
+    return "\n".join(lines)
+
+
+def headers_caching(site_path, fingerprinted, page_ttl, asset_ttl,
+                    immutable_ttl):
+    """Returns the caching rules for a _headers file (as understood by
+    Netlify, Cloudflare Pages and similar services). As these services
+    limit the number of rules (see MAX_HEADERS_RULES), there is one rule
+    per class of files rather than one per file: a default rule, which
+    also sets Vary, rules for pages and rules for the fingerprinted files.
+    Fingerprinted files share the rule '/dir/*.ext' with the other
+    fingerprinted files of their directory, unless it would match a file
+    that is not fingerprinted. Because the services combine the headers of
+    all rules that match a URL, the more specific rules detach the
+    Cache-Control header of the default rule. No ETags are set, as the
+    services generate the validators for each representation themselves."""
+    files = list(site_files(site_path))
+    groups = {}
+    for path in sorted(fingerprinted):
+        groups.setdefault((posixpath.dirname(path),
+                           posixpath.splitext(path)[1]), []).append(path)
+    immutable = []
+    for (dirname, ext), paths in sorted(groups.items()):
+        prefix = dirname + "/"
+        if dirname and ext and \
+                all(path in fingerprinted for path in files
+                    if path.startswith(prefix) and path.endswith(ext)):
+            immutable.append("/" + prefix + "*" + ext)
+        else:
+            immutable.extend("/" + path for path in paths)
+    pages = ["/", "/*/"] + ["/*" + ext for ext in sorted(PAGE_EXTENSIONS)]
+    room = MAX_HEADERS_RULES - 1 - len(pages)
+    if len(immutable) > room:
+        print("Warning: only %i of %i fingerprinted files or directories "
+              "fit into _headers" % (room, len(immutable)))
+        immutable = immutable[:room]
+    lines = ["/*",
+             "  Cache-Control: public, max-age=%i" % asset_ttl,
+             "  Vary: Accept-Encoding"]
+    for patterns, value in (
+            (pages, "public, max-age=%i, must-revalidate" % page_ttl),
+            (immutable, "public, max-age=%i, immutable" % immutable_ttl)):
+        for pattern in patterns:
+            lines += [pattern, "  ! Cache-Control",
+                      "  Cache-Control: " + value]
+    return "\n".join(lines)
+
+
+def write_caching_headers(site_path, fingerprinted, page_ttl=300,
+                          asset_ttl=86400, immutable_ttl=31536000,
+                          formats=("htaccess", "headers")):
+    """Writes the caching configuration of the site at `site_path` to the
+    .htaccess and/or the _headers file in the root directory of the site.
+
+    Args:
+        site_path (str): The build directory of the site
+        fingerprinted (set): The site relative paths of all files with a
+            content hash in their name
+        page_ttl (int): Seconds for which pages may be cached
+        asset_ttl (int): Seconds for which other files may be cached
+        immutable_ttl (int): Seconds for which fingerprinted files may be
+            cached
+        formats (sequence): "htaccess" and/or "headers"
+
+    Returns:
+        list of the names of the files that have been written
+    """
+    written = []
+    if "htaccess" in formats:
+        if update_block(os.path.join(site_path, ".htaccess"), "caching",
+                        htaccess_caching(fingerprinted, page_ttl, asset_ttl,
+                                         immutable_ttl)):
+            written.append(".htaccess")
+    if "headers" in formats:
+        if update_block(os.path.join(site_path, "_headers"), "caching",
+                        headers_caching(site_path, fingerprinted,
+                                        page_ttl, asset_ttl, immutable_ttl)):
+            written.append("_headers")
+    return written
+
+
+##############################################################################
+#
+# language negotiation
+#
+##############################################################################
+
+RX_HEAD = re.compile(r"<head(?:\s[^>]*)?>", re.IGNORECASE)
+RX_BASE = re.compile(r"<base\s", re.IGNORECASE)
+
+TYPE_MAP = "index.var"
+
+
+def language_tag(lang):
+    """Returns the language tag (as used in Accept-Language headers) for
+    the language `lang` of the site, e.g. 'en' for 'EN'."""
+    return lang.lower().replace("_", "-")
+
+
+def variant_name(lang):
+    """Returns the name of the root index variant for `lang`."""
+    return "index.%s.html" % language_tag(lang)
+
+
+def rebased_page(html, base):
+    """Inserts a <base href="`base`"> tag into the head of `html`, so that
+    the relative URLs of a page still work if it is delivered from the
+    root directory. Pages that already have a base tag are returned
+    unchanged."""
+    if RX_BASE.search(html):
+        return html
+    tag = '<base href="%s">' % base
+    m = RX_HEAD.search(html)
+    if m:
+        return html[:m.end()] + tag + html[m.end():]
+    return tag + html
+
+
+def type_map(languages, default):
+    """Returns an Apache type map that lets mod_negotiation choose the root
+    index variant matching the Accept-Language header. The `default`
+    language has the highest source quality, so that it is delivered if
+    none of the languages is acceptable."""
+    entries = ["URI: index"]
+    for lang in languages:
+        qs = "1.0" if lang == default else "0.9"
+        entries.append("URI: %s\nContent-Type: text/html;qs=%s\n"
+                       "Content-Language: %s"
+                       % (variant_name(lang), qs, language_tag(lang)))
+    return "\n\n".join(entries) + "\n"
+
+
+def htaccess_languages(languages, default):
+    """Returns the Apache configuration for delivering the root index in
+    the language of the visitor without a redirect: mod_negotiation picks
+    a variant through the type map; if it is not available, mod_rewrite
+    picks the variant for the primary language of the Accept-Language
+    header."""
+    others = [lang for lang in languages if lang != default]
+    priority = " ".join(language_tag(lang) for lang in [default] + others)
+    lines = [
+        "<IfModule mod_negotiation.c>",
+        "  AddHandler type-map .var",
+        "  DirectoryIndex %s index.html" % TYPE_MAP,
+        "  LanguagePriority " + priority,
+        "  ForceLanguagePriority Prefer Fallback",
+        "</IfModule>",
+        "<IfModule !mod_negotiation.c>",
+        "  <IfModule mod_rewrite.c>",
+        "    RewriteEngine On"]
+    for lang in others:
+        lines += [
+            "    RewriteCond %%{HTTP:Accept-Language} ^%s\\b [NC]"
+            % re.escape(language_tag(lang)),
+            "    RewriteRule ^(index\\.html)?$ %s [L]" % variant_name(lang)]
+    lines += [
+        "    RewriteRule ^(index\\.html)?$ %s [L]" % variant_name(default),
+        "  </IfModule>",
+        "  <IfModule mod_headers.c>",
+        '    <FilesMatch "^index\\.[a-z-]+\\.html(\\.gz|\\.br)?$">',
+        "      Header append Vary Accept-Language",
+        "    </FilesMatch>",
+        "  </IfModule>",
+        "</IfModule>"]
+    return "\n".join(lines)
+
+
+def fallback_index(languages, default, index="index.html"):
+    """Returns a minimal root index for static hosts that cannot negotiate
+    the language: an inline script sends the visitor to the index of the
+    first preferred language that the site offers, without waiting for any
+    further resources. Without scripting, a meta refresh leads to the
+    index of the `default` language."""
+    targets = ",".join('"%s":"%s/%s"' % (language_tag(lang), lang, index)
+                       for lang in languages)
+    default_url = "%s/%s" % (default, index)
+    links = "".join('<a href="%s/%s" hreflang="%s">%s</a> '
+                    % (lang, index, language_tag(lang), lang)
+                    for lang in languages)
+    return ('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><script>'
+            'var t={%s},l=navigator.languages||[navigator.language||""],u='
+            '"%s";for(var i=0;i<l.length;i++){var k=l[i].toLowerCase();'
+            'if(t[k]||t[k.split("-")[0]]){u=t[k]||t[k.split("-")[0]];break}}'
+            'location.replace(u)</script><noscript><meta http-equiv="refresh"'
+            ' content="0; URL=%s"></noscript></head><body>%s</body></html>\n'
+            % (targets, default_url, default_url, links.strip()))
+
+
+def write_if_changed(path, content):
+    """Writes `content` to the file at `path`, unless it already contains
+    exactly this. Returns True, if the file has been written."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+    return True
+
+
+def write_language_negotiation(site_path, languages, default, fallback=True,
+                               index="index.html"):
+    """Writes the files for delivering the root index of the site at
+    `site_path` in the visitor's language: a variant 'index.<lang>.html'
+    of the index page of each language (with a base tag that points to the
+    language directory), the type map, the rules in .htaccess and, if
+    `fallback` is True, the root index.html for static hosts.
+
+    Args:
+        site_path (str): The build directory of the site
+        languages (list): The languages of the site, e.g. ['EN', 'DE']
+        default (str): The language for visitors that accept none of them
+        fallback (bool): Whether to write the root index.html
+        index (str): The name of the index page in the language directories
+
+    Returns:
+        list of the names of the files that have been written
+    """
+    written = []
+    for lang in languages:
+        with open(os.path.join(site_path, lang, index), encoding="utf-8") as f:
+            page = rebased_page(f.read(), lang + "/")
+        if write_if_changed(os.path.join(site_path, variant_name(lang)), page):
+            written.append(variant_name(lang))
+    if write_if_changed(os.path.join(site_path, TYPE_MAP),
+                        type_map(languages, default)):
+        written.append(TYPE_MAP)
+    if update_block(os.path.join(site_path, ".htaccess"), "languages",
+                    htaccess_languages(languages, default)):
+        written.append(".htaccess")
+    if fallback and write_if_changed(os.path.join(site_path, "index.html"),
+                                     fallback_index(languages, default, index)):
+        written.append("index.html")
+    return written
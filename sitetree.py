@@ -22,7 +22,7 @@ import collections.abc
 import os
 
 import locale_strings
-from utility import copy_on_condition, copytree_on_condition, is_newer
+from utility import sync_tree
 
 
 class Entry(dict):
@@ -146,15 +146,19 @@ class StaticEntry:
         entryname(str): the file or directory name of the static entry
         entrypath(str): the absolute path of the entry
         isdir(bool): indicates whether the entry represents
+        link_mode(str): how the files of the entry are placed in the build
+            directory: "copy", "reflink", "hardlink", "symlink" or "auto"
+            (see `utility.link_or_copy()`)
     """
 
-    def __init__(self, entryname):
+    def __init__(self, entryname, link_mode="copy"):
         self.entryname = entryname
         self.entrypath = os.path.abspath(entryname)
         self.isdir = os.path.isdir(entryname)
+        self.link_mode = link_mode
 
-    # TODO: Maybe, Symlinking would even be better!!
-    def copy_entry(self, dst_path="", preprocessors={}):
+    def copy_entry(self, dst_path="", preprocessors={}, manifest=None,
+                   trust_dir_mtimes=False, workers=None):
         """Copies the entry to the build path of the site.
         Arguments:
            dest_path(string): the destination directory
@@ -165,16 +169,21 @@ class StaticEntry:
               is done if a preprocessor for the file extension is found in
               the dictionary. Preprocessors can be employed to minify
               javascript files or compile less stylsheets to css stylesheets.
+              Files for which no preprocessor exists are copied or linked
+              according to the entry's `link_mode`.
+           manifest(utility.SyncManifest): The record of the files that
+              have been copied in previous builds. Only files that have
+              changed since are copied again.
+           trust_dir_mtimes(bool): Skip directories that have not been
+              modified since the last build. See `utility.sync_tree()`
+           workers(int): The number of threads that copy files in parallel
+        Returns:
+           list. The sitemap entries for the copied HTML and PDF files
         """
         sitemap = []
-        if self.isdir:
-            copytree_on_condition(self.entrypath,
-                                  os.path.join(dst_path, self.entryname),
-                                  is_newer, preprocessors, sitemap)
-        else:
-            copy_on_condition(self.entrypath,
-                              os.path.join(dst_path, self.entryname),
-                              is_newer, preprocessors, sitemap)
+        sync_tree(self.entrypath, os.path.join(dst_path, self.entryname),
+                  preprocessors, sitemap, self.link_mode, manifest,
+                  trust_dir_mtimes, workers)
         return sitemap
 
 
@@ -0,0 +1,118 @@
+"""benchmark_minifiers.py -- compares the throughput of the builtin css and
+javascript minifiers with the external tools cleancss and closure
+
+Usage: python benchmark_minifiers.py [directory with .css and .js files]
+
+If no directory is given, a synthetic set of stylesheets and scripts is
+generated. External tools that are not installed are skipped. The output
+cache of the external tools is switched off, so that every file is
+actually processed.
+
+Copyright 2015  by Eckhart Arnold
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import generator
+import minify
+import tools
+import utility
+
+
+CSS_SAMPLE = """/* block %i */
+.nav-%i a:hover , .nav-%i > li {
+    color : #333 ;  margin: 0 auto;
+    background: url(images/bg%i.png) no-repeat;
+    width: calc(100%% - 2em);
+}
+@media screen and (max-width: 600px) { .nav-%i { display: none; } }
+"""
+
+JS_SAMPLE = """// function %i
+function handler%i(event, options) {
+    /* check the arguments */
+    var target = event.target || event.srcElement;
+    if (options && options.filter.test(target.className)) {
+        return target.getAttribute("data-value-%i") / 2;
+    }
+    return /^item-\\d+$/.test(target.id) ? %i : -1;
+}
+"""
+
+
+def create_samples(path, files=40, blocks=200):
+    """Writes `files` synthetic stylesheets and scripts to `path`."""
+    for i in range(files):
+        for ext, sample in ((".css", CSS_SAMPLE), (".js", JS_SAMPLE)):
+            with open(os.path.join(path, "sample%i%s" % (i, ext)), "w") as f:
+                for k in range(blocks):
+                    f.write(sample.replace("%i", str(i * blocks + k)))
+
+
+def benchmark(name, function, jobs):
+    size = sum(os.path.getsize(src) for src, dst in jobs)
+    start = time.perf_counter()
+    function(jobs)
+    seconds = time.perf_counter() - start
+    print("%-24s %4i files  %8.2f s  %8.2f MB/s" %
+          (name, len(jobs), seconds, size / seconds / 2**20))
+
+
+def main(source_dir):
+    tools.TOOL_CACHE.path = None
+    with tempfile.TemporaryDirectory() as tmp:
+        if source_dir is None:
+            source_dir = os.path.join(tmp, "src")
+            os.mkdir(source_dir)
+            create_samples(source_dir)
+        out_dir = os.path.join(tmp, "out")
+        os.mkdir(out_dir)
+        for ext in (".css", ".js"):
+            jobs = [(os.path.join(source_dir, name),
+                     os.path.join(out_dir, name))
+                    for name in sorted(os.listdir(source_dir))
+                    if name.endswith(ext)]
+            if not jobs:
+                continue
+            kind = ext[1:]
+            benchmark("builtin %s (1 process)" % kind,
+                      lambda jobs: [minify.minify_file(kind, *job)
+                                    for job in jobs], jobs)
+            minify.PARALLEL_THRESHOLD = 0
+            # do not count the startup of the worker processes
+            utility.process_pool().submit(str).result()
+            benchmark("builtin %s (parallel)" % kind,
+                      lambda jobs: minify.minify_files(kind, jobs), jobs)
+            for name, (preprocessor, tool) in \
+                    generator.MINIFIERS[ext].items():
+                if tool is None:
+                    continue
+                if tools.find_tool(tool) is None:
+                    print("%-24s not installed" % tool)
+                    continue
+                benchmark(tool, lambda jobs: [preprocessor(*job)
+                                              for job in jobs], jobs)
+                if hasattr(preprocessor, "batch"):
+                    benchmark(tool + " (batch)", preprocessor.batch, jobs)
+    utility.shutdown_process_pool()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
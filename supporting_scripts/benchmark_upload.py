@@ -0,0 +1,174 @@
+"""benchmark_upload.py -- compares the sequential upload of many small files
+via SFTP with the pipelined upload of `SFTPWrapper.upload_files()` and
+`SFTPWrapper.mkdirs()`
+
+Usage: python benchmark_upload.py [--files N] [--size BYTES] [--latency MS]
+
+The files are uploaded over a single connection to the local SFTP server of
+the test suite (tests/sftpserver.py). In order to simulate a link to a
+remote server, the connection passes a proxy that delays the data in both
+directions by half of the given round trip time.
+
+Copyright 2015  by Eckhart Arnold
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import os
+import queue
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "tests"))
+
+import sftpserver
+import upload
+
+
+class LatencyProxy:
+    """Forwards the connections to `port` on localhost and delays the data
+    in each direction by `delay` seconds."""
+
+    def __init__(self, port, delay):
+        self.target = port
+        self.delay = delay
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen(4)
+        self.port = self.socket.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                client, address = self.socket.accept()
+            except OSError:
+                return
+            server = socket.create_connection(("127.0.0.1", self.target))
+            for a, b in ((client, server), (server, client)):
+                a.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.pump(a, b)
+
+    def pump(self, source, destination):
+        delayed = queue.Queue()
+
+        def receive():
+            while True:
+                try:
+                    data = source.recv(65536)
+                except OSError:
+                    data = b""
+                delayed.put((time.perf_counter() + self.delay, data))
+                if not data:
+                    return
+
+        def send():
+            while True:
+                due, data = delayed.get()
+                time.sleep(max(0.0, due - time.perf_counter()))
+                try:
+                    if not data:
+                        destination.shutdown(socket.SHUT_WR)
+                        return
+                    destination.sendall(data)
+                except OSError:
+                    return
+
+        threading.Thread(target=receive, daemon=True).start()
+        threading.Thread(target=send, daemon=True).start()
+
+    def close(self):
+        self.socket.close()
+
+
+def create_files(path, files, size):
+    """Writes `files` files of `size` bytes to ten subdirectories of `path`
+    and returns the directories and the list of (local, remote) paths."""
+    dirs = ["dir%i" % i for i in range(10)]
+    transfers = []
+    for d in dirs:
+        os.makedirs(os.path.join(path, d))
+    for i in range(files):
+        rel_path = os.path.join(dirs[i % len(dirs)], "file%i.html" % i)
+        with open(os.path.join(path, rel_path), "wb") as f:
+            f.write(os.urandom(size))
+        transfers.append((os.path.join(path, rel_path), rel_path))
+    return dirs, transfers
+
+
+def sequential(remote, dirs, transfers):
+    for path in dirs:
+        remote.mkdir(path)
+    for local_path, remote_path in transfers:
+        remote.upload_file(local_path, remote_path)
+
+
+def pipelined(remote, dirs, transfers):
+    remote.mkdirs(dirs)
+    for batch in upload.upload_batches(transfers, 1):
+        remote.upload_files(batch)
+
+
+def benchmark(name, function, remote, server_root, dirs, transfers):
+    for entry in os.listdir(server_root):
+        shutil.rmtree(os.path.join(server_root, entry))
+    size = sum(os.path.getsize(src) for src, dst in transfers)
+    trips = remote.round_trips
+    start = time.perf_counter()
+    function(remote, dirs, transfers)
+    seconds = time.perf_counter() - start
+    print("%-12s %5i files  %8.2f s  %8.1f files/s  %8.2f MB/s  "
+          "%5i round trips" % (name, len(transfers), seconds,
+                               len(transfers) / seconds,
+                               size / seconds / 2**20,
+                               remote.round_trips - trips))
+
+
+def main(files, size, latency):
+    with tempfile.TemporaryDirectory() as tmp:
+        local_root = os.path.join(tmp, "local")
+        server_root = os.path.join(tmp, "server")
+        os.mkdir(server_root)
+        dirs, transfers = create_files(local_root, files, size)
+        with sftpserver.SFTPTestServer(server_root) as server:
+            proxy = LatencyProxy(server.port, latency / 2000)
+            sftp = upload.SFTP_connect("127.0.0.1", proxy.port, "bench",
+                                       "bench")
+            remote = upload.SFTPWrapper("", sftp)
+            print("round trip time: %i ms" % latency)
+            benchmark("sequential", sequential, remote, server_root, dirs,
+                      transfers)
+            benchmark("pipelined", pipelined, remote, server_root, dirs,
+                      transfers)
+            remote.close()
+            proxy.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks pipelined "
+                                     "SFTP uploads")
+    parser.add_argument("--files", type=int, default=200,
+                        help="number of files (default: 200)")
+    parser.add_argument("--size", type=int, default=4096,
+                        help="size of each file in bytes (default: 4096)")
+    parser.add_argument("--latency", type=int, default=40,
+                        help="simulated round trip time in milliseconds "
+                             "(default: 40)")
+    args = parser.parse_args()
+    main(args.files, args.size, args.latency)
@@ -49,10 +49,13 @@ def create_tree(path, tree):
 
 
 def read_tree(path):
-    """reads a directory tree into a nested dictionary structure."""
+    """reads a directory tree into a nested dictionary structure. The
+    manifest of uploaded trees is ignored."""
     tree = {}
     directory = os.listdir(path)
     for entry in directory:
+        if entry == upload.REMOTE_MANIFEST:
+            continue
         fullpath = os.path.join(path, entry)
         if os.path.isdir(fullpath):
             tree[entry] = read_tree(fullpath)
@@ -74,6 +77,8 @@ def retrieve_tree(wrapper, path):
         tree = {}
         directory = wrapper.listdir(path)
         for entry in directory:
+            if entry == upload.REMOTE_MANIFEST:
+                continue
             descendant = os.path.join(path, entry)
             if wrapper.isdir(descendant):
                 tree[entry] = retrieve_tree(wrapper, descendant)
@@ -483,10 +488,22 @@ class TestUpload(unittest.TestCase):
             self.remote.mtime(os.path.join(self.dst_path, 'file_2')), \
             "mtime resolution of your system is too small for this test." \
             "choose another value for sleep() in test_upload_new_files_only!"
+        # files are compared by content: touching does not lead to an upload
+        log = upload.upload_tree(local, "", self.remote, self.dst_path)
+        del log['skipped']
+        self.assertEqual(log, expected_log)
+
+        with open(local.fullpath('file_2'), 'w') as f:
+            f.write("file 2 changed")
         expected_log['uploaded'] = {os.path.join(self.dst_path, 'file_2')}
         log = upload.upload_tree(local, "", self.remote, self.dst_path)
         del log['skipped']
         self.assertEqual(log, expected_log)
+        with open(local.fullpath('file_2'), 'w') as f:
+            f.write(self.treeA['file_2'])
+        log = upload.upload_tree(local, "", self.remote, self.dst_path)
+        del log['skipped']
+        self.assertEqual(log, expected_log)
 
         local = upload.FileSystemWrapper(self.srcB_path)
         log = upload.upload_tree(local, "", self.remote, self.dst_path)
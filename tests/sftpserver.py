@@ -0,0 +1,236 @@
+"""sftpserver.py - A local SFTP server for testing upload.py
+
+Copyright 2015  by Eckhart Arnold
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+The server accepts any user name and password and serves the directory
+`root`. It runs in a background thread:
+
+    with SFTPTestServer(root) as server:
+        sftp = upload.SFTP_connect("127.0.0.1", server.port, "user", "pw")
+"""
+
+import os
+import socket
+import threading
+
+import paramiko
+from paramiko.sftp import CMD_EXTENDED
+
+
+HOST_KEY = None
+
+
+def host_key():
+    global HOST_KEY
+    if HOST_KEY is None:
+        HOST_KEY = paramiko.RSAKey.generate(2048)
+    return HOST_KEY
+
+
+class StubServer(paramiko.ServerInterface):
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class StubSFTPHandle(paramiko.SFTPHandle):
+
+    open_handles = set()    # the handles that have not been closed, yet
+
+    def close(self):
+        super().close()
+        StubSFTPHandle.open_handles.discard(self)
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            if attr._flags & attr.FLAG_SIZE:
+                # SFTPServer.set_file_attr() would empty the file first
+                self.writefile.flush()
+                os.truncate(self.filename, attr.st_size)
+                attr._flags &= ~attr.FLAG_SIZE
+            paramiko.SFTPServer.set_file_attr(self.filename, attr)
+            return paramiko.SFTP_OK
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+def sftp_errors(function):
+    """Converts OSErrors raised by `function` into SFTP error codes."""
+    def wrapper(self, *args):
+        try:
+            return function(self, *args)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+    return wrapper
+
+
+class StubSFTPServer(paramiko.SFTPServerInterface):
+
+    def __init__(self, server, root, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = root
+
+    def local(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip("/"))
+
+    @sftp_errors
+    def list_folder(self, path):
+        path = self.local(path)
+        return [paramiko.SFTPAttributes.from_stat(
+                    os.stat(os.path.join(path, name)), name)
+                for name in os.listdir(path)]
+
+    @sftp_errors
+    def stat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.stat(self.local(path)))
+
+    @sftp_errors
+    def lstat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.lstat(self.local(path)))
+
+    @sftp_errors
+    def open(self, path, flags, attr):
+        path = self.local(path)
+        fd = os.open(path, flags, attr.st_mode or 0o666)
+        if attr.st_mode is not None or attr.st_mtime is not None:
+            paramiko.SFTPServer.set_file_attr(path, attr)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        f = os.fdopen(fd, mode)
+        handle = StubSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = f
+        handle.writefile = f
+        StubSFTPHandle.open_handles.add(handle)
+        return handle
+
+    @sftp_errors
+    def remove(self, path):
+        os.remove(self.local(path))
+        return paramiko.SFTP_OK
+
+    @sftp_errors
+    def rename(self, oldpath, newpath):
+        if os.path.exists(self.local(newpath)):
+            return paramiko.SFTP_FAILURE
+        os.rename(self.local(oldpath), self.local(newpath))
+        return paramiko.SFTP_OK
+
+    @sftp_errors
+    def posix_rename(self, oldpath, newpath):
+        os.replace(self.local(oldpath), self.local(newpath))
+        return paramiko.SFTP_OK
+
+    @sftp_errors
+    def mkdir(self, path, attr):
+        os.mkdir(self.local(path))
+        return paramiko.SFTP_OK
+
+    @sftp_errors
+    def rmdir(self, path):
+        os.rmdir(self.local(path))
+        return paramiko.SFTP_OK
+
+    @sftp_errors
+    def chattr(self, path, attr):
+        paramiko.SFTPServer.set_file_attr(self.local(path), attr)
+        return paramiko.SFTP_OK
+
+
+class CopyDataSFTPServer(paramiko.SFTPServer):
+    """Adds the copy-data extension of OpenSSH to paramiko's SFTP server."""
+
+    def _process(self, t, request_number, msg):
+        start = msg.packet.tell()
+        if t != CMD_EXTENDED or msg.get_text() != "copy-data":
+            msg.packet.seek(start)
+            return super()._process(t, request_number, msg)
+        source = self.file_table.get(msg.get_binary())
+        read_offset, length = msg.get_int64(), msg.get_int64()
+        target = self.file_table.get(msg.get_binary())
+        write_offset = msg.get_int64()
+        if source is None or target is None:
+            self._send_status(request_number, paramiko.SFTP_FAILURE)
+            return
+        source.readfile.seek(read_offset)
+        data = source.readfile.read(length or -1)
+        target.writefile.seek(write_offset)
+        target.writefile.write(data)
+        target.writefile.flush()
+        self._send_status(request_number, paramiko.SFTP_OK)
+
+
+class SFTPTestServer:
+    """Serves the directory `root` via SFTP on a free port of localhost
+    (available as attribute `port` after starting the server). The server
+    supports the copy-data extension, if `copy_data` is True."""
+
+    def __init__(self, root, copy_data=True):
+        self.root = root
+        self.copy_data = copy_data
+        self.socket = None
+        self.port = None
+        self.transports = []
+
+    def start(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen(16)
+        self.port = self.socket.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+        return self
+
+    def serve(self):
+        while True:
+            try:
+                client, address = self.socket.accept()
+            except OSError:
+                return      # the server has been stopped
+            transport = paramiko.Transport(client)
+            transport.add_server_key(host_key())
+            transport.set_subsystem_handler(
+                "sftp", CopyDataSFTPServer if self.copy_data
+                else paramiko.SFTPServer, StubSFTPServer, self.root)
+            transport.start_server(server=StubServer())
+            self.transports.append(transport)
+
+    def stop(self):
+        self.socket.close()
+        for transport in self.transports:
+            transport.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
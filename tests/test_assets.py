@@ -0,0 +1,57 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import utility
+from assets import *
+
+
+class TestFingerprinting(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.site = os.path.join(self.tmp, "site")
+        os.makedirs(os.path.join(self.site, "css"))
+        self.write("css/styles.css", "p {}")
+        self.write("css/styles.css.gz", "compressed")
+        self.hashes = utility.HashCache(os.path.join(self.tmp, "hashes.json"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, path, content):
+        with open(os.path.join(self.site, path), "w") as f:
+            f.write(content)
+
+    def test_fingerprinted_name(self):
+        self.assertEqual(fingerprinted_name("css/a.min.css", "0123abcdef"),
+                         "css/a.min.0123abcd.css")
+
+    def test_fingerprint_assets(self):
+        manifest = fingerprint_assets(self.site, ["css"], self.hashes)
+        self.assertEqual(list(manifest.keys()), ["css/styles.css"])
+        first = manifest["css/styles.css"]
+        self.assertTrue(os.path.isfile(os.path.join(self.site, first)))
+        self.assertEqual(utility.load_json(
+            os.path.join(self.site, MANIFEST_NAME)), manifest)
+
+        # fingerprinted copies are not fingerprinted again
+        self.assertEqual(fingerprint_assets(self.site, ["css"], self.hashes),
+                         manifest)
+
+        self.write("css/styles.css", "p { color: red }")
+        manifest = fingerprint_assets(self.site, ["css"], self.hashes)
+        self.assertNotEqual(manifest["css/styles.css"], first)
+        self.assertFalse(os.path.exists(os.path.join(self.site, first)))
+
+    def test_lookup(self):
+        manifest = {"css/a.css": "css/a.0123abcd.css"}
+        self.assertEqual(lookup(manifest, "css/a.css?v=1#x"),
+                         "css/a.0123abcd.css?v=1#x")
+        self.assertEqual(lookup(manifest, "css/b.css"), "css/b.css")
+
+
+if __name__ == "__main__":
+    unittest.main()
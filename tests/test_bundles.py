@@ -0,0 +1,93 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import generator
+import sitetree
+import utility
+from bundles import *
+
+
+class TestBundles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.site = os.path.join(self.tmp, "site")
+        os.makedirs(os.path.join(self.site, "js"))
+        self.write("js/a.js", "var a = 1")
+        self.write("js/b.js", "var b = 2;")
+        self.hashes = utility.HashCache(os.path.join(self.tmp, "hashes.json"))
+        self.record = os.path.join(self.tmp, "bundles.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, path, content):
+        with open(os.path.join(self.site, path), "w") as f:
+            f.write(content)
+
+    def build(self):
+        return build_bundles(self.site, {"js/all.js": ["js/a.js", "js/b.js"]},
+                             self.hashes, self.record)
+
+    def test_build_bundles(self):
+        manifest = self.build()
+        name, target = manifest["js/a.js"]
+        self.assertEqual(manifest["js/b.js"], (name, target))
+        self.assertRegex(target, r"^js/all\.[0-9a-f]{8}\.js$")
+        with open(os.path.join(self.site, target)) as f:
+            self.assertEqual(f.read(), "var a = 1;\nvar b = 2;")
+        # unchanged members: the bundle is not built again
+        mtime = os.stat(os.path.join(self.site, target)).st_mtime_ns
+        self.assertEqual(self.build(), manifest)
+        self.assertEqual(
+            os.stat(os.path.join(self.site, target)).st_mtime_ns, mtime)
+        # a changed member: a new bundle replaces the old one
+        self.write("js/b.js", "var b = 3;")
+        new_target = self.build()["js/a.js"][1]
+        self.assertNotEqual(new_target, target)
+        self.assertTrue(os.path.exists(os.path.join(self.site, new_target)))
+        self.assertFalse(os.path.exists(os.path.join(self.site, target)))
+
+    def test_stylesheets(self):
+        os.makedirs(os.path.join(self.site, "css"))
+        os.makedirs(os.path.join(self.site, "vendor", "lib"))
+        self.write("css/a.css", '@charset "utf-8";@import url(b.css);'
+                                'a{background:url(img/a.png)}')
+        self.write("vendor/lib/b.css", '@charset "UTF-8";'
+                                       'b{background:url("../b.png")}'
+                                       'c{background:url(/c.png)}')
+        manifest = build_bundles(
+            self.site, {"css/all.css": ["css/a.css", "vendor/lib/b.css"]},
+            self.hashes, self.record)
+        with open(os.path.join(self.site, manifest["css/a.css"][1])) as f:
+            self.assertEqual(f.read(),
+                             '@charset "utf-8";\n@import url(b.css);'
+                             'a{background:url(img/a.png)}\n'
+                             'b{background:url("../vendor/lib/../b.png")}'
+                             'c{background:url(/c.png)}')
+        self.assertRaises(ValueError, build_bundles, self.site,
+                          {"css/all.css": ["vendor/lib/b.css", "css/a.css"]},
+                          self.hashes, self.record)
+
+    def test_missing_member(self):
+        self.assertRaises(FileNotFoundError, build_bundles, self.site,
+                          {"js/all.js": ["js/c.js"]}, self.hashes,
+                          self.record)
+
+    def test_bundle_tags(self):
+        root = sitetree.Folder()
+        root.metadata['bundle_manifest'] = self.build()
+        target = root.metadata['bundle_manifest']["js/a.js"][1]
+        page = '<script src="STATIC:js/a.js"></script>\n' \
+               '<script src="../js/b.js" defer></script>\n' \
+               '<script src="STATIC:js/c.js"></script>'
+        self.assertEqual(generator.bundle_tags(root, page),
+                         '<script src="STATIC:%s"></script>\n\n'
+                         '<script src="STATIC:js/c.js"></script>' % target)
+
+
+if __name__ == "__main__":
+    unittest.main()
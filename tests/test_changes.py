@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import utility
+from changes import *
+
+
+class TestChanges(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.site = os.path.join(self.tmp, "site")
+        os.makedirs(os.path.join(self.site, "EN"))
+        self.write("EN/index.html", "<html></html>")
+        self.write("EN/index.html.gz", "compressed")
+        self.write("logo.png", "png")
+        self.write(".htaccess", "Options -Indexes")
+        self.hashes = utility.HashCache(None)
+        self.filename = os.path.join(self.tmp, "changes.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, path, content):
+        with open(os.path.join(self.site, path), "w") as f:
+            f.write(content)
+
+    def test_tree_state(self):
+        state = tree_state(self.site, self.hashes)
+        self.assertEqual(state["dirs"], ["EN"])
+        self.assertEqual(state["files"]["EN/index.html"],
+                         [utility.md5("<html></html>"), 13])
+        self.assertEqual(len(state["files"]), 4)
+        self.assertEqual(state_id(state),
+                         state_id(tree_state(self.site, workers=1)))
+
+    def test_update_changes(self):
+        first = update_changes(self.filename, self.site, self.hashes)
+        self.assertIsNone(first["base"])
+        self.assertEqual(len(first["added"]), 4)
+        self.assertEqual(first["added_dirs"], ["EN"])
+        self.write("EN/index.html", "<html>new</html>")
+        os.remove(os.path.join(self.site, "logo.png"))
+        os.makedirs(os.path.join(self.site, "DE"))
+        self.write("DE/index.html", "<html></html>")
+        second = update_changes(self.filename, self.site, self.hashes)
+        self.assertEqual(second["base"], first["id"])
+        self.assertEqual(second["id"], state_id(second["state"]))
+        self.assertEqual(list(second["added"]), ["DE/index.html"])
+        self.assertEqual(list(second["changed"]), ["EN/index.html"])
+        self.assertEqual(second["removed"], ["logo.png"])
+        self.assertEqual(second["added_dirs"], ["DE"])
+        self.assertEqual(load_changes(self.filename), second)
+        self.assertIsNone(load_changes(os.path.join(self.tmp, "missing")))
+
+    def test_purge_urls(self):
+        update_changes(self.filename, self.site, self.hashes)
+        self.write("EN/index.html", "<html>new</html>")
+        self.write("EN/index.html.gz", "new")
+        self.write(".htaccess", "Options +Indexes")
+        os.remove(os.path.join(self.site, "logo.png"))
+        changes = update_changes(self.filename, self.site, self.hashes)
+        self.assertEqual(purge_urls(changes, "https://example.org"),
+                         ["https://example.org/EN/",
+                          "https://example.org/EN/index.html",
+                          "https://example.org/logo.png"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import generator
+import sitetree
+from criticalcss import *
+
+
+CSS = '@charset "utf-8";nav ul li{display:inline}.a,.b>p{color:red}' \
+      '@media screen{#x{margin:0}.c:hover{color:blue}}' \
+      '@font-face{font-family:"F";src:url(f.woff)}' \
+      '@keyframes k{from{opacity:0}to{opacity:1}}'
+
+
+class TestParsing(unittest.TestCase):
+
+    def test_roundtrip(self):
+        self.assertEqual(render_css(parse_css(CSS)), CSS)
+
+    def test_nesting(self):
+        rules = parse_css(CSS)
+        self.assertEqual(rules[3][0], "@media screen")
+        self.assertEqual(rules[3][1], [("#x", "margin:0"),
+                                       (".c:hover", "color:blue")])
+        self.assertEqual(rules[5][1], "from{opacity:0}to{opacity:1}")
+
+
+class TestSelectors(unittest.TestCase):
+
+    def test_split_selectors(self):
+        self.assertEqual(split_selectors('a, p:not(.x,.y), [title="a,b"]'),
+                         ['a', 'p:not(.x,.y)', '[title="a,b"]'])
+
+    def test_selector_features(self):
+        self.assertEqual(selector_features('nav > UL li.item#main a:hover'),
+                         {"nav", "ul", "li", ".item", "#main", "a"})
+        self.assertEqual(selector_features('input[type="text"]::after'),
+                         {"input", "[type"})
+        self.assertEqual(selector_features(':root'), set())
+        self.assertIsNone(selector_features('.sm\\:hidden'))
+
+    def test_page_features(self):
+        self.assertEqual(page_features('<p class="a b" id="x">'),
+                         {"html", "head", "body", "p", "[class", ".a", ".b",
+                          "[id", "#x"})
+
+    def test_prune_rules(self):
+        features = page_features('<nav><ul><li class="a"><p class="c">')
+        self.assertEqual(render_css(prune_rules(parse_css(CSS), features)),
+                         '@charset "utf-8";nav ul li{display:inline}'
+                         '.a{color:red}@media screen{.c:hover{color:blue}}'
+                         '@font-face{font-family:"F";src:url(f.woff)}'
+                         '@keyframes k{from{opacity:0}to{opacity:1}}')
+
+
+class TestCriticalCSS(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "styles.css")
+        with open(self.path, "w") as f:
+            f.write(CSS)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_subsets_are_shared(self):
+        critical = CriticalCSS(os.path.join(self.tmp, "critical.json"))
+        # features that the stylesheet does not refer to do not matter
+        first = critical.subset(self.path, page_features('<p class="a">'))
+        second = critical.subset(self.path,
+                                 page_features('<p class="a"><i id="y">'))
+        self.assertEqual(first, second)
+        self.assertEqual(len(critical.record), 1)
+        critical.save()
+        critical = CriticalCSS(os.path.join(self.tmp, "critical.json"))
+        self.assertEqual(len(critical.record), 1)
+
+    def test_rebase_css_urls(self):
+        self.assertEqual(rebase_css_urls(
+            'a{background:url("img/a.png")}b{src:url(data:x)}'
+            'c{src:url(/x.png)}', "../css/"),
+            'a{background:url("../css/img/a.png")}b{src:url(data:x)}'
+            'c{src:url(/x.png)}')
+
+
+    def test_writer(self):
+        os.mkdir(os.path.join(self.tmp, "css"))
+        with open(os.path.join(self.tmp, "css", "s.css"), "w") as f:
+            f.write(".a { background: url(a.png) } .b { color: red }")
+        root = sitetree.Folder()
+        root["css"] = sitetree.StaticEntry(os.path.join(self.tmp, "css"))
+        writer = generator.critical_css_writer()
+        page = '<head><link rel="stylesheet" href="STATIC:css/s.css">' \
+               '<link rel="stylesheet" href="STATIC:css/s.css" ' \
+               'media="print"></head><p class="a">'
+        self.assertEqual(
+            writer(root, page),
+            '<head><style>.a{background:url(../css/a.png)}</style>'
+            '<link rel="preload" href="STATIC:css/s.css" as="style" '
+            'onload="this.onload=null;this.rel=\'stylesheet\'">'
+            '<noscript><link rel="stylesheet" href="STATIC:css/s.css">'
+            '</noscript><link rel="stylesheet" href="STATIC:css/s.css" '
+            'media="print"></head><p class="a">')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+
+import unittest
+
+import generator
+import sitetree
+
+from htmlrewriter import *
+
+
+class TestTokenizer(unittest.TestCase):
+
+    def kinds(self, data):
+        return [(t.kind, t.name) for t in tokenize(data)]
+
+    def test_tokens_cover_data(self):
+        data = '<!DOCTYPE html>\n<p class="a>b">Text <b>bold</b></p>' \
+               '<!-- <a href="x"> --> a < b'
+        tokens = list(tokenize(data))
+        self.assertEqual("".join(data[t.start:t.end] for t in tokens), data)
+        for a, b in zip(tokens, tokens[1:]):
+            self.assertEqual(a.end, b.start)
+
+    def test_kinds(self):
+        self.assertEqual(self.kinds('<p>Text</p><!-- <a> -->'),
+                         [(STARTTAG, 'p'), (TEXT, None), (ENDTAG, 'p'),
+                          (COMMENT, None)])
+        self.assertEqual(self.kinds('<?xml version="1.0"?><br/>'),
+                         [(DECL, None), (STARTTAG, 'br')])
+
+    def test_rawtext(self):
+        self.assertEqual(
+            self.kinds('<script>if (a<b) x = "<p>";</script><P>'),
+            [(STARTTAG, 'script'), (RAWTEXT, 'script'), (ENDTAG, 'script'),
+             (STARTTAG, 'p')])
+
+    def test_preformatted(self):
+        self.assertEqual(self.kinds('a<pre>b<i>c</i></pre>d'),
+                         [(TEXT, None), (STARTTAG, 'pre'), (TEXT, 'pre'),
+                          (STARTTAG, 'i'), (TEXT, 'pre'), (ENDTAG, 'i'),
+                          (ENDTAG, 'pre'), (TEXT, None)])
+
+
+class TestAttributes(unittest.TestCase):
+
+    def test_tag_attributes(self):
+        attrs = tag_attributes('<img SRC="a.png" alt=\'A "b"\' width=10 '
+                               'hidden data-x="1">')
+        self.assertEqual(list(attrs.items()),
+                         [('src', 'a.png'), ('alt', 'A "b"'), ('width', '10'),
+                          ('hidden', None), ('data-x', '1')])
+
+    def test_build_tag(self):
+        tag = '<img src="a.png" hidden />'
+        self.assertEqual(build_tag('img', tag_attributes(tag),
+                                   is_selfclosing(tag)), tag)
+
+
+class TestHTMLRewriter(unittest.TestCase):
+
+    def test_unchanged(self):
+        data = "<p>text</p>"
+        rw = HTMLRewriter()
+        rw.register(lambda text, token, page: text, ALL_KINDS)
+        self.assertIs(rw.rewrite(data), data)
+
+    def test_comments_are_skipped(self):
+        rw = HTMLRewriter()
+        rw.register(lambda text, token, page: '<a href="y">', STARTTAG, ['a'])
+        self.assertEqual(rw.rewrite('<a href="x"><!-- <a href="x"> -->'),
+                         '<a href="y"><!-- <a href="x"> -->')
+
+    def test_chaining(self):
+        rw = HTMLRewriter()
+        rw.register(lambda text, token, page: text + "1", TEXT)
+        rw.register(lambda text, token, page: text + "2", TEXT)
+        self.assertEqual(rw.rewrite("<b>x</b>y"), "<b>x12</b>y12")
+
+    def test_named_handlers_keep_order(self):
+        rw = HTMLRewriter()
+        rw.register(lambda text, token, page: text[:-1] + " a>", STARTTAG,
+                    ['p'])
+        rw.register(lambda text, token, page: text.upper(), STARTTAG)
+        self.assertEqual(rw.rewrite("<p><b>"), "<P A><B>")
+
+    def test_elements(self):
+        rw = HTMLRewriter()
+        rw.register(lambda text, token, page: text.upper(), TEXT)
+        rw.register_element(lambda text, token, page: "[%s]" % text, ['h1'])
+        self.assertEqual(rw.rewrite("a<h1>b<i>c</i></h1>d"),
+                         "A[<h1>b<i>c</i></h1>]D")
+
+    def test_combine_writers(self):
+        @streaming_writer
+        def upper(rewriter):
+            rewriter.register(lambda text, token, page: text.upper(), TEXT)
+
+        @streaming_writer
+        def root_name(rewriter):
+            rewriter.register(lambda text, token, page: text + page.root,
+                              TEXT)
+
+        def plain(root, content):
+            return content + "!"
+
+        writers = combine_writers([upper, root_name, plain, upper])
+        self.assertEqual(len(writers), 3)
+        content = "<p>a</p>"
+        for wr in writers:
+            content = wr("r", content)
+        self.assertEqual(content, "<p>AR</p>!")
+
+
+
+class TestURLTemplates(unittest.TestCase):
+
+    def test_conditional_comments(self):
+        root = sitetree.Folder()
+        branch = sitetree.Folder()
+        branch.parent = root
+        root["EN"] = branch
+        page = '<a href="TOPLEVEL:index.html">x</a>' \
+               '<!--[if lt IE 9]><script src="STATIC:js/html5.js">' \
+               '</script><![endif]-->' \
+               '<script>var s = \'<img src="STATIC:a.png">\';</script>'
+        self.assertEqual(generator.fillin_URL_templates(branch, page),
+                         '<a href="../index.html">x</a>'
+                         '<!--[if lt IE 9]><script src="../../js/html5.js">'
+                         '</script><![endif]-->'
+                         '<script>var s = \'<img src="../../a.png">\';'
+                         '</script>')
+
+if __name__ == "__main__":
+    unittest.main()
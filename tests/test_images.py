@@ -0,0 +1,247 @@
+
+import base64
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+import zlib
+
+import generator
+import images
+import sitetree
+import utility
+from images import *
+
+
+PNG = b"\x89PNG\r\n\x1a\n\x00\x00\x00\x0dIHDR" + struct.pack(">II", 40, 30)
+GIF = b"GIF89a" + struct.pack("<HH", 16, 8)
+JPEG = b"\xff\xd8" + b"\xff\xe0" + struct.pack(">H", 4) + b"JF" + \
+       b"\xff\xc0" + struct.pack(">HBHH", 17, 8, 480, 640) + b"\x03"
+WEBP = b"RIFF\x00\x00\x00\x00WEBPVP8X" + b"\x00" * 8 + \
+       (99).to_bytes(3, "little") + (49).to_bytes(3, "little")
+SVG = b'<?xml version="1.0"?>\n<svg xmlns="http://www.w3.org/2000/svg" ' \
+      b'width="100%" viewBox="0 0 24 12">'
+
+
+class TestImageSize(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_formats(self):
+        for name, data, size in [("a.png", PNG, (40, 30)),
+                                 ("a.gif", GIF, (16, 8)),
+                                 ("a.jpg", JPEG, (640, 480)),
+                                 ("a.webp", WEBP, (100, 50)),
+                                 ("a.svg", SVG, (24, 12)),
+                                 ("a.txt", b"text", None)]:
+            self.assertEqual(image_size(self.write(name, data)), size, name)
+
+    def test_svg_size(self):
+        self.assertEqual(svg_size(b'<svg width="10px" height="5">'), (10, 5))
+        self.assertEqual(svg_size(b'<svg width="10em" height="5em">'), None)
+
+    def test_cache(self):
+        filename = os.path.join(self.tmp, "sizes.json")
+        sizes = ImageSizes(filename)
+        self.assertEqual(sizes.size(self.write("a.png", PNG)), (40, 30))
+        sizes.save()
+        # a copy of the same image is found by its hash
+        path = self.write("b.png", PNG)
+        sizes = ImageSizes(filename)
+        self.assertFalse(sizes.changed)
+        self.assertEqual(sizes.size(path), (40, 30))
+        self.assertFalse(sizes.changed)
+
+
+def stored_png(width=32, height=32):
+    """Returns an RGB PNG image whose image data is not compressed."""
+    raw = b"".join(b"\x00" + bytes([x % 256, 0, 255]) * width
+                   for x in range(height))
+    return PNG_SIGNATURE + \
+        png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2,
+                                       0, 0, 0)) + \
+        png_chunk(b"IDAT", zlib.compress(raw, 0)[:100]) + \
+        png_chunk(b"IDAT", zlib.compress(raw, 0)[100:]) + \
+        png_chunk(b"IEND", b"")
+
+
+class TestOptimization(unittest.TestCase):
+
+    def test_optimize_png(self):
+        data = stored_png()
+        optimized = optimize_png(data)
+        self.assertLess(len(optimized), len(data))
+        self.assertEqual(png_size(optimized), (32, 32))
+        chunks = list(png_chunks(optimized))
+        self.assertEqual([kind for kind, _ in chunks],
+                         [b"IHDR", b"IDAT", b"IEND"])
+        self.assertEqual(zlib.decompress(chunks[1][1]),
+                         zlib.decompress(b"".join(
+                             chunk for kind, chunk in png_chunks(data)
+                             if kind == b"IDAT")))
+        self.assertEqual(optimize_png(optimized), optimized)
+
+    def test_optimize_svg(self):
+        path = os.path.join(os.path.dirname(__file__), "..", "_data",
+                            "next.svg")
+        with open(path) as f:
+            svg = f.read()
+        optimized = optimize_svg(svg)
+        self.assertLess(len(optimized), len(svg) * 2 // 3)
+        for name in ("inkscape", "sodipodi", "metadata", "rdf:", "<!--"):
+            self.assertNotIn(name, optimized)
+        root = ET.fromstring(optimized)
+        self.assertEqual(root.get("viewBox"), "0 0 63.999999 63.999999")
+        self.assertIn('xmlns:osb', optimized)     # still in use
+
+    def test_svg_text_keeps_whitespace(self):
+        svg = '<svg>\n  <text>a <tspan>b</tspan></text>\n</svg>'
+        self.assertEqual(optimize_svg(svg), svg)
+
+    def test_image_optimizer(self):
+        tmp = tempfile.mkdtemp()
+        images.OPTIMIZER_CACHE.path = os.path.join(tmp, "cache")
+        try:
+            jobs = []
+            for name, data in (("a.png", stored_png()),
+                               ("b.png", stored_png()),
+                               ("c.svg", b"<svg>\n <g/>\n</svg>")):
+                src = os.path.join(tmp, name)
+                with open(src, "wb") as f:
+                    f.write(data)
+                jobs.append((src, src + ".out"))
+            optimizer = image_optimizer()
+            self.assertEqual(optimizer.batch(jobs),
+                             [dst for src, dst in jobs])
+            with open(jobs[2][1], "rb") as f:
+                self.assertEqual(f.read(), b"<svg><g/></svg>")
+            self.assertEqual(optimizer.statistics['files'], 3)
+            self.assertGreater(optimizer.statistics['bytes_saved'], 0)
+            # identical images are optimised only once
+            self.assertEqual(len(os.listdir(images.OPTIMIZER_CACHE.path)),
+                             2)
+        finally:
+            images.OPTIMIZER_CACHE.path = None
+            utility.shutdown_process_pool()
+            shutil.rmtree(tmp)
+
+
+class TestImgWidthHeight(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp, "img"))
+        with open(os.path.join(self.tmp, "img", "a.png"), "wb") as f:
+            f.write(PNG)
+        self.root = sitetree.Folder()
+        self.root["img"] = sitetree.StaticEntry(os.path.join(self.tmp, "img"))
+        self.root["blog"] = sitetree.Folder()
+        self.root["blog"].parent = self.root
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_static_source(self):
+        path = os.path.join(self.tmp, "img", "a.png")
+        blog = self.root["blog"]
+        self.assertEqual(generator.static_source(blog, "STATIC:img/a.png"),
+                         path)
+        self.assertEqual(generator.static_source(blog, "../../img/a.png"),
+                         path)
+        self.assertEqual(generator.static_source(self.root, "/img/a.png?x"),
+                         path)
+        # static entries are not part of the language branches
+        self.assertIsNone(generator.static_source(self.root, "img/a.png"))
+        self.assertIsNone(generator.static_source(blog, "http://x/a.png"))
+
+    def test_writer(self):
+        writer = generator.img_width_height_writer(lazy_loading=True,
+                                                   eager_images=1)
+        page = '<img src="STATIC:img/a.png"><img src="../img/a.png" />' \
+               '<img src="STATIC:img/a.png" width="10">'
+        self.assertEqual(writer(self.root, page),
+                         '<img src="STATIC:img/a.png" width="40" height="30">'
+                         '<img src="../img/a.png" width="40" height="30" '
+                         'loading="lazy"/>'
+                         '<img src="STATIC:img/a.png" width="10" '
+                         'loading="lazy">')
+
+
+
+class TestSprites(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp, "img"))
+        shutil.copy(os.path.join(os.path.dirname(__file__), "..", "_data",
+                                 "next.svg"), os.path.join(self.tmp, "img"))
+        with open(os.path.join(self.tmp, "img", "dot.png"), "wb") as f:
+            f.write(PNG)
+        self.root = sitetree.Folder()
+        self.root["img"] = sitetree.StaticEntry(os.path.join(self.tmp, "img"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_svg_symbol(self):
+        symbol, namespaces = svg_symbol(
+            '<svg xmlns:xlink="http://www.w3.org/1999/xlink" width="8" '
+            'height="4"><linearGradient id="g"/><path id="p" '
+            'fill="url(#g)"/><use xlink:href="#p"/></svg>', "s")
+        self.assertEqual(symbol, '<symbol id="s" viewBox="0 0 8 4">'
+                         '<linearGradient id="s-g"/><path id="s-p" '
+                         'fill="url(#s-g)"/><use xlink:href="#s-p"/>'
+                         '</symbol>')
+        self.assertEqual(namespaces,
+                         {"xmlns:xlink": "http://www.w3.org/1999/xlink"})
+
+    def test_sprite_sheet(self):
+        path = os.path.join(self.tmp, "img", "next.svg")
+        sheet = SpriteSheet(os.path.join(self.tmp, "sprites.json"))
+        symbol_id = sheet.add(path)
+        self.assertTrue(symbol_id.startswith("next-"))
+        sheet_path = os.path.join(self.tmp, "sprites.svg")
+        self.assertTrue(sheet.write(sheet_path))
+        root = ET.parse(sheet_path).getroot()
+        self.assertEqual(root[0].get("id"), symbol_id)
+        # the symbol is taken from the record in the next build
+        sheet = SpriteSheet(os.path.join(self.tmp, "sprites.json"))
+        self.assertIn(symbol_id + ":", next(iter(sheet.record)))
+        self.assertEqual(sheet.add(path), symbol_id)
+        self.assertFalse(sheet.write(sheet_path))
+        # a sheet without symbols in use is removed
+        sheet = SpriteSheet(os.path.join(self.tmp, "sprites.json"))
+        self.assertTrue(sheet.write(sheet_path))
+        self.assertFalse(os.path.exists(sheet_path))
+        self.assertFalse(sheet.write(sheet_path))
+
+    def test_writer(self):
+        writer = generator.small_images_writer(inline_threshold=100)
+        page = '<img src="STATIC:img/dot.png"><img class="nav" alt="Next" ' \
+               'src="STATIC:img/next.svg">'
+        result = writer(self.root, page)
+        sheet = generator.sprite_sheet(self.root)
+        symbol_id = next(iter(sheet.symbols))
+        self.assertEqual(result,
+                         '<img src="data:image/png;base64,%s">'
+                         '<svg class="nav" width="64" height="64" role="img" '
+                         'aria-label="Next"><use href="STATIC:sprites.svg#%s"/>'
+                         '</svg>' % (base64.b64encode(PNG).decode(), symbol_id))
+        self.assertEqual(writer.statistics['inlined'], 1)
+        self.assertEqual(writer.statistics['sprites'], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
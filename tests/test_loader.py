@@ -4,6 +4,7 @@ import os
 #import sys
 import unittest
 
+import htmlrewriter
 import loader
 
 
@@ -112,6 +113,23 @@ class TestLoader(unittest.TestCase):
         self.assertEqual(result['EN']['content']['English'], "English")
         self.assertEqual(result['EN']['content']['German'], "German")
 
+    def test_postprocessor_order(self):
+        def streaming(data, args, metadata):
+            return data.replace("b", "c")
+        streaming.register = lambda rewriter, args, metadata: \
+            rewriter.register(lambda text, token, page:
+                              text.replace("b", "c"), htmlrewriter.TEXT)
+
+        def plain(data, args, metadata):
+            return data.replace("a", "b")
+
+        metadata = {'POSTPROCESSOR_S': streaming, 'POSTPROCESSOR_P': plain}
+        self.assertEqual(loader.gather_postprocessors(metadata)("<p>a</p>"),
+                         "<p>b</p>")
+        metadata = {'POSTPROCESSOR_P': plain, 'POSTPROCESSOR_S': streaming}
+        self.assertEqual(loader.gather_postprocessors(metadata)("<p>a</p>"),
+                         "<p>c</p>")
+
 
 # if __name__ == "__main__":
 #     sys.path.append(
@@ -0,0 +1,117 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import minify
+import utility
+from minify import *
+
+
+class TestHTMLMinifier(unittest.TestCase):
+
+    def minify(self, page, **kwargs):
+        writer = html_minifier(**kwargs)
+        return writer(None, page), writer.statistics['bytes_saved']
+
+    def test_minify_tag(self):
+        self.assertEqual(minify_tag('<a  href="index.html"\n class="x y">'),
+                         '<a href=index.html class="x y">')
+        self.assertEqual(minify_tag('<img src="a.png" />'),
+                         '<img src=a.png />')
+        self.assertEqual(minify_tag('<br />'), '<br/>')
+        self.assertEqual(minify_tag("<p title='say \"hi\"'>"),
+                         "<p title='say \"hi\"'>")
+        self.assertEqual(minify_tag('<p {{ attrs }}>'), '<p {{ attrs }}>')
+
+    def test_whitespace(self):
+        page = "<div>\n  <p>some    text\n   here</p>\n</div>\n"
+        result, saved = self.minify(page)
+        self.assertEqual(result, "<div><p>some text\nhere</p></div>\n")
+        self.assertEqual(saved, len(page) - len(result))
+
+    def test_preserved_content(self):
+        page = ('<pre>  a\n   b</pre><textarea>  x  </textarea>'
+                '<script>var a  =  "<p>  ";</script>'
+                '<style>p  {  }</style><!--[if IE]>  <p> <![endif]-->'
+                '<!-- comment -->')
+        result, saved = self.minify(page)
+        self.assertEqual(result, page[:-len('<!-- comment -->')])
+
+    def test_options(self):
+        page = '<p  class="a">  <!-- c --></p>'
+        self.assertEqual(self.minify(page, remove_comments=False,
+                                     collapse_spaces=False)[0],
+                         '<p class=a>  <!-- c --></p>')
+
+
+class TestCSSMinifier(unittest.TestCase):
+
+    def test_minify_css(self):
+        css = """/* comment */
+            @media screen and (max-width: 600px) {
+              a:hover ,  div > p { color: red ; content: "a ; b" ; }
+              .x { width: calc(1px + 2px); background: url(a.png); }
+            } /*! license */"""
+        self.assertEqual(minify_css(css),
+                         '@media screen and (max-width:600px){a:hover,div>p'
+                         '{color:red;content:"a ; b"}.x{width:calc(1px + 2px)'
+                         ';background:url(a.png)}}/*! license */')
+
+    def test_selectors_keep_spaces(self):
+        self.assertEqual(minify_css("div :first-child { }"),
+                         "div :first-child{}")
+
+
+class TestJSMinifier(unittest.TestCase):
+
+    def test_comments_and_spaces(self):
+        js = """// comment
+            var a = 1 + +b;   /* comment */
+            if (a) { f( a , b ) }
+
+
+            /*! license */"""
+        self.assertEqual(minify_js(js),
+                         "var a=1 + +b;\nif(a){f(a,b)}\n/*! license */")
+
+    def test_literals(self):
+        js = 'var re = /[/]"\'/g, s = "a // b";\nreturn /x/.test(s)' \
+             '\nx = a / b / c\nt = `${a}  // t`'
+        self.assertEqual(minify_js(js),
+                         'var re=/[/]"\'/g,s="a // b";\nreturn /x/.test(s)'
+                         '\nx=a / b / c\nt=`${a}  // t`')
+
+    def test_number_member_access(self):
+        self.assertEqual(minify_js("x = 1 .toString() ; y = a . b"),
+                         "x=1 .toString();y=a.b")
+
+
+class TestMinifyFiles(unittest.TestCase):
+
+    def test_minify_files_in_parallel(self):
+        tmp = tempfile.mkdtemp()
+        threshold = minify.PARALLEL_THRESHOLD
+        minify.PARALLEL_THRESHOLD = 0
+        try:
+            jobs = []
+            for name in ("a.css", "b.css", "c.min.css"):
+                src = os.path.join(tmp, name)
+                with open(src, "w") as f:
+                    f.write("p {  color: red; }")
+                jobs.append((src, src + ".out"))
+            self.assertEqual(minify_files("css", jobs),
+                             [dst for src, dst in jobs])
+            with open(jobs[1][1]) as f:
+                self.assertEqual(f.read(), "p{color:red}")
+            with open(jobs[2][1]) as f:
+                self.assertEqual(f.read(), "p {  color: red; }")
+        finally:
+            minify.PARALLEL_THRESHOLD = threshold
+            utility.shutdown_process_pool()
+            shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import generator
+import precompress
+import utility
+from precompress import *
+
+
+class TestPrecompress(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.site = os.path.join(self.tmp, "site")
+        os.makedirs(os.path.join(self.site, "css"))
+        with open(os.path.join(self.site, "page.html"), "w") as f:
+            f.write("<p>Lorem ipsum dolor sit amet</p>\n" * 100)
+        with open(os.path.join(self.site, "css", "tiny.css"), "w") as f:
+            f.write("p{}")
+        with open(os.path.join(self.site, "image.png"), "wb") as f:
+            f.write(b"\x89PNG" * 100)
+        self.hashes = utility.HashCache(os.path.join(self.tmp, "hashes.json"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_precompress_site(self):
+        count, saved = precompress_site(self.site, self.tmp, self.hashes)
+        self.assertEqual(count, 2)
+        self.assertGreater(saved, 0)
+        page = os.path.join(self.site, "page.html")
+        with open(page, "rb") as f, gzip.open(page + ".gz", "rb") as g:
+            self.assertEqual(f.read(), g.read())
+        # incompressible or unsupported files do not get a sibling
+        self.assertFalse(os.path.exists(
+            os.path.join(self.site, "css", "tiny.css.gz")))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.site, "image.png.gz")))
+
+        # unchanged files are not compressed again
+        self.assertEqual(precompress_site(self.site, self.tmp,
+                                          self.hashes)[0], 0)
+        with open(page, "a") as f:
+            f.write("<p>changed</p>")
+        self.assertEqual(precompress_site(self.site, self.tmp,
+                                          self.hashes)[0], 1)
+        os.remove(page + ".gz")
+        self.assertEqual(precompress_site(self.site, self.tmp,
+                                          self.hashes)[0], 1)
+
+    def test_missing_brotli_sibling(self):
+        class Brotli:   # stands in for the brotli module
+            compress = staticmethod(lambda data, quality: gzip.compress(data))
+        real_brotli = precompress.brotli
+        precompress.brotli = Brotli
+        try:
+            # a single file is compressed in this process
+            os.remove(os.path.join(self.site, "css", "tiny.css"))
+            page = os.path.join(self.site, "page.html")
+            precompress_site(self.site, self.tmp, self.hashes)
+            os.remove(page + ".br")
+            self.assertEqual(precompress_site(self.site, self.tmp,
+                                              self.hashes)[0], 1)
+            self.assertTrue(os.path.exists(page + ".br"))
+        finally:
+            precompress.brotli = real_brotli
+
+    def test_orphaned_siblings(self):
+        page = os.path.join(self.site, "page.html")
+        precompress_site(self.site, self.tmp, self.hashes)
+        self.assertTrue(os.path.exists(page + ".gz"))
+        os.remove(page)
+        self.assertEqual(precompress_site(self.site, self.tmp,
+                                          self.hashes)[0], 0)
+        self.assertEqual(sorted(os.listdir(self.site)), ["css", "image.png"])
+
+    def test_configured_extensions(self):
+        config = {'precompress': {'extensions': [".css"]}}
+        generator.precompress_site(self.site, self.tmp, self.hashes, config)
+        self.assertEqual(config, {'precompress': {'extensions': [".css"]}})
+        self.assertFalse(os.path.exists(
+            os.path.join(self.site, "page.html.gz")))
+
+
+if __name__ == "__main__":
+    unittest.main()
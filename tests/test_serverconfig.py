@@ -0,0 +1,149 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import generator
+import utility
+from serverconfig import *
+
+
+class TestServerConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.site = os.path.join(self.tmp, "site")
+        os.makedirs(os.path.join(self.site, "EN"))
+        os.makedirs(os.path.join(self.site, "css"))
+        self.write("EN/index.html", "<html></html>")
+        self.write("EN/index.html.gz", "compressed")
+        self.write("css/styles.css", "body{}")
+        self.write("css/styles.0123abcd.css", "body{}")
+        self.write("logo.png", "png")
+        self.hashes = utility.HashCache(os.path.join(self.tmp, "hashes.json"))
+        self.fingerprinted = {"css/styles.0123abcd.css"}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, path, content):
+        with open(os.path.join(self.site, path), "w") as f:
+            f.write(content)
+
+    def read(self, path):
+        with open(os.path.join(self.site, path)) as f:
+            return f.read()
+
+    def test_update_block(self):
+        path = os.path.join(self.site, ".htaccess")
+        self.write(".htaccess", "Options -Indexes\n")
+        self.assertTrue(update_block(path, "caching", "A"))
+        self.assertEqual(self.read(".htaccess"),
+                         "Options -Indexes\n# BEGIN caching\nA\n"
+                         "# END caching\n")
+        self.assertFalse(update_block(path, "caching", "A"))
+        self.assertTrue(update_block(path, "caching", "B"))
+        self.assertEqual(self.read(".htaccess").count("# BEGIN caching"), 1)
+        self.assertIn("\nB\n", self.read(".htaccess"))
+        self.assertTrue(update_block(path, "caching", ""))
+        self.assertEqual(self.read(".htaccess"), "Options -Indexes\n")
+
+    def test_cache_control(self):
+        ttls = (300, 86400, 31536000)
+        self.assertEqual(cache_control("EN/index.html", self.fingerprinted,
+                                       *ttls),
+                         "public, max-age=300, must-revalidate")
+        self.assertEqual(cache_control("css/styles.css", self.fingerprinted,
+                                       *ttls), "public, max-age=86400")
+        self.assertEqual(cache_control("css/styles.0123abcd.css",
+                                       self.fingerprinted, *ttls),
+                         "public, max-age=31536000, immutable")
+
+    def test_write_caching_headers(self):
+        written = write_caching_headers(self.site, self.fingerprinted)
+        self.assertEqual(written, [".htaccess", "_headers"])
+        htaccess = self.read(".htaccess")
+        self.assertIn("FileETag MTime Size", htaccess)
+        self.assertIn(r"^(styles\.0123abcd\.css)(\.gz|\.br)?$", htaccess)
+        headers = self.read("_headers")
+        self.assertNotIn("index.html", headers)
+        self.assertNotIn("ETag", headers)
+        self.assertIn("/*\n  Cache-Control: public, max-age=86400\n"
+                      "  Vary: Accept-Encoding\n", headers)
+        self.assertIn("/*.html\n  ! Cache-Control\n  Cache-Control: public, "
+                      "max-age=300, must-revalidate", headers)
+        # css/styles.css is not fingerprinted, so there is no rule /css/*.css
+        self.assertNotIn("/css/*.css", headers)
+        self.assertIn("/css/styles.0123abcd.css\n  ! Cache-Control\n"
+                      "  Cache-Control: public, max-age=31536000, immutable",
+                      headers)
+        # nothing changed: nothing is written
+        self.assertEqual(write_caching_headers(self.site, self.fingerprinted),
+                         [])
+
+    def test_headers_patterns(self):
+        for i in range(200):
+            self.write("css/bundle%i.0123abcd.css" % i, "body{}")
+        fingerprinted = {"css/bundle%i.0123abcd.css" % i for i in range(200)}
+        headers = headers_caching(self.site, fingerprinted, 300, 86400,
+                                  31536000)
+        self.assertLessEqual(headers.count("\n/") + 1, MAX_HEADERS_RULES)
+        self.assertIn("/css/bundle0.0123abcd.css\n", headers)
+        os.remove(os.path.join(self.site, "css/styles.css"))
+        fingerprinted.add("css/styles.0123abcd.css")
+        headers = headers_caching(self.site, fingerprinted, 300, 86400,
+                                  31536000)
+        self.assertIn("/css/*.css\n  ! Cache-Control\n", headers)
+        self.assertNotIn("bundle0", headers)
+
+    def test_rebased_page(self):
+        self.assertEqual(rebased_page('<html><head lang="en"><title>',
+                                      "EN/"),
+                         '<html><head lang="en"><base href="EN/"><title>')
+        page = '<head><base href="/x/">'
+        self.assertEqual(rebased_page(page, "EN/"), page)
+
+    def test_write_language_negotiation(self):
+        os.makedirs(os.path.join(self.site, "DE"))
+        self.write("DE/index.html", "<html><head></head></html>")
+        written = write_language_negotiation(self.site, ["DE", "EN"], "EN")
+        self.assertEqual(written, ["index.de.html", "index.en.html",
+                                   "index.var", ".htaccess", "index.html"])
+        self.assertEqual(self.read("index.de.html"),
+                         '<html><head><base href="DE/"></head></html>')
+        self.assertIn("URI: index.en.html\nContent-Type: text/html;qs=1.0"
+                      "\nContent-Language: en", self.read("index.var"))
+        htaccess = self.read(".htaccess")
+        self.assertIn("LanguagePriority en de", htaccess)
+        self.assertIn("RewriteCond %{HTTP:Accept-Language} ^de\\b [NC]\n"
+                      "    RewriteRule ^(index\\.html)?$ index.de.html [L]",
+                      htaccess)
+        self.assertIn('"de":"DE/index.html"', self.read("index.html"))
+        self.assertIn("URL=EN/index.html", self.read("index.html"))
+        self.assertEqual(write_language_negotiation(
+            self.site, ["DE", "EN"], "EN"), [])
+
+
+class TestNegotiateRootLanguage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmp, "EN"))
+        with open(os.path.join(self.tmp, "EN", "index.html"), "w") as f:
+            f.write("<html></html>")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_negotiate_root_language(self):
+        config = {'language_negotiation': True, 'languages': ['EN']}
+        self.assertTrue(generator.negotiate_root_language(self.tmp, config))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, "index.html")))
+        # the root index must be copied, if no fallback has been written
+        config['root_index'] = 'root.html'
+        self.assertFalse(generator.negotiate_root_language(self.tmp, config))
+        config = {'language_negotiation': True, 'languages': ['ANY']}
+        self.assertFalse(generator.negotiate_root_language(self.tmp, config))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,6 +6,8 @@ import time
 import unittest
 
 from sitetree import *
+from utility import LINK_STRATEGIES, SyncManifest, copy_on_condition, \
+    is_newer, link_or_copy
 
 
 class TestCopyFuncs(unittest.TestCase):
@@ -61,6 +63,87 @@ class TestCopyFuncs(unittest.TestCase):
         self.assertNotEqual(content, ALT_TEXT)
         os.remove('testdata/test_sitetree/fileC.txt')
 
+    def test_link_or_copy(self):
+        src = 'testdata/test_sitetree/src/fileC.txt'
+        for mode in LINK_STRATEGIES:
+            dst = 'testdata/test_sitetree/link_' + mode
+            method = link_or_copy(src, dst, mode)
+            self.assertIn(method, LINK_STRATEGIES[mode])
+            with open(dst, "r") as f:
+                self.assertEqual(f.read(), "fileC")
+            if method == "symlink":
+                self.assertTrue(os.path.islink(dst))
+            elif method == "hardlink":
+                self.assertTrue(os.path.samefile(src, dst))
+
+    def test_preprocessor_does_not_write_through_links(self):
+        src = 'testdata/test_sitetree/src/fileC.txt'
+        dst = 'testdata/test_sitetree/fileC.txt'
+
+        def preprocessor(src, dst):
+            with open(dst, "w") as f:
+                f.write("preprocessed")
+            return dst
+
+        for mode in ("hardlink", "symlink"):
+            link_or_copy(src, dst, mode)
+            copy_on_condition(src, dst, lambda src, dst: True,
+                              {".txt": preprocessor})
+            with open(src, "r") as f:
+                self.assertEqual(f.read(), "fileC")
+            with open(dst, "r") as f:
+                self.assertEqual(f.read(), "preprocessed")
+            os.remove(dst)
+
+    def test_sync_tree(self):
+        src = os.path.abspath('testdata/test_sitetree/src')
+        dst = 'testdata/test_sitetree/dst'
+        manifest = SyncManifest()
+        self.assertEqual(sync_tree(src, dst, manifest=manifest), 3)
+        with open(os.path.join(dst, 'nested/fileA.txt'), "r") as f:
+            self.assertEqual(f.read(), "fileA")
+
+        def next_run():
+            nonlocal manifest
+            manifest.old_files, manifest.old_dirs = \
+                manifest.files, manifest.dirs
+            manifest.files, manifest.dirs = {}, {}
+            return manifest
+
+        self.assertEqual(sync_tree(src, dst, manifest=next_run()), 0)
+
+        # changes within the same second are noticed
+        fileC = os.path.join(src, 'fileC.txt')
+        st = os.stat(fileC)
+        with open(fileC, "w") as f:
+            f.write("fileX")
+        os.utime(fileC, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        self.assertEqual(sync_tree(src, dst, manifest=next_run()), 1)
+        with open(os.path.join(dst, 'fileC.txt'), "r") as f:
+            self.assertEqual(f.read(), "fileX")
+
+        # merely touched files are not copied again
+        os.utime(fileC, ns=(st.st_atime_ns, st.st_mtime_ns + 2))
+        self.assertEqual(sync_tree(src, dst, manifest=next_run()), 0)
+
+        # files in a removed destination directory are copied again
+        shutil.rmtree(os.path.join(dst, 'nested'))
+        self.assertEqual(sync_tree(src, dst, manifest=next_run(),
+                                   trust_dir_mtimes=True), 2)
+        self.assertEqual(sync_tree(src, dst, manifest=next_run(),
+                                   trust_dir_mtimes=True), 0)
+        self.assertEqual(set(manifest.files), set(manifest.old_files))
+
+        # deleted destination files are placed again
+        os.remove(os.path.join(dst, 'fileC.txt'))
+        self.assertEqual(sync_tree(src, dst, manifest=next_run()), 1)
+        with open(os.path.join(dst, 'fileC.txt'), "r") as f:
+            self.assertEqual(f.read(), "fileX")
+        os.remove(os.path.join(dst, 'nested/fileA.txt'))
+        self.assertEqual(sync_tree(src, dst, manifest=next_run(),
+                                   trust_dir_mtimes=True), 1)
+        self.assertTrue(os.path.exists(os.path.join(dst, 'nested/fileA.txt')))
+
 
 # if __name__ == "__main__":
 #     sys.path.append(
@@ -0,0 +1,174 @@
+
+import concurrent.futures
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import tools
+import utility
+
+FAKE_TOOL = """#!%s
+import os, sys
+if sys.argv[1] == "--version":
+    with open(os.environ["FAKETOOL_LOG"] + ".version", "a") as log:
+        log.write("version\\n")
+    print("faketool 1.0")
+    sys.exit(0)
+with open(os.environ["FAKETOOL_LOG"], "a") as log:
+    log.write(" ".join(sys.argv[1:]) + "\\n")
+if sys.argv[1] == "--batch":
+    for name in sys.argv[4:]:
+        base, ext = os.path.splitext(name)
+        with open(name) as f, open(base + sys.argv[3] + ext, "w") as g:
+            g.write(f.read().upper())
+else:
+    with open(sys.argv[-1]) as f:
+        sys.stdout.write(f.read().upper())
+""" % sys.executable
+
+
+class TestTools(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.tool = os.path.join(self.tmp, "faketool")
+        with open(self.tool, "w") as f:
+            f.write(FAKE_TOOL)
+        os.chmod(self.tool, os.stat(self.tool).st_mode | stat.S_IEXEC)
+        self.log = os.path.join(self.tmp, "log")
+        os.environ["FAKETOOL_LOG"] = self.log
+        self.srcs = []
+        for i in range(3):
+            src = os.path.join(self.tmp, "src%i.css" % i)
+            with open(src, "w") as f:
+                f.write("p%i {}" % i)
+            self.srcs.append(src)
+        tools.TOOL_CACHE.path = os.path.join(self.tmp, "cache")
+        tools.TOOL_REGISTRY.reset()
+
+    def tearDown(self):
+        tools.TOOL_CACHE.path = None
+        tools.TOOL_REGISTRY.reset()
+        shutil.rmtree(self.tmp)
+
+    def invocations(self, log=""):
+        if not os.path.exists(self.log + log):
+            return 0
+        with open(self.log + log) as f:
+            return len(f.readlines())
+
+    def test_registry(self):
+        record_file = os.path.join(self.tmp, "tools.json")
+        old_path = os.environ["PATH"]
+        os.environ["PATH"] = self.tmp
+        try:
+            registry = tools.ToolRegistry(record_file)
+            self.assertEqual(registry.find("faketool"),
+                             (self.tool, "faketool 1.0"))
+            self.assertIsNone(registry.find("no_such_tool_here"))
+            # the version is taken from the record file
+            registry = tools.ToolRegistry(record_file)
+            registry.find("faketool")
+            self.assertEqual(self.invocations(".version"), 1)
+            # ... unless the binary has changed
+            st = os.stat(self.tool)
+            os.utime(self.tool, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            registry = tools.ToolRegistry(record_file)
+            registry.find("faketool")
+            self.assertEqual(self.invocations(".version"), 2)
+            # ... or the PATH has changed
+            os.environ["PATH"] = self.tmp + os.pathsep + old_path
+            registry = tools.ToolRegistry(record_file)
+            registry.find("faketool")
+            self.assertEqual(self.invocations(".version"), 3)
+        finally:
+            os.environ["PATH"] = old_path
+
+    def test_lazy_preprocessors(self):
+        preprocessors = tools.Preprocessors()
+        preprocessors.register(".css", "cleancss", "no_such_tool_here")
+        self.assertNotIn(".css", preprocessors)
+        preprocessors.register(".css", "fallback")
+        preprocessors.register(".js", "js", lambda: False)
+        self.assertEqual(preprocessors[".css"], "fallback")
+        # iterating does not search for the tools of the other extensions
+        checked = []
+        preprocessors.register(".svg", "svgo",
+                               lambda: checked.append(".svg") or True)
+        self.assertEqual(list(preprocessors), [".css", ".js", ".svg"])
+        self.assertEqual(len(preprocessors), 3)
+        self.assertEqual(checked, [])
+        self.assertNotIn(".js", preprocessors)
+        self.assertEqual(list(preprocessors), [".css", ".svg"])
+        self.assertEqual(preprocessors.used(), {"fallback"})
+
+    def test_concurrent_lookup(self):
+        preprocessors = tools.Preprocessors()
+        checks = []
+
+        def slow_requirement():
+            checks.append(threading.current_thread())
+            time.sleep(0.05)
+            return True
+
+        preprocessors.register(".css", "minifier", slow_requirement)
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(lambda ext: preprocessors[ext],
+                                    [".css"] * 8))
+        self.assertEqual(results, ["minifier"] * 8)
+        self.assertEqual(len(checks), 1)
+
+    def test_tool_version(self):
+        self.assertEqual(tools.tool_version(self.tool), "faketool 1.0")
+        self.assertEqual(tools.tool_version("no_such_tool_here"), "")
+
+    def test_run_tool_cached(self):
+        self.assertEqual(tools.run_tool(self.tool, [], self.srcs[0]),
+                         b"P0 {}")
+        self.assertEqual(tools.run_tool(self.tool, [], self.srcs[0]),
+                         b"P0 {}")
+        self.assertEqual(self.invocations(), 1)
+        # different options mean different cache entries
+        tools.run_tool(self.tool, ["-x"], self.srcs[0])
+        self.assertEqual(self.invocations(), 2)
+
+    def test_batch_preprocessor(self):
+        # prefill the cache for the first file
+        tools.run_tool_batch(self.tool, ["--batch", "--batch-suffix", ".min"],
+                             self.srcs[:1], ".min")
+        os.remove(self.log)
+
+        def compressor(src, dst):
+            raise AssertionError("should be called in batches")
+
+        def batch(jobs):
+            outputs = tools.run_tool_batch(
+                self.tool, ["--batch", "--batch-suffix", ".min"],
+                [src for src, dst in jobs], ".min")
+            for (src, dst), output in zip(jobs, outputs):
+                with open(dst, "wb") as f:
+                    f.write(output)
+            return [dst for src, dst in jobs]
+
+        compressor.batch = batch
+        src_dir = os.path.join(self.tmp, "src")
+        os.mkdir(src_dir)
+        for src in self.srcs:
+            shutil.move(src, src_dir)
+        dst_dir = os.path.join(self.tmp, "dst")
+        self.assertEqual(utility.sync_tree(src_dir, dst_dir,
+                                           {".css": compressor}), 3)
+        self.assertEqual(self.invocations(), 1)
+        with open(os.path.join(dst_dir, "src2.css")) as f:
+            self.assertEqual(f.read(), "P2 {}")
+        with open(os.path.join(dst_dir, "src0.css")) as f:
+            self.assertEqual(f.read(), "P0 {}")
+
+
+if __name__ == "__main__":
+    unittest.main()
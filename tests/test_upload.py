@@ -22,11 +22,15 @@ import copy
 import os
 import shutil
 import tempfile
+import threading
 import time
 import unittest
 import uuid
 
+import changes
+import sftpserver
 import upload
+import utility
 
 
 #############################################################################
@@ -49,10 +53,13 @@ def create_tree(path, tree):
 
 
 def read_tree(path):
-    """reads a directory tree into a nested dictionary structure."""
+    """reads a directory tree into a nested dictionary structure. The
+    manifest of uploaded trees is ignored."""
     tree = {}
     directory = os.listdir(path)
     for entry in directory:
+        if entry == upload.REMOTE_MANIFEST:
+            continue
         fullpath = os.path.join(path, entry)
         if os.path.isdir(fullpath):
             tree[entry] = read_tree(fullpath)
@@ -74,6 +81,8 @@ def retrieve_tree(wrapper, path):
         tree = {}
         directory = wrapper.listdir(path)
         for entry in directory:
+            if entry == upload.REMOTE_MANIFEST:
+                continue
             descendant = os.path.join(path, entry)
             if wrapper.isdir(descendant):
                 tree[entry] = retrieve_tree(wrapper, descendant)
@@ -372,6 +381,8 @@ class TestSFTPWrapper(TestFTPWrapper):
 
 class TestUpload(unittest.TestCase):
 
+    pool = ()
+
     # setup and tear down
 
     @classmethod
@@ -434,18 +445,21 @@ class TestUpload(unittest.TestCase):
 
     def test_simple_upload(self):
         local = upload.FileSystemWrapper(self.srcA_path)
-        upload.upload_tree(local, "", self.remote, self.dst_path)
+        upload.upload_tree(local, "", self.remote, self.dst_path,
+                           pool=self.pool)
         self.assertEqual(self.treeA, retrieve_tree(self.remote, self.dst_path))
         self.cleanup_dest()
 
     def test_differential_upload(self):
         # setup
         local = upload.FileSystemWrapper(self.srcA_path)
-        upload.upload_tree(local, "", self.remote, self.dst_path)
+        upload.upload_tree(local, "", self.remote, self.dst_path,
+                           pool=self.pool)
 
         # test
         local = upload.FileSystemWrapper(self.srcB_path)
-        upload.upload_tree(local, "", self.remote, self.dst_path)
+        upload.upload_tree(local, "", self.remote, self.dst_path,
+                           pool=self.pool)
         self.assertEqual(self.treeB, retrieve_tree(self.remote, self.dst_path))
 
         self.cleanup_dest()
@@ -453,7 +467,8 @@ class TestUpload(unittest.TestCase):
     def test_NIL_Proxy(self):
         # setup
         local = upload.FileSystemWrapper(self.srcA_path)
-        upload.upload_tree(local, "", self.remote, self.dst_path)
+        upload.upload_tree(local, "", self.remote, self.dst_path,
+                           pool=self.pool)
 
         # test
         local = upload.FileSystemWrapper(self.srcC_path)
@@ -466,14 +481,16 @@ class TestUpload(unittest.TestCase):
     def test_upload_new_files_only(self):
         # setup
         local = upload.FileSystemWrapper(self.srcA_path)
-        upload.upload_tree(local, "", self.remote, self.dst_path)
+        upload.upload_tree(local, "", self.remote, self.dst_path,
+                           pool=self.pool)
 
         expected_log = get_emptylog()
         del expected_log['skipped']
 
         # test
         # print(local.mtime("file_1"), self.remote.mtime("dst/file_1"))
-        log = upload.upload_tree(local, "", self.remote, self.dst_path)
+        log = upload.upload_tree(local, "", self.remote, self.dst_path,
+                                 pool=self.pool)
         del log['skipped']
         self.assertEqual(log, expected_log)
 
@@ -483,13 +500,32 @@ class TestUpload(unittest.TestCase):
             self.remote.mtime(os.path.join(self.dst_path, 'file_2')), \
             "mtime resolution of your system is too small for this test." \
             "choose another value for sleep() in test_upload_new_files_only!"
+        # files are compared by content: touching does not lead to an upload
+        for verify in (False, True):
+            log = upload.upload_tree(local, "", self.remote, self.dst_path,
+                                     pool=self.pool, verify=verify)
+            del log['skipped']
+            self.assertEqual(log, expected_log)
+
+        hashes = utility.HashCache(None)
+        with open(local.fullpath('file_2'), 'w') as f:
+            f.write("file 2 changed")
         expected_log['uploaded'] = {os.path.join(self.dst_path, 'file_2')}
-        log = upload.upload_tree(local, "", self.remote, self.dst_path)
+        log = upload.upload_tree(local, "", self.remote, self.dst_path,
+                                 pool=self.pool, hashes=hashes)
+        del log['skipped']
+        self.assertEqual(log, expected_log)
+        self.assertIn(local.fullpath('file_2'), hashes)
+        with open(local.fullpath('file_2'), 'w') as f:
+            f.write(self.treeA['file_2'])
+        log = upload.upload_tree(local, "", self.remote, self.dst_path,
+                                 pool=self.pool, verify=True)
         del log['skipped']
         self.assertEqual(log, expected_log)
 
         local = upload.FileSystemWrapper(self.srcB_path)
-        log = upload.upload_tree(local, "", self.remote, self.dst_path)
+        log = upload.upload_tree(local, "", self.remote, self.dst_path,
+                                 pool=self.pool)
         self.assertEqual(log['uploaded'],
                          {os.path.join(self.dst_path, 'subdir/file_4')})
         self.assertEqual(log['skipped'],
@@ -500,34 +536,757 @@ class TestUpload(unittest.TestCase):
     def test_differential_upload_wo_delete(self):
         # setup
         local = upload.FileSystemWrapper(self.srcA_path)
-        upload.upload_tree(local, "", self.remote, self.dst_path)
+        upload.upload_tree(local, "", self.remote, self.dst_path,
+                           pool=self.pool)
 
         tree = copy.deepcopy(self.treeA)
         tree.update(self.treeC)
         assert tree == self.treeB
 
         local = upload.FileSystemWrapper(self.srcC_path)
-        upload.upload_tree(local, "", self.remote, self.dst_path, delete=False)
+        upload.upload_tree(local, "", self.remote, self.dst_path,
+                           delete=False, pool=self.pool)
         self.assertEqual(self.treeB, retrieve_tree(self.remote, self.dst_path))
         self.cleanup_dest()
 
     def test_differential_upload_w_delete(self):
         # setup
         local = upload.FileSystemWrapper(self.srcA_path)
-        upload.upload_tree(local, "", self.remote, self.dst_path)
+        upload.upload_tree(local, "", self.remote, self.dst_path,
+                           pool=self.pool)
 
         tree = copy.deepcopy(self.treeA)
         tree.update(self.treeC)
         assert tree == self.treeB
 
         local = upload.FileSystemWrapper(self.srcC_path)
-        upload.upload_tree(local, "", self.remote, self.dst_path, delete=True)
+        upload.upload_tree(local, "", self.remote, self.dst_path,
+                           delete=True, pool=self.pool)
         tree = copy.deepcopy(self.treeB)
         del tree['file_2']
         self.assertEqual(tree, retrieve_tree(self.remote, self.dst_path))
         self.cleanup_dest()
 
 
+def write_config(path, section, **keys):
+    """writes a configuration file with a single section for
+    upload.connect()."""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[%s]\n" % section)
+        for key, value in keys.items():
+            f.write("%s = %s\n" % (key, value))
+
+
+class TestPooledUpload(TestUpload):
+
+    @classmethod
+    def setUpWrapper(cls):
+        cfg = os.path.join(cls.tmp, "sites.ini")
+        write_config(cfg, "pool", server=cls.tmp, protocol="filesystem",
+                     connections=3)
+        connections = upload.connect_pool(cfg, "pool")
+        assert len(connections) == 3
+        cls.pool = connections[1:]
+        return connections[0]
+
+    @classmethod
+    def tearDownWrapper(cls):
+        for connection in [cls.remote] + list(cls.pool):
+            connection.close()
+
+    def test_plan_upload(self):
+        local = upload.FileSystemWrapper(self.srcA_path)
+        upload.upload_tree(local, "", self.remote, self.dst_path,
+                           pool=self.pool)
+        local = upload.FileSystemWrapper(self.srcC_path)
+        plan = upload.plan_upload(local, "", self.remote, self.dst_path,
+                                  delete=True)
+        self.assertEqual(plan.mkdirs, [])
+        self.assertEqual(plan.uploads,
+                         [(local.fullpath("subdir/file_4"),
+                           os.path.join(self.dst_path, "subdir/file_4"))])
+        self.assertEqual(plan.deletions,
+                         [("deleted", os.path.join(self.dst_path, "file_2"))])
+        # planning does not change anything
+        self.assertEqual(self.treeA, retrieve_tree(self.remote, self.dst_path))
+        self.cleanup_dest()
+
+    def test_directories_before_files(self):
+        tree = {"a": {"b": {"c": {"file": "deep"}}}, "file": "flat"}
+        src_path = os.path.join(self.tmp, "srcDeep")
+        create_tree(src_path, tree)
+        local = upload.FileSystemWrapper(src_path)
+        log = upload.upload_tree(local, "", self.remote, self.dst_path,
+                                 pool=self.pool)
+        self.assertEqual(tree, retrieve_tree(self.remote, self.dst_path))
+        self.assertEqual(log['created'],
+                         {os.path.join(self.dst_path, path)
+                          for path in ["a", "a/b", "a/b/c"]})
+        self.cleanup_dest()
+
+    def test_manifest(self):
+        local = upload.FileSystemWrapper(self.srcA_path)
+        upload.upload_tree(local, "", self.remote, self.dst_path,
+                           pool=self.pool)
+        self.assertTrue(self.remote.isfile(
+            os.path.join(self.dst_path, upload.REMOTE_MANIFEST)))
+        # with a manifest, no remote directory is listed
+        listings = []
+        listdir_attr = self.remote.listdir_attr
+        self.remote.listdir_attr = \
+            lambda path: listings.append(path) or listdir_attr(path)
+        try:
+            local = upload.FileSystemWrapper(self.srcB_path)
+            log = upload.upload_tree(local, "", self.remote, self.dst_path,
+                                     pool=self.pool)
+        finally:
+            del self.remote.listdir_attr
+        self.assertEqual(listings, [])
+        self.assertEqual(log['uploaded'],
+                         {os.path.join(self.dst_path, 'subdir/file_4')})
+        # changes behind the back of the manifest are only found by verify
+        self.remote.remove(os.path.join(self.dst_path, 'file_1'))
+        log = upload.upload_tree(local, "", self.remote, self.dst_path,
+                                 pool=self.pool)
+        self.assertEqual(log['uploaded'], set())
+        log = upload.upload_tree(local, "", self.remote, self.dst_path,
+                                 pool=self.pool, verify=True)
+        self.assertEqual(log['uploaded'],
+                         {os.path.join(self.dst_path, 'file_1')})
+        self.assertEqual(self.treeB, retrieve_tree(self.remote, self.dst_path))
+        # an up to date tree without a manifest gets one
+        manifest = os.path.join(self.dst_path, upload.REMOTE_MANIFEST)
+        self.remote.remove(manifest)
+        log = upload.upload_tree(local, "", self.remote, self.dst_path,
+                                 pool=self.pool)
+        self.assertEqual(log['uploaded'], set())
+        self.assertTrue(self.remote.isfile(manifest))
+        self.cleanup_dest()
+
+    def test_change_manifest(self):
+        stateA = changes.tree_state(self.srcA_path)
+        stateB = changes.tree_state(self.srcB_path)
+        stateC = changes.tree_state(self.srcC_path)
+        local = upload.FileSystemWrapper(self.srcA_path)
+        upload.upload_tree(local, "", self.remote, self.dst_path,
+                           pool=self.pool,
+                           change_manifest=changes.compare_states(None,
+                                                                  stateA))
+        messages = []
+        scan_tree = upload.scan_tree
+        upload.scan_tree = None     # the local tree must not be scanned
+        try:
+            local = upload.FileSystemWrapper(self.srcB_path)
+            log = upload.upload_tree(
+                local, "", self.remote, self.dst_path, True, messages.append,
+                self.pool,
+                change_manifest=changes.compare_states(stateA, stateB))
+            self.assertIn("planning from the change manifest", messages)
+            self.assertEqual(log['uploaded'],
+                             {os.path.join(self.dst_path, 'subdir/file_4')})
+            # the server is not in the base state of the change manifest
+            messages = []
+            local = upload.FileSystemWrapper(self.srcC_path)
+            log = upload.upload_tree(
+                local, "", self.remote, self.dst_path, True, messages.append,
+                self.pool,
+                change_manifest=changes.compare_states(stateA, stateC))
+            self.assertNotIn("planning from the change manifest", messages)
+            self.assertEqual(log['uploaded'], set())
+            self.assertEqual(log['deleted'],
+                             {os.path.join(self.dst_path, 'file_2')})
+        finally:
+            upload.scan_tree = scan_tree
+        self.assertEqual(self.treeC, retrieve_tree(self.remote, self.dst_path))
+        self.cleanup_dest()
+
+
+class TestManifestPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.local = upload.FileSystemWrapper("/src")
+        self.manifest = {"files": {"a": ["1", 1], "b": ["2", 1],
+                                   "d/c": ["3", 1], "e/f/g": ["4", 1]},
+                         "dirs": ["d", "e", "e/f"]}
+
+    def plan(self, state, delete=True):
+        return upload.plan_from_manifest(self.local, "", state, self.manifest,
+                                         "dst", delete)
+
+    def test_plan_from_manifest(self):
+        state = {"files": {"a": ["1", 1], "b": ["5", 1], "d": ["6", 1],
+                           "x/y": ["7", 1]},
+                 "dirs": ["x"]}
+        plan = self.plan(state)
+        self.assertEqual(plan.removals, [("removed", "dst/d")])
+        self.assertEqual(plan.mkdirs, ["dst/x"])
+        self.assertEqual(plan.uploads, [("/src/b", "dst/b"),
+                                        ("/src/d", "dst/d"),
+                                        ("/src/x/y", "dst/x/y")])
+        self.assertEqual(plan.skipped, ["dst/a"])
+        # only the topmost stale directory is removed
+        self.assertEqual(plan.deletions, [("removed", "dst/e")])
+        self.assertRaises(IOError, self.plan, state, False)
+
+    def test_updated_manifest(self):
+        state = {"files": {"a": ["1", 1]}, "dirs": []}
+        plan = self.plan(state, delete=False)
+        self.assertEqual(plan.kept, [("deleted", "dst/b"),
+                                     ("removed", "dst/d"),
+                                     ("removed", "dst/e")])
+        self.assertEqual(upload.updated_manifest(plan, state, self.manifest,
+                                                 "dst"), self.manifest)
+        plan = self.plan(state, delete=True)
+        self.assertEqual(upload.updated_manifest(plan, state, self.manifest,
+                                                 "dst"), state)
+
+
+    def test_plan_from_changes(self):
+        state = {"files": {"a": ["1", 1], "b": ["5", 1], "d": ["6", 1],
+                           "x/y": ["7", 1]},
+                 "dirs": ["x"]}
+        change_manifest = changes.compare_states(self.manifest, state)
+        for delete in (True, False):
+            if not delete:
+                self.assertRaises(IOError, upload.plan_from_changes,
+                                  self.local, "", change_manifest, "dst",
+                                  delete)
+                del state["files"]["d"]
+                change_manifest = changes.compare_states(self.manifest,
+                                                         state)
+            plan = upload.plan_from_changes(self.local, "", change_manifest,
+                                            "dst", delete)
+            expected = self.plan(state, delete)
+            for attribute in ("removals", "mkdirs", "uploads", "deletions",
+                              "skipped", "kept"):
+                self.assertEqual(getattr(plan, attribute),
+                                 getattr(expected, attribute), attribute)
+
+
+class TestRunParallel(unittest.TestCase):
+
+    def test_failure(self):
+        executed = []
+
+        def operation(i):
+            def run(connection):
+                if i == 0:
+                    raise OSError("failed")
+                time.sleep(0.02)
+                executed.append(i)
+            return run
+
+        operations = [operation(i) for i in range(20)]
+        completed = []
+        with self.assertRaises(OSError):
+            for op in upload.run_parallel(["a", "b"], operations):
+                completed.append(operations.index(op))
+        self.assertEqual(sorted(completed), sorted(executed))
+        self.assertLess(len(executed), 19)
+
+
+class TestScanTree(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        create_tree(self.tmp, {"sub": {"file_%i" % i: "content %i" % i
+                                       for i in range(100)}})
+        self.local = upload.FileSystemWrapper(self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_scan_tree(self):
+        hashes = utility.HashCache(os.path.join(self.tmp, "hashes.json"))
+        state = upload.scan_tree(self.local, "", hashes)
+        self.assertEqual(state["dirs"], ["sub"])
+        self.assertEqual(state["files"]["sub/file_7"],
+                         [utility.md5("content 7"), len("content 7")])
+        # unchanged files are not hashed again
+        path = self.local.fullpath("sub/file_7")
+        hashes[path][2] = "cached"
+        state = upload.scan_tree(self.local, "", hashes, workers=1)
+        self.assertEqual(state["files"]["sub/file_7"][0], "cached")
+
+
+class TestSFTPStubUpload(TestPooledUpload):
+
+    @classmethod
+    def setUpWrapper(cls):
+        root = os.path.join(cls.tmp, "sftp_root")
+        os.mkdir(root)
+        cls.server = sftpserver.SFTPTestServer(root).start()
+        cfg = os.path.join(cls.tmp, "sites.ini")
+        write_config(cfg, "stub", server="127.0.0.1", port=cls.server.port,
+                     protocol="sftp", user="test", password="test",
+                     connections=2)
+        connections = upload.connect_pool(cfg, "stub")
+        cls.pool = connections[1:]
+        return connections[0]
+
+    @classmethod
+    def tearDownWrapper(cls):
+        super().tearDownWrapper()
+        cls.server.stop()
+
+    def test_round_trips(self):
+        local = upload.FileSystemWrapper(self.srcA_path)
+        upload.upload_tree(local, "", self.remote, self.dst_path,
+                           pool=self.pool)
+        local = upload.FileSystemWrapper(self.srcB_path)
+        log = upload.upload_tree(local, "", self.remote, self.dst_path,
+                                 pool=self.pool)
+        # manifest download, removal and upload plus one request per file
+        self.assertEqual(log.round_trips, 3 + 1)
+        log = upload.upload_tree(local, "", self.remote, self.dst_path,
+                                 pool=self.pool)
+        self.assertEqual(log.round_trips, 1)
+        self.cleanup_dest()
+
+    def test_listing_cache(self):
+        self.remote.clear_cache()
+        trips = self.remote.round_trips
+        self.remote.listdir_attr(self.dst_path)
+        self.assertFalse(self.remote.exists(
+            os.path.join(self.dst_path, "new_dir")))
+        self.remote.mkdir(os.path.join(self.dst_path, "new_dir"))
+        self.assertTrue(self.remote.isdir(
+            os.path.join(self.dst_path, "new_dir")))
+        self.assertEqual(self.remote.listdir(
+            os.path.join(self.dst_path, "new_dir")), [])
+        self.remote.rmdir(os.path.join(self.dst_path, "new_dir"))
+        self.assertFalse(self.remote.exists(
+            os.path.join(self.dst_path, "new_dir")))
+        # one listing, one mkdir and one rmdir
+        self.assertEqual(self.remote.round_trips - trips, 3)
+
+    def test_pipelined_upload(self):
+        src = os.path.join(self.tmp, "pipelined")
+        os.mkdir(src)
+        transfers = []
+        for i in range(5):
+            with open(os.path.join(src, "file%i" % i), "wb") as f:
+                f.write(bytes([i]) * (upload.SFTP_CHUNK_SIZE * i + 1))
+            transfers.append((os.path.join(src, "file%i" % i),
+                              os.path.join(self.dst_path, "a/b/file%i" % i)))
+        dirs = [os.path.join(self.dst_path, "a"),
+                os.path.join(self.dst_path, "a/b")]
+        trips = self.remote.round_trips
+        self.remote.mkdirs(dirs)
+        self.remote.upload_files(transfers)
+        # one round trip for the directories, two for the files
+        self.assertEqual(self.remote.round_trips - trips, 3)
+        for local_path, remote_path in transfers:
+            self.assertTrue(self.remote.isfile(remote_path))
+            with open(local_path, "rb") as f:
+                self.assertEqual(self.remote.size(remote_path),
+                                 len(f.read()))
+        self.remote.clear_cache()
+        self.assertEqual(sorted(self.remote.listdir(dirs[1])),
+                         ["file%i" % i for i in range(5)])
+        # a failed request does not keep the other files from being written
+        transfers.insert(0, (transfers[0][0], os.path.join(
+            self.dst_path, "missing/file0")))
+        self.assertRaises(IOError, self.remote.upload_files, transfers)
+        self.assertRaises(IOError, self.remote.mkdirs, dirs)
+        # a local error does not leave the other files open on the server
+        transfers[0] = (os.path.join(src, "missing"), transfers[1][1])
+        self.assertRaises(FileNotFoundError, self.remote.upload_files,
+                          transfers[1:3] + transfers[:1] + transfers[3:])
+        self.assertEqual(sftpserver.StubSFTPHandle.open_handles, set())
+        self.remote.listdir(dirs[1])
+        self.remote.clear_cache()
+        self.remote.rmtree(dirs[0])
+        shutil.rmtree(src)
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptedRecord(upload.ResumeRecord):
+    """A resume record that simulates a dropped connection after `chunks`
+    chunks have been sent."""
+
+    def __init__(self, filename, chunks):
+        super().__init__(filename)
+        self.chunks = chunks
+
+    def chunk_sent(self, remote_path, data):
+        if self.chunks == 0:
+            raise Interrupted(remote_path)
+        self.chunks -= 1
+        super().chunk_sent(remote_path, data)
+
+
+class TestResumableUpload(unittest.TestCase):
+
+    def setUpRemote(self):
+        os.mkdir(os.path.join(self.tmp, "remote"))
+        return upload.FileSystemWrapper(os.path.join(self.tmp, "remote"))
+
+    def tearDownRemote(self):
+        pass
+
+    def setUp(self):
+        self.chunk, self.threshold = upload.RESUME_CHUNK, \
+            upload.RESUMABLE_SIZE
+        upload.RESUME_CHUNK, upload.RESUMABLE_SIZE = 1024, 2048
+        self.tmp = tempfile.mkdtemp()
+        self.remote = self.setUpRemote()
+        self.src = os.path.join(self.tmp, "src")
+        os.mkdir(self.src)
+        self.record_file = os.path.join(self.tmp, "resume.json")
+        self.content = b"".join(bytes([i]) * 1024 for i in range(5)) + b"end"
+        self.write("large.pdf", self.content)
+        self.offsets = []
+        write_part = self.remote.write_part
+        self.remote.write_part = lambda source, path, offset, sent: \
+            self.offsets.append(offset) or \
+            write_part(source, path, offset, sent)
+
+    def tearDown(self):
+        del self.remote.write_part
+        self.tearDownRemote()
+        upload.RESUME_CHUNK, upload.RESUMABLE_SIZE = self.chunk, \
+            self.threshold
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, content):
+        with open(os.path.join(self.src, name), "wb") as f:
+            f.write(content)
+
+    def read(self, name):
+        with tempfile.NamedTemporaryFile() as f:
+            self.remote.download(name, f.name)
+            return f.read()
+
+    def interrupt(self, chunks):
+        record = InterruptedRecord(self.record_file, chunks)
+        self.assertRaises(Interrupted, self.remote.upload_resumable,
+                          os.path.join(self.src, "large.pdf"), "large.pdf",
+                          record)
+        self.assertFalse(self.remote.exists("large.pdf"))
+        self.assertTrue(self.remote.exists("large.pdf" + upload.PART_SUFFIX))
+
+    def resume(self):
+        record = upload.ResumeRecord(self.record_file)
+        self.remote.upload_resumable(os.path.join(self.src, "large.pdf"),
+                                     "large.pdf", record)
+        self.assertEqual(upload.ResumeRecord(self.record_file), {})
+        self.assertFalse(self.remote.exists("large.pdf" + upload.PART_SUFFIX))
+
+    def test_resume(self):
+        self.interrupt(2)
+        self.resume()
+        self.assertEqual(self.offsets, [0, 2048])
+        self.assertEqual(self.read("large.pdf"), self.content)
+
+    def test_changed_chunk(self):
+        self.interrupt(3)
+        self.content = self.content[:1024] + b"x" * 1024 + self.content[2048:]
+        self.write("large.pdf", self.content)
+        self.resume()
+        self.assertEqual(self.offsets, [0, 1024])
+        self.assertEqual(self.read("large.pdf"), self.content)
+
+    def test_upload_tree(self):
+        self.write("small.html", b"small")
+        local = upload.FileSystemWrapper(self.src)
+        self.assertRaises(Interrupted, upload.upload_tree, local, "",
+                          self.remote, "", record=InterruptedRecord(
+                              self.record_file, 1))
+        # the partial file is kept, even if remote files are deleted
+        log = upload.upload_tree(local, "", self.remote, "", delete=True,
+                                 record=upload.ResumeRecord(self.record_file))
+        self.assertEqual(log['uploaded'], {"large.pdf", "small.html"})
+        self.assertEqual(log['deleted'], set())
+        self.assertEqual(self.offsets, [0, 1024])
+        self.assertEqual(self.read("large.pdf"), self.content)
+        self.assertFalse(self.remote.exists("large.pdf" + upload.PART_SUFFIX))
+
+
+class TestSFTPResumableUpload(TestResumableUpload):
+
+    def setUpRemote(self):
+        os.mkdir(os.path.join(self.tmp, "remote"))
+        self.server = sftpserver.SFTPTestServer(
+            os.path.join(self.tmp, "remote")).start()
+        return upload.SFTPWrapper("", upload.SFTP_connect(
+            "127.0.0.1", self.server.port, "test", "test"))
+
+    def tearDownRemote(self):
+        self.remote.close()
+        self.server.stop()
+
+
+class TestDeltaTransfer(unittest.TestCase):
+
+    def setUpRemote(self):
+        os.mkdir(os.path.join(self.tmp, "remote"))
+        return upload.FileSystemWrapper(os.path.join(self.tmp, "remote"))
+
+    def tearDownRemote(self):
+        pass
+
+    def setUp(self):
+        self.block = upload.DELTA_BLOCK
+        upload.DELTA_BLOCK = 1024
+        self.tmp = tempfile.mkdtemp()
+        self.remote = self.setUpRemote()
+        self.local_path = os.path.join(self.tmp, "data.bin")
+        self.signatures = upload.SignatureCache(
+            os.path.join(self.tmp, "signatures.json"), min_size=4096)
+        self.content = b"".join(b"%05i" % i for i in range(2048))
+        self.literals = []
+        self.delta = upload.delta
+
+        def delta(*args, **kwargs):
+            for offset, data, index in self.delta(*args, **kwargs):
+                if index is None:
+                    self.literals.append(offset)
+                yield offset, data, index
+        upload.delta = delta
+
+    def tearDown(self):
+        upload.delta = self.delta
+        upload.DELTA_BLOCK = self.block
+        self.tearDownRemote()
+        shutil.rmtree(self.tmp)
+
+    def upload(self, content):
+        with open(self.local_path, "wb") as f:
+            f.write(content)
+        self.remote.upload_delta(self.local_path, "data.bin",
+                                 self.signatures, upload.ResumeRecord())
+        with tempfile.NamedTemporaryFile() as f:
+            self.remote.download("data.bin", f.name)
+            self.assertEqual(f.read(), content)
+
+    def test_delta(self):
+        old = os.path.join(self.tmp, "old")
+        with open(old, "wb") as f:
+            f.write(self.content)
+        signature = upload.file_signature(old, 1000)
+        new = self.content[:3000] + b"inserted" + self.content[3000:9000]
+        with open(self.local_path, "wb") as f:
+            f.write(new)
+        pieces = list(self.delta(self.local_path, signature, 1000))
+        self.assertEqual(b"".join(data for offset, data, index in pieces),
+                         new)
+        self.assertEqual([(offset, index) for offset, data, index in pieces],
+                         [(0, 0), (1000, 1), (2000, 2), (3000, None),
+                          (3008, 3), (4008, 4), (5008, 5), (6008, 6),
+                          (7008, 7), (8008, 8)])
+        # without the rolling checksum, blocks after the insertion are lost
+        pieces = list(self.delta(self.local_path, signature, 1000,
+                                 rolling=False))
+        self.assertEqual([index for offset, data, index in pieces],
+                         [0, 1, 2] + [None] * 7)
+        # the rolling checksum gives up after `limit` bytes
+        pieces = list(self.delta(self.local_path, signature, 1000, limit=4))
+        self.assertEqual(b"".join(data for offset, data, index in pieces),
+                         new)
+        self.assertEqual([index for offset, data, index in pieces
+                          if index is not None], [0, 1, 2])
+
+    def test_upload_delta(self):
+        self.upload(self.content)
+        self.assertIn("data.bin", self.signatures)
+        self.assertEqual(self.literals, [])
+        # a changed block and appended data
+        content = self.content[:2048] + b"x" * 1024 + self.content[3072:] + \
+            b"appended"
+        self.upload(content)
+        self.assertEqual(self.literals, [2048, 10240])
+        # a changed remote file is uploaded as a whole
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b"changed on the server")
+            f.flush()
+            self.remote.upload_file(f.name, "data.bin")
+        self.literals = []
+        self.upload(content)
+        self.assertEqual(self.literals, [])
+        self.signatures.save()
+        self.assertEqual(list(upload.SignatureCache(
+            self.signatures.filename)), ["data.bin"])
+
+    def test_upload_tree(self):
+        src = os.path.join(self.tmp, "src")
+        create_tree(src, {"small.html": "small", "sub": {}})
+        with open(os.path.join(src, "sub/data.bin"), "wb") as f:
+            f.write(self.content)
+        local = upload.FileSystemWrapper(src)
+        upload.upload_tree(local, "", self.remote, "",
+                           signatures=self.signatures)
+        with open(os.path.join(src, "sub/data.bin"), "ab") as f:
+            f.write(b"appended")
+        log = upload.upload_tree(local, "", self.remote, "",
+                                 signatures=self.signatures)
+        self.assertEqual(log['uploaded'], {"sub/data.bin"})
+        self.assertEqual(self.literals, [10240])
+
+
+class TestSFTPDeltaTransfer(TestDeltaTransfer):
+
+    def setUpRemote(self):
+        os.mkdir(os.path.join(self.tmp, "remote"))
+        self.server = sftpserver.SFTPTestServer(
+            os.path.join(self.tmp, "remote")).start()
+        return upload.SFTPWrapper("", upload.SFTP_connect(
+            "127.0.0.1", self.server.port, "test", "test"))
+
+    def tearDownRemote(self):
+        self.remote.close()
+        self.server.stop()
+
+    def test_truncate(self):
+        self.upload(self.content)
+        self.upload(self.content[:5000])
+        self.assertEqual(self.literals, [4096])
+
+    def test_replace(self):
+        # the copy of the old version is patched and replaces the old file
+        path = os.path.join(self.tmp, "remote", "data.bin")
+        self.upload(self.content)
+        inode = os.stat(path).st_ino
+        self.upload(self.content[:2048] + b"x" * 1024 + self.content[3072:])
+        self.assertEqual(self.literals, [2048])
+        self.assertNotEqual(os.stat(path).st_ino, inode)
+        self.assertEqual(os.listdir(os.path.dirname(path)), ["data.bin"])
+
+    def test_without_copy_data(self):
+        self.tearDownRemote()
+        self.server = sftpserver.SFTPTestServer(
+            os.path.join(self.tmp, "remote"), copy_data=False).start()
+        self.remote = upload.SFTPWrapper("", upload.SFTP_connect(
+            "127.0.0.1", self.server.port, "test", "test"))
+        self.upload(self.content)
+        self.upload(self.content[:2048] + b"x" * 1024 + self.content[3072:])
+        self.assertEqual(self.literals, [])
+        self.assertFalse(self.remote.copy_data)
+        self.assertEqual(os.listdir(os.path.join(self.tmp, "remote")),
+                         ["data.bin"])
+
+
+class FailingWrapper(upload.FileSystemWrapper):
+    """A file system wrapper whose directories cannot be listed."""
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.failed = threading.Event()
+
+    def listdir_attr(self, path):
+        self.failed.set()
+        raise OSError("disk on fire")
+
+
+class WaitingWrapper(upload.FileSystemWrapper):
+    """A file system wrapper that creates directories only after `failing`
+    has failed."""
+
+    def __init__(self, root, failing):
+        super().__init__(root)
+        self.failing = failing
+
+    def mkdirs(self, paths):
+        self.failing.failed.wait(5)
+        time.sleep(0.2)
+        super().mkdirs(paths)
+
+
+class TestMultiTarget(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.site = os.path.join(self.tmp, "site")
+        os.makedirs(os.path.join(self.site, "EN"))
+        for path in ("index.html", "EN/index.html", "EN/about.html"):
+            with open(os.path.join(self.site, path), "w") as f:
+                f.write("<html>%s</html>" % path)
+        self.local = upload.FileSystemWrapper(self.site)
+        self.scans = 0
+        self.plans = 0
+        self.scan_tree = upload.scan_tree
+        self.plan_from_manifest = upload.plan_from_manifest
+
+        def scan_tree(*args):
+            self.scans += 1
+            return self.scan_tree(*args)
+
+        def plan_from_manifest(*args):
+            self.plans += 1
+            return self.plan_from_manifest(*args)
+        upload.scan_tree = scan_tree
+        upload.plan_from_manifest = plan_from_manifest
+
+    def tearDown(self):
+        upload.scan_tree = self.scan_tree
+        upload.plan_from_manifest = self.plan_from_manifest
+        shutil.rmtree(self.tmp)
+
+    def target(self, name, wrapper=upload.FileSystemWrapper, *args):
+        os.mkdir(os.path.join(self.tmp, name))
+        return upload.Target(name, wrapper(os.path.join(self.tmp, name),
+                                           *args))
+
+    def assertDeployed(self, name):
+        for path in ("index.html", "EN/index.html", "EN/about.html"):
+            self.assertTrue(os.path.exists(os.path.join(self.tmp, name, path)))
+
+    def test_upload_targets(self):
+        targets = [self.target("a"), self.target("b")]
+        messages = []
+        reports = upload.upload_targets(self.local, "", targets,
+                                        logger=messages.append)
+        self.assertEqual(self.scans, 1)
+        for name in ("a", "b"):
+            self.assertDeployed(name)
+            self.assertIsNone(reports[name].error)
+            self.assertEqual(len(reports[name]["uploaded"]), 3)
+            self.assertIn("[%s] uploaded EN/about.html" % name, messages)
+        with open(os.path.join(self.site, "index.html"), "w") as f:
+            f.write("<html>changed</html>")
+        reports = upload.upload_targets(self.local, "", targets,
+                                        logger=messages.append)
+        self.assertEqual(self.plans, 1)
+        for name in ("a", "b"):
+            self.assertEqual(reports[name]["uploaded"], {"index.html"})
+
+    def test_continue(self):
+        targets = [self.target("a"), self.target("broken", FailingWrapper)]
+        reports = upload.upload_targets(self.local, "", targets)
+        self.assertDeployed("a")
+        self.assertIsNone(reports["a"].error)
+        self.assertIsInstance(reports["broken"].error, OSError)
+
+    def test_abort(self):
+        failing = self.target("broken", FailingWrapper)
+        targets = [self.target("a", WaitingWrapper, failing.remote), failing]
+        reports = upload.upload_targets(self.local, "", targets,
+                                        on_failure="abort")
+        self.assertIsInstance(reports["broken"].error, OSError)
+        self.assertIsInstance(reports["a"].error, upload.DeployCancelled)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, "a",
+                                                     "index.html")))
+        self.assertRaises(ValueError, upload.upload_targets, self.local, "",
+                          targets, on_failure="ignore")
+
+    def test_connect_targets(self):
+        config = os.path.join(self.tmp, "sites.ini")
+        with open(config, "w") as f:
+            for name in ("a", "b"):
+                f.write("[%s]\nserver = %s\nprotocol = filesystem\n"
+                        "connections = 2\n" % (name, self.tmp))
+                f.write("root = %s\n" % name)
+        targets = upload.connect_targets(config, ["a", "b"])
+        self.assertEqual([target.name for target in targets], ["a", "b"])
+        self.assertEqual(len(targets[1].pool), 1)
+        self.assertEqual(targets[1].remote.root, os.path.join(self.tmp, "b"))
+        for target in targets:
+            target.close()
+
+
 @unittest.skip("")
 class test_FTP_upload(TestUpload):
 
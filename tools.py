@@ -0,0 +1,312 @@
+"""tools.py -- lazy detection of external preprocessing tools (cleancss,
+    closure, lessc, ...) and running them with a persistent cache of their
+    outputs
+
+Copyright 2015  by Eckhart Arnold
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import collections.abc
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+import utility
+
+
+##############################################################################
+#
+# tool detection
+#
+##############################################################################
+
+
+def file_signatures(paths):
+    """Returns a list of [size, mtime_ns] for each of the `paths` (None for
+    paths that do not exist)."""
+    signatures = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            signatures.append([st.st_size, st.st_mtime_ns])
+        except OSError:
+            signatures.append(None)
+    return signatures
+
+
+class ToolRegistry:
+    """Class ToolRegistry detects external tools on demand and remembers
+    their location and version. If `path` is not None, the results are
+    also stored in the json file `path`, so that subsequent builds do not
+    need to start the tools (e.g. a JVM for closure) just in order to find
+    out about their version.
+
+    A stored result is discarded, if the PATH environment variable has
+    changed, if the binary of a tool has been modified or, for tools that
+    have not been found, if any of the directories on the PATH has changed.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.records = None
+        self.found = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.records is None:
+            self.records = utility.load_json(self.path, {}) \
+                if self.path is not None else {}
+        return self.records
+
+    def is_valid(self, record, search_path):
+        if record.get("PATH") != search_path:
+            return False
+        if record["path"]:
+            watched = [record["path"]]
+        else:
+            watched = search_path.split(os.pathsep)
+        return record["signature"] == file_signatures(watched)
+
+    def detect(self, tool, search_path):
+        path = shutil.which(tool, path=search_path)
+        version = ""
+        if path:
+            watched = [path]
+            try:
+                output = subprocess.check_output(
+                    [path, "--version"], stdin=subprocess.DEVNULL,
+                    stderr=subprocess.STDOUT)
+                version = output.decode("utf-8", errors="replace").strip()
+            except (OSError, subprocess.CalledProcessError):
+                pass
+        else:
+            watched = search_path.split(os.pathsep)
+        return {"PATH": search_path, "path": path, "version": version,
+                "signature": file_signatures(watched)}
+
+    def find(self, tool):
+        """Returns a tuple (path, version) for `tool` or None, if the tool
+        cannot be found on the PATH."""
+        with self.lock:
+            if tool not in self.found:
+                records = self.load()
+                search_path = os.environ.get("PATH", os.defpath)
+                record = records.get(tool)
+                if record is None or not self.is_valid(record, search_path):
+                    record = self.detect(tool, search_path)
+                    records[tool] = record
+                    if self.path is not None:
+                        utility.save_json(self.path, records)
+                self.found[tool] = (record["path"], record["version"]) \
+                    if record["path"] else None
+            return self.found[tool]
+
+    def reset(self, path=None):
+        """Forgets all results detected in this process and switches to the
+        record file `path`."""
+        with self.lock:
+            self.path = path
+            self.records = None
+            self.found = {}
+
+
+# The registry used by find_tool() and tool_version(). Its record file is
+# set to the cache directory of the build by generator.create_site()
+TOOL_REGISTRY = ToolRegistry()
+
+
+def find_tool(tool):
+    """Returns the full path of `tool` or None, if it is not installed."""
+    result = TOOL_REGISTRY.find(tool)
+    return result[0] if result else None
+
+
+def tool_version(tool):
+    """Returns the version string of `tool` (as reported by
+    `tool --version`) or an empty string if it cannot be determined."""
+    result = TOOL_REGISTRY.find(tool)
+    return result[1] if result else ""
+
+
+class Preprocessors(collections.abc.Mapping):
+    """A mapping of file extensions to preprocessors (see
+    utility.sync_tree()), where several candidates can be registered for
+    each extension. The first candidate whose requirement is met is chosen
+    when an extension is looked up for the first time, so that tools are
+    only searched for if files that need them are actually processed.
+    Iterating over the mapping does not search for tools either: it yields
+    every extension with candidates that has not yet been found to lack a
+    usable one, so that looking up an extension may still fail.
+    """
+
+    def __init__(self):
+        self.candidates = collections.OrderedDict()
+        self.chosen = {}
+        self.lock = threading.Lock()
+
+    def register(self, ext, preprocessor, requires=None):
+        """Registers `preprocessor` as a candidate for the extension `ext`.
+        `requires` is either the name of an external tool, a function that
+        returns True if the preprocessor can be used or None if the
+        preprocessor can always be used."""
+        with self.lock:
+            self.candidates.setdefault(ext, []).append((preprocessor,
+                                                        requires))
+            self.chosen.pop(ext, None)
+
+    def unregister(self, ext):
+        """Removes all candidates for the extension `ext`."""
+        with self.lock:
+            self.candidates.pop(ext, None)
+            self.chosen.pop(ext, None)
+
+    def used(self):
+        """Returns the set of preprocessors that have been chosen for the
+        extensions looked up so far."""
+        with self.lock:
+            return {preprocessor for preprocessor in self.chosen.values()
+                    if preprocessor is not None}
+
+    def copy(self):
+        """Returns a copy with the same candidates, which can be altered
+        without affecting this mapping."""
+        preprocessors = Preprocessors()
+        for ext, candidates in self.candidates.items():
+            preprocessors.candidates[ext] = list(candidates)
+        return preprocessors
+
+    def __getitem__(self, ext):
+        # sync_tree() looks up extensions from several threads, so the
+        # search is done under the lock and its result is stored only once
+        # it is complete
+        with self.lock:
+            if ext not in self.chosen:
+                chosen = None
+                for preprocessor, requires in self.candidates.get(ext, []):
+                    if requires is None or (find_tool(requires)
+                                            if isinstance(requires, str)
+                                            else requires()):
+                        chosen = preprocessor
+                        break
+                self.chosen[ext] = chosen
+            preprocessor = self.chosen[ext]
+        if preprocessor is None:
+            raise KeyError(ext)
+        return preprocessor
+
+    def __iter__(self):
+        with self.lock:
+            return iter([ext for ext in self.candidates
+                         if self.chosen.get(ext, ext) is not None])
+
+    def __len__(self):
+        return sum(1 for ext in self)
+
+
+##############################################################################
+#
+# output cache
+#
+##############################################################################
+
+
+class ToolCache:
+    """Class ToolCache stores the outputs of external tools in the directory
+    `path`. Outputs are keyed by the hash of the source, the tool, the tool's
+    version and the command line options, so that a source is only run
+    through a tool again if any of these have changed. If `path` is None,
+    nothing is cached.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def key(self, tool, options, src):
+        return utility.md5(tool, tool_version(tool), "\x00".join(options),
+                           utility.md5_file(src))
+
+    def get(self, key):
+        if self.path is None:
+            return None
+        try:
+            with open(os.path.join(self.path, key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+            tmp_name = os.path.join(self.path, key + ".tmp")
+            with open(tmp_name, "wb") as f:
+                f.write(data)
+            os.replace(tmp_name, os.path.join(self.path, key))
+
+
+# The cache used by run_tool() and run_tool_batch(). It is pointed to the
+# cache directory of the build by generator.create_site()
+TOOL_CACHE = ToolCache()
+
+
+##############################################################################
+#
+# running tools
+#
+##############################################################################
+
+
+def run_tool(tool, options, src):
+    """Returns the output (bytes) of running `tool` with the list of command
+    line `options` on the file `src`. The output is taken from the cache, if
+    the same source has already been processed with the same version of the
+    tool and the same options.
+    """
+    key = TOOL_CACHE.key(tool, options, src)
+    output = TOOL_CACHE.get(key)
+    if output is None:
+        output = subprocess.check_output([tool] + options + [src])
+        TOOL_CACHE.put(key, output)
+    return output
+
+
+def run_tool_batch(tool, options, srcs, suffix):
+    """Returns the outputs (list of bytes) of processing all files `srcs`
+    with a single invocation of a `tool` that writes the result for each
+    input 'name.ext' to 'name' + suffix + '.ext' (like `cleancss --batch`).
+    Cached outputs are taken from the cache and only the remaining files are
+    passed to the tool. The tool is run on copies of the sources in a
+    temporary directory, so that the source directories are not polluted.
+    """
+    keys = [TOOL_CACHE.key(tool, options, src) for src in srcs]
+    outputs = [TOOL_CACHE.get(key) for key in keys]
+    todo = [i for i, output in enumerate(outputs) if output is None]
+    if not todo:
+        return outputs
+    with tempfile.TemporaryDirectory() as tmp:
+        names = []
+        for i in todo:
+            ext = os.path.splitext(srcs[i])[1]
+            name = "%i%s" % (i, ext)
+            shutil.copyfile(srcs[i], os.path.join(tmp, name))
+            names.append(name)
+        subprocess.check_call([tool] + options + names, cwd=tmp)
+        for i, name in zip(todo, names):
+            base, ext = os.path.splitext(name)
+            with open(os.path.join(tmp, base + suffix + ext), "rb") as f:
+                outputs[i] = f.read()
+            TOOL_CACHE.put(keys[i], outputs[i])
+    return outputs
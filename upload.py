@@ -31,15 +31,32 @@ password = enterprise
 """
 
 
+import argparse
+import concurrent.futures
 import configparser
 import datetime
 import ftplib
 import getpass
+import hashlib
+import itertools
+import mmap
 import os
+import posixpath
+import queue
 import shutil
 import stat
+import sys
+import tempfile
+import threading
+import time
 
 import paramiko
+from paramiko.sftp import CMD_CLOSE, CMD_EXTENDED, CMD_HANDLE, \
+    CMD_MKDIR, CMD_OPEN, CMD_WRITE, SFTP_FLAG_CREATE, SFTP_FLAG_TRUNC, \
+    SFTP_FLAG_WRITE, int64
+
+import changes
+import utility
 
 
 ##############################################################################
@@ -63,6 +80,237 @@ def timestamp(datetime_str, tzinfo=None):
     return dt.timestamp()
 
 
+##############################################################################
+#
+# resumable uploads
+#
+##############################################################################
+
+# files larger than this are uploaded in chunks, so that an interrupted
+# upload can be resumed (see `AbstractConnectionWrapper.upload_resumable()`)
+RESUMABLE_SIZE = 4 * 2**20
+
+# the size of the chunks of a resumable upload
+RESUME_CHUNK = 2**20
+
+# the suffix of the temporary name under which a large file is uploaded
+PART_SUFFIX = ".part"
+
+
+class ResumeRecord(dict):
+    """Class ResumeRecord is the persistent record of the large files that
+    are being uploaded in chunks. It maps remote paths to lists [chunk size,
+    list of the md5-hashes of the chunks that have been sent]. An entry is
+    removed as soon as the upload of the file has been completed. If
+    `filename` is None, the record is only kept in memory.
+
+    The record is shared by all connections of an upload, its methods are
+    thread safe.
+    """
+
+    def __init__(self, filename=None):
+        super().__init__(utility.load_json(filename, {}) if filename else {})
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def resume_offset(self, remote_path, local_path, part_size):
+        """Returns the offset from which the upload of the file `local_path`
+        to `remote_path` can be resumed, given the size `part_size` of the
+        partial copy that is already stored on the server. The offset covers
+        the chunks that have been recorded and that are (still) equal to the
+        chunks of the local file, as far as they are contained in the
+        partial copy. The recorded chunks after the offset are dropped."""
+        with self.lock:
+            entry = self.get(remote_path)
+        chunks = 0
+        if entry and entry[0] == RESUME_CHUNK and \
+                part_size <= os.path.getsize(local_path):
+            with open(local_path, "rb") as f:
+                for digest in entry[1][:part_size // RESUME_CHUNK]:
+                    data = f.read(RESUME_CHUNK)
+                    if hashlib.md5(data).hexdigest() != digest:
+                        break
+                    chunks += 1
+        with self.lock:
+            self[remote_path] = [RESUME_CHUNK,
+                                 entry[1][:chunks] if chunks else []]
+        return chunks * RESUME_CHUNK
+
+    def chunk_sent(self, remote_path, data):
+        """Records that the next chunk `data` of the file uploaded to
+        `remote_path` has been sent."""
+        with self.lock:
+            self[remote_path][1].append(hashlib.md5(data).hexdigest())
+        self.save()
+
+    def finish(self, remote_path):
+        """Removes the entry of `remote_path` after the upload has been
+        completed."""
+        with self.lock:
+            self.pop(remote_path, None)
+        self.save()
+
+    def save(self):
+        if self.filename:
+            with self.lock:
+                utility.save_json(self.filename, dict(self))
+
+
+##############################################################################
+#
+# delta transfer
+#
+##############################################################################
+
+# files larger than this are transferred as a delta to the version of the
+# last upload, if a signature of that version has been kept
+DELTA_SIZE = 2**20
+
+# the size of the blocks that are compared by a delta transfer
+DELTA_BLOCK = 16384
+
+# the number of bytes of a file that the rolling checksum may step over
+# before the search for moved blocks is given up, because rolling in Python
+# is slow (about a second per MiB) on heavily changed files
+DELTA_ROLLING = 2**20
+
+
+def weak_checksum(block):
+    """Returns rsync's rolling checksum of `block` as a tuple (a, b), where
+    `a` is the sum of the bytes and `b` the sum of the bytes weighted by
+    their distance from the end of the block, both modulo 2**16."""
+    return sum(block) & 0xffff, sum(itertools.accumulate(block)) & 0xffff
+
+
+def file_signature(path, block_size=DELTA_BLOCK):
+    """Returns the signature of the file `path`, i.e. the list of the weak
+    (see `weak_checksum()`) and the strong (md5) checksums [weak, strong]
+    of its blocks of `block_size` bytes."""
+    signature = []
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            a, b = weak_checksum(block)
+            signature.append([a | b << 16, hashlib.md5(block).hexdigest()])
+    return signature
+
+
+def delta(path, signature, block_size=DELTA_BLOCK, rolling=True,
+          limit=None):
+    """Compares the file `path` with the `signature` of an older version of
+    the file (see `file_signature()`) and yields tuples (offset, data,
+    index) that cover the file in order: `index` is the number of the block
+    of the old version that is equal to the `data` at `offset` or None, if
+    the data has not been found in the old version. Unmatched data is
+    yielded in pieces of at most `block_size` bytes.
+
+    If `rolling` is True, blocks of the old version are searched at every
+    offset with rsync's rolling checksum, so that inserted or removed data
+    does not keep the following blocks from being found. Otherwise, only
+    the blocks at multiples of `block_size` are compared, which is much
+    faster and sufficient if the old version is patched in place. After
+    the rolling checksum has stepped over `limit` bytes (`DELTA_ROLLING`
+    by default) without finding a block, the rest of the file is compared
+    block by block only.
+    """
+    if limit is None:
+        limit = DELTA_ROLLING
+    table = {}
+    for index, (weak, strong) in enumerate(signature):
+        table.setdefault(weak, []).append((index, strong))
+
+    def find(data, start, end, weak):
+        for index, digest in table.get(weak, ()):
+            if digest == hashlib.md5(data[start:end]).hexdigest():
+                return index
+        return None
+
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            n, L = len(data), block_size
+            pos = start = 0     # start of the unmatched data
+            a = b = None
+            while pos + L <= n:
+                if a is None:
+                    a, b = weak_checksum(data[pos:pos + L])
+                match = find(data, pos, pos + L, a | b << 16)
+                if match is not None or not rolling or limit <= 0:
+                    if start < pos:
+                        yield start, data[start:pos], None
+                    yield pos, data[pos:pos + L], match
+                    pos += L
+                    start = pos
+                    a = None
+                    continue
+                if pos - start == L:
+                    yield start, data[start:pos], None
+                    start = pos
+                if pos + L < n:
+                    a = (a - data[pos] + data[pos + L]) & 0xffff
+                    b = (b - L * data[pos] + a) & 0xffff
+                pos += 1
+                limit -= 1
+            # the last block of the old version may be shorter
+            tail = None
+            if pos < n:
+                a, b = weak_checksum(data[pos:n])
+                tail = find(data, pos, n, a | b << 16)
+            end = n if tail is None else pos
+            while start < end:
+                yield start, data[start:min(start + L, end)], None
+                start = min(start + L, end)
+            if tail is not None:
+                yield pos, data[pos:n], tail
+        finally:
+            data.close()
+
+
+class SignatureCache(dict):
+    """Class SignatureCache is the persistent record of the signatures (see
+    `file_signature()`) of the large files that have been uploaded. It maps
+    remote paths to lists [size, mtime, block size, signature], where size
+    and modification time are those of the remote file after the upload,
+    so that a remote file that has been changed since is recognized. Only
+    files larger than `min_size` are recorded. If `filename` is None, the
+    signatures are only kept in memory.
+
+    The cache is shared by all connections of an upload, its methods are
+    thread safe.
+    """
+
+    def __init__(self, filename=None, min_size=DELTA_SIZE):
+        super().__init__(utility.load_json(filename, {}) if filename else {})
+        self.filename = filename
+        self.min_size = min_size
+        self.lock = threading.Lock()
+
+    def signature(self, remote_path, size, mtime):
+        """Returns the signature of the remote file `remote_path`, if it has
+        not been changed since it was recorded, i.e. if it still has the
+        given `size` and modification time `mtime`, or None. The entry is
+        dropped, because the remote file is about to be changed."""
+        with self.lock:
+            entry = self.pop(remote_path, None)
+        if entry is None or entry[:3] != [size, mtime, DELTA_BLOCK]:
+            return None
+        return entry[3]
+
+    def store(self, remote_path, size, mtime, local_path):
+        """Records the signature of `local_path` for the remote file
+        `remote_path` with the given `size` and modification time
+        `mtime`."""
+        signature = file_signature(local_path, DELTA_BLOCK)
+        with self.lock:
+            self[remote_path] = [size, mtime, DELTA_BLOCK, signature]
+
+    def save(self):
+        if self.filename:
+            with self.lock:
+                utility.save_json(self.filename, dict(self))
+
+
 ##############################################################################
 #
 # FTPWrappers
@@ -71,6 +319,9 @@ def timestamp(datetime_str, tzinfo=None):
 
 class AbstractConnectionWrapper:
 
+    # number of requests that have been sent to the server
+    round_trips = 0
+
     def close(self):
         """Closes the wrapped connection."""
         pass
@@ -115,11 +366,80 @@ class AbstractConnectionWrapper:
         """Returns the size of the file at location `path`."""
         raise NotImplementedError
 
+    def clear_cache(self):
+        """Forgets all cached information about the remote tree."""
+        pass
+
     def upload(self, local_path, remote_path):
         """Uploads a file from `local_path` on the file system to
         `remote_path` on the wrapped connection."""
         return NotImplementedError
 
+    def upload_file(self, local_path, remote_path):
+        """Uploads a file from `local_path` on the file system to the file
+        `remote_path` on the wrapped connection. Other than `upload()`, it
+        does not check whether `remote_path` is a directory."""
+        self.upload(local_path, remote_path)
+
+    def upload_files(self, transfers):
+        """Uploads the files given as a list of (local path, remote path)
+        pairs in `transfers` (see `upload_file()`). Connections that can
+        send requests without waiting for the replies to earlier requests
+        override this method, so that a batch of small files does not cost
+        one round trip per file."""
+        for local_path, remote_path in transfers:
+            self.upload_file(local_path, remote_path)
+
+    def upload_resumable(self, local_path, remote_path, record):
+        """Uploads the large file `local_path` in chunks of `RESUME_CHUNK`
+        bytes to the temporary name `remote_path` + `PART_SUFFIX` and
+        renames it to `remote_path` when it is complete, so that readers
+        never see a truncated file. The chunks that have been sent are
+        recorded in the `ResumeRecord` `record`. If a partial copy of an
+        earlier, interrupted upload exists, the upload is resumed from the
+        offset that is confirmed by both the record and the size of the
+        partial copy."""
+        part = remote_path + PART_SUFFIX
+        offset = 0
+        if remote_path in record:
+            try:
+                part_size = self.size(part)
+            except OSError:
+                part_size = 0
+            offset = record.resume_offset(remote_path, local_path, part_size)
+        else:
+            record.resume_offset(remote_path, local_path, 0)
+        with open(local_path, "rb") as f:
+            f.seek(offset)
+            self.write_part(f, part, offset,
+                            lambda data: record.chunk_sent(remote_path, data))
+        self.replace(part, remote_path)
+        record.finish(remote_path)
+
+    def upload_delta(self, local_path, remote_path, signatures, record):
+        """Uploads the large file `local_path` to `remote_path` by sending
+        only the blocks that differ from the remote file, as far as a
+        signature of the remote file has been kept in the `SignatureCache`
+        `signatures`. Connections that support this keep the signature of
+        the new version for the next upload. This default implementation
+        uploads the whole file (see `upload_resumable()` for `record`)."""
+        if os.path.getsize(local_path) > RESUMABLE_SIZE:
+            self.upload_resumable(local_path, remote_path, record)
+        else:
+            self.upload_file(local_path, remote_path)
+
+    def write_part(self, source, path, offset, sent):
+        """Writes the rest of the open file `source` to the file `path`
+        from position `offset` on, where the file `path` is created, if
+        `offset` is zero. Calls `sent()` with every chunk of `RESUME_CHUNK`
+        bytes that has been written."""
+        raise NotImplementedError
+
+    def replace(self, path, target):
+        """Renames the file `path` to `target`, replacing `target` if it
+        exists."""
+        raise NotImplementedError
+
     def download(self, remote_path, local_path):
         """Downloads a file from `remote_path` on the wrapped connection to
         `local_path` on the file system."""
@@ -133,6 +453,12 @@ class AbstractConnectionWrapper:
         """Creates a directory at `path`."""
         raise NotImplementedError
 
+    def mkdirs(self, paths):
+        """Creates the directories `paths` in the given order, i.e. parents
+        must precede their subdirectories."""
+        for path in paths:
+            self.mkdir(path)
+
     def rmdir(self, path):
         """Removes the (empty!) directory at location `path`."""
         raise NotImplementedError
@@ -175,6 +501,10 @@ class NILProxy(AbstractConnectionWrapper):
     def isFileSystem(self):
         return self.connection.isFileSystem()
 
+    @property
+    def round_trips(self):
+        return self.connection.round_trips
+
     def fullpath(self, path):
         return self.connection.fullpath(path)
 
@@ -184,11 +514,35 @@ class NILProxy(AbstractConnectionWrapper):
         else:
             return []
 
+    def exists(self, path):
+        return self.connection.exists(path)
+
+    def isfile(self, path):
+        return self.connection.isfile(path)
+
+    def isdir(self, path):
+        return self.connection.isdir(path)
+
+    def mtime(self, path):
+        return self.connection.mtime(path)
+
+    def size(self, path):
+        return self.connection.size(path)
+
     def upload(self, local_path, remote_path):
         assert os.path.exists(local_path)
 
+    def upload_file(self, local_path, remote_path):
+        assert os.path.exists(local_path)
+
+    def upload_resumable(self, local_path, remote_path, record):
+        assert os.path.exists(local_path)
+
+    def upload_delta(self, local_path, remote_path, signatures, record):
+        assert os.path.exists(local_path)
+
     def download(self, remote_path, local_path):
-        shutil.copy2(self.fullpath(remote_path), local_path)
+        self.connection.download(remote_path, local_path)
 
     def remove(self, path):
         pass
@@ -255,6 +609,43 @@ class FileSystemWrapper(AbstractConnectionWrapper):
     def upload(self, local_path, remote_path):
         shutil.copy2(local_path, self.fullpath(remote_path))
 
+    def write_part(self, source, path, offset, sent):
+        with open(self.fullpath(path), "r+b" if offset else "wb") as f:
+            f.seek(offset)
+            for data in iter(lambda: source.read(RESUME_CHUNK), b""):
+                f.write(data)
+                f.flush()
+                sent(data)
+            f.truncate()
+
+    def replace(self, path, target):
+        os.replace(self.fullpath(path), self.fullpath(target))
+
+    def upload_delta(self, local_path, remote_path, signatures, record):
+        # the new version is assembled from the blocks of the old version
+        # and the changed data under a temporary name
+        path = self.fullpath(remote_path)
+        try:
+            st = os.stat(path)
+            signature = signatures.signature(remote_path, st.st_size,
+                                             st.st_mtime)
+        except FileNotFoundError:
+            signature = None
+        if signature is None:
+            super().upload_delta(local_path, remote_path, signatures, record)
+        else:
+            with open(path, "rb") as old, \
+                    open(path + PART_SUFFIX, "wb") as new:
+                for offset, data, index in delta(local_path, signature,
+                                                 DELTA_BLOCK):
+                    if index is not None:
+                        old.seek(index * DELTA_BLOCK)
+                        data = old.read(len(data))
+                    new.write(data)
+            os.replace(path + PART_SUFFIX, path)
+        st = os.stat(path)
+        signatures.store(remote_path, st.st_size, st.st_mtime, local_path)
+
     def download(self, remote_path, local_path):
         shutil.copy2(self.fullpath(remote_path), local_path)
 
@@ -271,6 +662,72 @@ class FileSystemWrapper(AbstractConnectionWrapper):
         shutil.rmtree(self.fullpath(path))
 
 
+class ListingCache:
+    """Class ListingCache keeps the remote directory listings of one
+    connection, so that queries like `isdir()` or `mtime()` can be answered
+    without asking the server again. Listings are stored when a directory
+    is listed and kept up to date with the changes that the connection
+    itself makes. Changes made by other connections are not noticed; call
+    `clear()` if the remote tree may have been changed in the meantime.
+    """
+
+    def __init__(self):
+        self.listings = {}   # directory -> {name: paramiko.SFTPAttributes}
+
+    @staticmethod
+    def key(path):
+        return os.path.normpath(path or ".")
+
+    def clear(self):
+        self.listings = {}
+
+    def store(self, path, entries):
+        """Stores the listing of the directory `path`."""
+        self.listings[self.key(path)] = {entry.filename: entry
+                                         for entry in entries}
+
+    def listing(self, path):
+        """Returns the list of entries of the directory `path` or None, if
+        it has not been listed."""
+        listing = self.listings.get(self.key(path))
+        return None if listing is None else list(listing.values())
+
+    def lookup(self, path):
+        """Returns a tuple (known, attributes): `known` is True, if the
+        parent directory of `path` has been listed, `attributes` are the
+        attributes of `path` or None, if it does not exist."""
+        parent, name = os.path.split(self.key(path))
+        listing = self.listings.get(self.key(parent))
+        if listing is None:
+            return False, None
+        return True, listing.get(name)
+
+    def add(self, path, st_mode, st_size=0):
+        """Records that an entry with the given mode and size has been
+        created or replaced at `path`."""
+        parent, name = os.path.split(self.key(path))
+        listing = self.listings.get(self.key(parent))
+        if listing is not None:
+            entry = paramiko.SFTPAttributes()
+            entry.filename = name
+            entry.st_mode = st_mode
+            entry.st_size = st_size
+            entry.st_mtime = entry.st_atime = int(time.time())
+            listing[name] = entry
+        if stat.S_ISDIR(st_mode):
+            self.listings[self.key(path)] = {}
+
+    def discard(self, path):
+        """Records that the entry at `path` (and everything below) has
+        been removed."""
+        path = self.key(path)
+        parent, name = os.path.split(path)
+        self.listings.get(self.key(parent), {}).pop(name, None)
+        for directory in list(self.listings):
+            if directory == path or directory.startswith(path + "/"):
+                del self.listings[directory]
+
+
 class FTPWrapper(AbstractConnectionWrapper):
 
     def __init__(self, root, ftp):
@@ -278,6 +735,8 @@ class FTPWrapper(AbstractConnectionWrapper):
         if root:
             ftp.cwd(root)
         self.ftp = ftp
+        self.cache = ListingCache()
+        self.round_trips = 0
 
     def close(self):
         print("FTP closed")
@@ -286,16 +745,17 @@ class FTPWrapper(AbstractConnectionWrapper):
     def isFileSystem(self):
         return False
 
-    def listdir(self, path):
-        if not path:
-            path = "."
-        return [entry[0] for entry in self.ftp.mlsd(path)
-                if entry[0] not in {".", ".."}]
+    def clear_cache(self):
+        self.cache.clear()
 
     def listdir_attr(self, path):
         if not path:
             path = "."
+        cached = self.cache.listing(path)
+        if cached is not None:
+            return cached
         directory = []
+        self.round_trips += 1
         for name, attrs in self.ftp.mlsd(path):
             entry = paramiko.sftp_attr.SFTPAttributes()
             if name not in {".", ".."}:
@@ -309,76 +769,204 @@ class FTPWrapper(AbstractConnectionWrapper):
                 entry.st_mode = int(attrs['unix.mode'], 8) \
                     if 'unix.gid' in attrs else 0o755
                 if attrs['type'][-3:] == "dir":
-                    entry.st_mode |= 0o40000
+                    entry.st_mode |= stat.S_IFDIR
+                elif attrs['type'] == "file":
+                    entry.st_mode |= stat.S_IFREG
                 entry.st_mtime = timestamp(attrs['modify'],
                                            datetime.timezone.utc)
                 entry.st_atime = entry.st_mtime
                 directory.append(entry)
+        self.cache.store(path, directory)
         return directory
 
-    def exists(self, path):
-        parent, name = os.path.split(path)
-        directory = self.listdir(parent)
-        return name in directory
-
     def __attr(self, path):
-        parent, name = os.path.split(path)
-        directory = {name: attrs for name, attrs in
-                     self.ftp.mlsd(parent)}
-        if name not in directory:
-            raise IOError("FileNotFound: " + path)
-        return directory[name]
+        """Returns the attributes of `path` (from the listing of its parent
+        directory) or None, if `path` does not exist."""
+        known, attrs = self.cache.lookup(path)
+        if not known:
+            parent, name = os.path.split(ListingCache.key(path))
+            try:
+                self.listdir_attr(parent)
+            except ftplib.error_perm:
+                return None     # the parent directory does not exist
+            known, attrs = self.cache.lookup(path)
+        return attrs
+
+    def exists(self, path):
+        return self.__attr(path) is not None
 
     def isfile(self, path):
-        try:
-            return self.__attr(path)['type'] == "file"
-        except IOError:
-            return False
+        attrs = self.__attr(path)
+        return attrs is not None and stat.S_ISREG(attrs.st_mode)
 
     def isdir(self, path):
-        if not path:
-            path = "."
-        try:
-            return self.__attr(path)['type'][-3:] == "dir"
-        except IOError:
-            return False
+        if ListingCache.key(path) == ".":
+            return True
+        attrs = self.__attr(path)
+        return attrs is not None and stat.S_ISDIR(attrs.st_mode)
 
     def mtime(self, path):
-        return timestamp(self.__attr(path)['modify'], datetime.timezone.utc)
+        attrs = self.__attr(path)
+        if attrs is None:
+            raise IOError("FileNotFound: " + path)
+        return attrs.st_mtime
 
     def size(self, path):
-        return self.ftp.size(path)
+        attrs = self.__attr(path)
+        if attrs is None:
+            raise IOError("FileNotFound: " + path)
+        return attrs.st_size
 
     def upload(self, local_path, remote_path):
         dest_name = os.path.join(remote_path, os.path.basename(local_path)) \
             if not remote_path or self.isdir(remote_path) else remote_path
+        self.upload_file(local_path, dest_name)
+
+    def upload_file(self, local_path, remote_path):
+        self.round_trips += 1
         with open(local_path, "rb") as f:
-            self.ftp.storbinary("STOR " + dest_name, f)
+            self.ftp.storbinary("STOR " + remote_path, f)
+        self.cache.add(remote_path, stat.S_IFREG | 0o644,
+                       os.path.getsize(local_path))
+
+    def upload_resumable(self, local_path, remote_path, record):
+        super().upload_resumable(local_path, remote_path, record)
+        self.cache.discard(remote_path + PART_SUFFIX)
+        self.cache.add(remote_path, stat.S_IFREG | 0o644,
+                       os.path.getsize(local_path))
+
+    def write_part(self, source, path, offset, sent):
+        # REST positions the transfer at the resumed chunk, which may lie
+        # before the end of the partial file, where APPE would continue
+        self.round_trips += 1
+        self.ftp.storbinary("STOR " + path, source, RESUME_CHUNK, sent,
+                            rest=offset or None)
+
+    def replace(self, path, target):
+        self.round_trips += 1
+        try:
+            self.ftp.rename(path, target)
+        except ftplib.error_perm:
+            # some servers do not overwrite an existing file when renaming
+            self.round_trips += 2
+            self.ftp.delete(target)
+            self.ftp.rename(path, target)
 
     def download(self, remote_path, local_path):
+        self.round_trips += 1
         with open(local_path, "wb") as f:
             self.ftp.retrbinary("RETR " + remote_path, f.write)
 
     def remove(self, path):
+        self.round_trips += 1
         self.ftp.delete(path)
+        self.cache.discard(path)
 
     def mkdir(self, path):
+        self.round_trips += 1
         self.ftp.mkd(path)
+        self.cache.add(path, stat.S_IFDIR | 0o755)
 
     def rmdir(self, path):
+        self.round_trips += 1
         self.ftp.rmd(path)
+        self.cache.discard(path)
 
     def _rmtree(self, path, keep_topdir=False):
-        for entry, attrs in self.ftp.mlsd(path):
-            if entry not in {".", ".."}:
-                entry_path = os.path.join(path, entry)
-                if attrs['type'][-3:] == "dir":
-                    self.rmtree(entry_path)
-                else:
-                    self.remove(entry_path)
+        for entry in self.listdir_attr(path):
+            entry_path = os.path.join(path, entry.filename)
+            if stat.S_ISDIR(entry.st_mode):
+                self._rmtree(entry_path)
+            else:
+                self.remove(entry_path)
         self.rmdir(path)
 
 
+# size of the write requests of a pipelined upload
+SFTP_CHUNK_SIZE = 32768
+
+
+class SFTPPipeline:
+    """Class SFTPPipeline sends requests over an SFTP connection without
+    waiting for the replies to the earlier requests. Because the server
+    executes the requests of a session in the order in which they arrive, a
+    sequence of requests, e.g. creating nested directories, costs a single
+    round trip instead of one round trip per request.
+
+    The public API of paramiko does not suffice for this, because
+    `SFTPClient.open()` waits for the handle of each file and
+    `SFTPFile.close()` for the acknowledgement of each file. The pipeline
+    therefore uses the request layer of `paramiko.SFTPClient` in the same
+    way as the pipelined writes of `paramiko.SFTPFile`, i.e. the private
+    methods `_async_request()`, `_read_response()` and `_convert_status()`.
+    These, as well as `paramiko.sftp.int64`, are present from paramiko 3.0
+    up to 5.0, the latest version this module has been tested with.
+    """
+
+    def __init__(self, sftp):
+        self.sftp = sftp
+        self.replies = {}
+        self.pending = set()    # numbers of the requests without reply
+
+    def path(self, path):
+        """Returns `path` relative to the current directory of the client
+        (see `SFTPClient.chdir()`), of which the server knows nothing."""
+        cwd = self.sftp.getcwd()
+        return path if cwd is None else posixpath.join(cwd, path)
+
+    def send(self, request, *args):
+        """Sends `request` with the arguments `args` and returns the number
+        of the request."""
+        num = self.sftp._async_request(self, request, *args)
+        self.pending.add(num)
+        return num
+
+    def _async_response(self, reply, msg, num):
+        # called by the SFTPClient when the reply to request `num` arrives
+        self.replies[num] = (reply, msg)
+
+    def receive(self, num):
+        """Waits for the reply to the request `num` and returns it as a
+        tuple (reply type, message)."""
+        while num not in self.replies:
+            self.sftp._read_response()
+        self.pending.discard(num)
+        return self.replies.pop(num)
+
+    def drain(self):
+        """Waits for the replies to all requests that are still outstanding
+        and closes the handles that arrive with them, so that a pipeline
+        that has been interrupted by an error leaves neither open files on
+        the server nor unread replies on the connection. A broken
+        connection leaves nothing to clean up, so its errors are ignored.
+        """
+        try:
+            while self.pending:
+                reply, msg = self.receive(min(self.pending))
+                if reply == CMD_HANDLE:
+                    self.send(CMD_CLOSE, msg.get_binary())
+        except (IOError, EOFError):
+            pass
+
+    def wait(self, nums):
+        """Waits for the status replies to the requests `nums` and returns
+        the error of the first request that failed or None."""
+        error = None
+        for num in nums:
+            reply, msg = self.receive(num)
+            error = error or self.error(msg)
+        return error
+
+    def error(self, msg):
+        """Returns the error that is reported by the status reply `msg` or
+        None, if the request succeeded."""
+        try:
+            self.sftp._convert_status(msg)
+        except (IOError, EOFError) as e:
+            return e
+        return None
+
+
 class SFTPWrapper(AbstractConnectionWrapper):
 
     def __init__(self, root, sftp):
@@ -386,6 +974,9 @@ class SFTPWrapper(AbstractConnectionWrapper):
         if root:
             sftp.chdir(root)
         self.sftp = sftp
+        self.cache = ListingCache()
+        self.round_trips = 0
+        self.copy_data = True   # until the server refuses the extension
 
     def close(self):
         print("SFTP closed")
@@ -394,76 +985,248 @@ class SFTPWrapper(AbstractConnectionWrapper):
     def isFileSystem(self):
         return False
 
-    def listdir(self, path):
-        if not path:
-            path = "."
-        return [entry for entry in self.sftp.listdir(path)
-                if entry not in {".", ".."}]
+    def clear_cache(self):
+        self.cache.clear()
 
     def listdir_attr(self, path):
         if not path:
             path = "."
-        return [entry for entry in self.sftp.listdir_attr(path)
-                if entry.filename not in {".", ".."}]
+        cached = self.cache.listing(path)
+        if cached is not None:
+            return cached
+        self.round_trips += 1
+        directory = [entry for entry in self.sftp.listdir_attr(path)
+                     if entry.filename not in {".", ".."}]
+        self.cache.store(path, directory)
+        return directory
 
-    def exists(self, path):
+    def __attr(self, path):
+        """Returns the attributes of `path` (from the cached listing of its
+        parent directory or by asking the server) or None, if `path` does
+        not exist."""
+        known, attrs = self.cache.lookup(path)
+        if known:
+            return attrs
+        self.round_trips += 1
         try:
-            self.sftp.stat(path)
-            return True
+            return self.sftp.stat(path)
         except FileNotFoundError:
-            return False
+            return None
+
+    def exists(self, path):
+        return self.__attr(path) is not None
 
     def isfile(self, path):
-        try:
-            if stat.S_ISREG(self.sftp.stat(path).st_mode):
-                return True
-            else:
-                return False
-        except FileNotFoundError:
-            return False
+        attrs = self.__attr(path)
+        return attrs is not None and stat.S_ISREG(attrs.st_mode)
 
     def isdir(self, path):
-        if not path:
-            path = "."
-        try:
-            if stat.S_ISDIR(self.sftp.stat(path).st_mode):
-                return True
-            else:
-                return False
-        except FileNotFoundError:
-            return False
+        if ListingCache.key(path) == ".":
+            return True
+        attrs = self.__attr(path)
+        return attrs is not None and stat.S_ISDIR(attrs.st_mode)
 
     def mtime(self, path):
-        return self.sftp.stat(path).st_mtime
+        attrs = self.__attr(path)
+        if attrs is None:
+            raise FileNotFoundError(path)
+        return attrs.st_mtime
 
     def size(self, path):
-        return self.sftp.stat(path).st_size
+        attrs = self.__attr(path)
+        if attrs is None:
+            raise FileNotFoundError(path)
+        return attrs.st_size
 
     def upload(self, local_path, remote_path):
         dest_name = os.path.join(remote_path, os.path.basename(local_path)) \
             if not remote_path or self.isdir(remote_path) else remote_path
-        self.sftp.put(local_path, dest_name)
+        self.upload_file(local_path, dest_name)
+
+    def upload_file(self, local_path, remote_path):
+        self.round_trips += 1
+        self.sftp.put(local_path, remote_path, confirm=False)
+        self.cache.add(remote_path, stat.S_IFREG | 0o644,
+                       os.path.getsize(local_path))
+
+    def upload_files(self, transfers):
+        """Uploads the files in `transfers` over a pipeline (see
+        `SFTPPipeline`): All files are opened at once and the writes and
+        the closing of each file are sent as soon as its handle arrives. A
+        batch of files thus costs two round trips."""
+        if len(transfers) < 2:
+            super().upload_files(transfers)
+            return
+        pipeline = SFTPPipeline(self.sftp)
+        flags = SFTP_FLAG_WRITE | SFTP_FLAG_CREATE | SFTP_FLAG_TRUNC
+        error = None
+        try:
+            opened = [pipeline.send(CMD_OPEN, pipeline.path(remote_path),
+                                    flags, paramiko.SFTPAttributes())
+                      for local_path, remote_path in transfers]
+            self.round_trips += 2
+            written = []
+            for num, (local_path, remote_path) in zip(opened, transfers):
+                reply, msg = pipeline.receive(num)
+                if reply != CMD_HANDLE:
+                    error = error or pipeline.error(msg)
+                    continue
+                handle = msg.get_binary()
+                requests, offset = [], 0
+                try:
+                    with open(local_path, "rb") as f:
+                        for data in iter(lambda: f.read(SFTP_CHUNK_SIZE),
+                                         b""):
+                            requests.append(pipeline.send(
+                                CMD_WRITE, handle, int64(offset), data))
+                            offset += len(data)
+                finally:
+                    requests.append(pipeline.send(CMD_CLOSE, handle))
+                written.append((remote_path, offset, requests))
+            for remote_path, size, requests in written:
+                failure = pipeline.wait(requests)
+                if failure is None:
+                    self.cache.add(remote_path, stat.S_IFREG | 0o644, size)
+                else:
+                    error = error or failure
+        finally:
+            pipeline.drain()
+        if error is not None:
+            raise error
+
+    def upload_resumable(self, local_path, remote_path, record):
+        super().upload_resumable(local_path, remote_path, record)
+        self.cache.discard(remote_path + PART_SUFFIX)
+        self.cache.add(remote_path, stat.S_IFREG | 0o644,
+                       os.path.getsize(local_path))
+
+    def copy_file(self, path, target):
+        """Copies the remote file `path` to `target` on the server by the
+        copy-data extension of OpenSSH (version 9.0 and later), which is
+        sent with the private `SFTPClient._request()`, as paramiko has no
+        public API for extended requests. Returns the open file `target` or
+        None, if the server does not support the extension."""
+        if not self.copy_data:
+            return None
+        self.round_trips += 3
+        with self.sftp.open(path, "r") as source:
+            f = self.sftp.open(target, "w")
+            try:
+                self.sftp._request(CMD_EXTENDED, "copy-data", source.handle,
+                                   int64(0), int64(0), f.handle, int64(0))
+            except IOError:
+                f.close()
+                self.round_trips += 1
+                self.sftp.remove(target)
+                self.copy_data = False
+                return None
+        return f
+
+    def upload_delta(self, local_path, remote_path, signatures, record):
+        # the old version is copied to the temporary name on the server and
+        # patched there, so that readers never see a half patched file. As
+        # the copy is patched in place, only the blocks that are found at
+        # the same offset in the old version are kept
+        self.round_trips += 1
+        try:
+            attrs = self.sftp.stat(remote_path)
+            signature = signatures.signature(remote_path, attrs.st_size,
+                                             attrs.st_mtime)
+        except FileNotFoundError:
+            signature = None
+        part = remote_path + PART_SUFFIX
+        f = None if signature is None else self.copy_file(remote_path, part)
+        if f is None:
+            super().upload_delta(local_path, remote_path, signatures, record)
+        else:
+            size = os.path.getsize(local_path)
+            with f:
+                f.set_pipelined(True)
+                for offset, data, index in delta(local_path, signature,
+                                                 DELTA_BLOCK, False):
+                    if index is None or index * DELTA_BLOCK != offset:
+                        f.seek(offset)
+                        f.write(data)
+                if attrs.st_size > size:
+                    f.truncate(size)
+            self.replace(part, remote_path)
+            self.cache.add(remote_path, stat.S_IFREG | 0o644, size)
+        self.round_trips += 1
+        attrs = self.sftp.stat(remote_path)
+        signatures.store(remote_path, attrs.st_size, attrs.st_mtime,
+                         local_path)
+
+    def write_part(self, source, path, offset, sent):
+        self.round_trips += 1
+        with self.sftp.open(path, "r+" if offset else "w") as f:
+            f.set_pipelined(True)
+            f.seek(offset)
+            for data in iter(lambda: source.read(RESUME_CHUNK), b""):
+                f.write(data)
+                sent(data)
+
+    def replace(self, path, target):
+        self.round_trips += 1
+        try:
+            self.sftp.posix_rename(path, target)
+        except IOError:
+            # the server does not support the posix-rename extension
+            self.round_trips += 2
+            if self.exists(target):
+                self.sftp.remove(target)
+            self.sftp.rename(path, target)
 
     def download(self, remote_path, local_path):
+        self.round_trips += 1
         self.sftp.get(remote_path, local_path)
 
     def remove(self, path):
+        self.round_trips += 1
         self.sftp.remove(path)
+        self.cache.discard(path)
 
     def mkdir(self, path):
+        self.round_trips += 1
         self.sftp.mkdir(path)
+        self.cache.add(path, stat.S_IFDIR | 0o755)
+
+    def mkdirs(self, paths):
+        """Creates the directories `paths` over a pipeline (see
+        `SFTPPipeline`) in a single round trip."""
+        if len(paths) < 2:
+            super().mkdirs(paths)
+            return
+        pipeline = SFTPPipeline(self.sftp)
+        attrs = paramiko.SFTPAttributes()
+        attrs.st_mode = 0o777
+        error = None
+        try:
+            requests = [pipeline.send(CMD_MKDIR, pipeline.path(path), attrs)
+                        for path in paths]
+            self.round_trips += 1
+            for path, num in zip(paths, requests):
+                failure = pipeline.wait([num])
+                if failure is None:
+                    self.cache.add(path, stat.S_IFDIR | 0o755)
+                else:
+                    error = error or failure
+        finally:
+            pipeline.drain()
+        if error is not None:
+            raise error
 
     def rmdir(self, path):
+        self.round_trips += 1
         self.sftp.rmdir(path)
+        self.cache.discard(path)
 
     def _rmtree(self, path, keep_topdir=False):
-        for entry in self.listdir(path):
-            if entry not in {".", ".."}:
-                entry_path = os.path.join(path, entry)
-                if self.isdir(entry_path):
-                    self.rmtree(entry_path)
-                else:
-                    self.remove(entry_path)
+        for entry in self.listdir_attr(path):
+            entry_path = os.path.join(path, entry.filename)
+            if stat.S_ISDIR(entry.st_mode):
+                self._rmtree(entry_path)
+            else:
+                self.remove(entry_path)
         self.rmdir(path)
 
 
@@ -473,90 +1236,729 @@ class SFTPWrapper(AbstractConnectionWrapper):
 #
 ##############################################################################
 
-def upload_tree(local, local_path, remote, remote_path, delete=False,
-                logger=lambda msg: 0):
+class UploadReport(dict):
+    """The upload report, a dictionary that maps the categories of transfer
+    operations to the sets of affected remote paths. The attribute
+    `round_trips` counts the requests that have been sent to the server.
+    """
+
+    def __init__(self):
+        super().__init__(uploaded=set(),  # file uploaded
+                         skipped=set(),   # file skipped
+                         created=set(),   # directory created
+                         deleted=set(),   # file deleted
+                         removed=set())   # directory removed
+        self.round_trips = 0
+
+
+def empty_report():
+    """Returns an empty upload report."""
+    return UploadReport()
+
+
+class TransferPlan:
+    """Class TransferPlan contains the operations that are necessary in order
+    to bring a remote directory tree up to date with a local one, grouped in
+    the order in which they must be executed:
+
+    removals:  (category, path) of remote entries that stand in the way of
+               local entries of the other type, i.e. a file in place of a
+               directory or vice versa
+    mkdirs:    paths of the directories to be created, parents first
+    uploads:   (local path, remote path) of the files to be uploaded
+    deletions: (category, path) of remote entries that do not exist locally
+               (only if the plan has been made with `delete=True`)
+    skipped:   remote paths of the files that are up to date
+    kept:      (category, path) of remote entries that do not exist locally
+               but are kept, because the plan has been made without `delete`
+
+    The category of removals, deletions and kept entries is either 'deleted'
+    (a file) or 'removed' (a directory tree).
+    """
+
+    def __init__(self):
+        self.removals = []
+        self.mkdirs = []
+        self.uploads = []
+        self.deletions = []
+        self.skipped = []
+        self.kept = []
+
+    def __len__(self):
+        return len(self.removals) + len(self.mkdirs) + len(self.uploads) + \
+            len(self.deletions)
+
+
+def is_outdated(local_attr, remote_attr):
+    """Returns True, if the remote file described by `remote_attr` is older
+    than the local file described by `local_attr` or if both have the same
+    time but different sizes. Times are compared with a resolution of one
+    second, because SFTP and FTP servers do not report fractions of
+    seconds."""
+    local_time = int(local_attr.st_mtime)
+    remote_time = int(remote_attr.st_mtime)
+    return local_time > remote_time or \
+        (local_time == remote_time and
+         local_attr.st_size != remote_attr.st_size)
+
+
+def plan_upload(local, local_path, remote, remote_path, delete=False,
+                logger=lambda msg: 0, state=None, manifest=None):
+    """Compares the local directory tree at `local_path` with the remote
+    tree at `remote_path` by listing the remote directories and returns the
+    `TransferPlan` for uploading the local tree. Nothing is changed on the
+    remote side. Raises an IOError if a remote entry would have to be
+    replaced by a local entry of the other type, but `delete` is False.
+
+    If the `state` of the local tree (see `scan_tree()`) is given, a file is
+    uploaded if its hash differs from the hash recorded in the remote
+    `manifest` for a remote file of the same size. Files that are not
+    contained in the manifest (or that have been changed on the server
+    since) are uploaded if their size differs or if the local file is
+    newer.
+    """
+    assert local.isFileSystem()
+    plan = TransferPlan()
+    known = manifest["files"] if manifest else {}
+
+    def outdated(rel_path, local_attr, remote_attr):
+        if state is None:
+            return is_outdated(local_attr, remote_attr)
+        local_entry = state["files"][rel_path]
+        remote_entry = known.get(rel_path)
+        if remote_entry and remote_entry[1] == remote_attr.st_size:
+            return remote_entry != local_entry
+        return local_entry[1] != remote_attr.st_size or \
+            is_outdated(local_attr, remote_attr)
+
+    def plan_dir(rel_dir, remote_dir, remote_exists):
+        logger("entering " + remote_dir + "...")
+        local_dir = os.path.join(local_path, rel_dir)
+        local_dict = {entry.filename: entry
+                      for entry in local.listdir_attr(local_dir)}
+        remote_dict = {entry.filename: entry
+                       for entry in remote.listdir_attr(remote_dir)} \
+            if remote_exists else {}
+
+        for entry in sorted(local_dict):
+            rel_path = os.path.join(rel_dir, entry)
+            src_path = local.fullpath(os.path.join(local_path, rel_path))
+            dst_path = os.path.join(remote_dir, entry)
+            remote_attr = remote_dict.get(entry)
+            if stat.S_ISDIR(local_dict[entry].st_mode):
+                exists = remote_attr is not None and \
+                    stat.S_ISDIR(remote_attr.st_mode)
+                if not exists:
+                    if remote_attr is not None:
+                        if not delete:
+                            raise IOError("Can't overwrite file "
+                                          "%s with a directory" % dst_path)
+                        plan.removals.append(('deleted', dst_path))
+                    plan.mkdirs.append(dst_path)
+                plan_dir(rel_path, dst_path, exists)
+            elif remote_attr is None:
+                plan.uploads.append((src_path, dst_path))
+            elif stat.S_ISDIR(remote_attr.st_mode):
+                if not delete:
+                    raise IOError("Can't overwrite dir %s with file" %
+                                  dst_path)
+                plan.removals.append(('removed', dst_path))
+                plan.uploads.append((src_path, dst_path))
+            elif outdated(rel_path, local_dict[entry], remote_attr):
+                plan.uploads.append((src_path, dst_path))
+            else:
+                plan.skipped.append(dst_path)
+
+        for entry in sorted(remote_dict.keys() - local_dict.keys()):
+            if not rel_dir and entry == REMOTE_MANIFEST:
+                continue
+            if entry.endswith(PART_SUFFIX) and \
+                    entry[:-len(PART_SUFFIX)] in local_dict:
+                continue    # an interrupted upload that can be resumed
+            dst_path = os.path.join(remote_dir, entry)
+            category = 'removed' \
+                if stat.S_ISDIR(remote_dict[entry].st_mode) else 'deleted'
+            if delete:
+                plan.deletions.append((category, dst_path))
+            else:
+                plan.kept.append((category, dst_path))
+        logger("...leaving " + remote_dir)
+
+    plan_dir("", remote_path, True)
+    return plan
+
+
+##############################################################################
+#
+# remote manifest
+#
+##############################################################################
+
+REMOTE_MANIFEST = ".upload-manifest.json"
+
+
+def scan_tree(local, local_path, hashes=None, workers=None):
+    """Returns the state of the local directory tree at `local_path` in the
+    form of a manifest, i.e. a dictionary with the keys 'files', which maps
+    the paths of all files (relative to `local_path`) to lists [md5-hash,
+    size], and 'dirs', the sorted list of the relative paths of all
+    directories (see `changes.tree_state()`).
+    """
     assert local.isFileSystem()
-    logger("entering " + remote_path + "...")
+    return changes.tree_state(local.fullpath(local_path), hashes, workers)
+
+
+def ancestors(path):
+    """Yields the parent directories of the relative `path`."""
+    path = os.path.dirname(path)
+    while path:
+        yield path
+        path = os.path.dirname(path)
+
+
+def plan_from_manifest(local, local_path, state, manifest, remote_path,
+                       delete=False):
+    """Returns the `TransferPlan` for uploading the local tree at
+    `local_path`, the `state` of which has been determined by
+    `scan_tree()`, to `remote_path`, where the remote tree is described by
+    `manifest`. Files are uploaded if their hash or size differ from those
+    recorded in the manifest. No remote directories are listed.
+    """
+    plan = TransferPlan()
+    remote_files, remote_dirs = manifest["files"], set(manifest["dirs"])
+    local_files, local_dirs = state["files"], set(state["dirs"])
+    replaced = set()
+
+    for path in state["dirs"]:
+        if path not in remote_dirs:
+            if path in remote_files:
+                if not delete:
+                    raise IOError("Can't overwrite file %s with a directory"
+                                  % os.path.join(remote_path, path))
+                plan.removals.append(
+                    ('deleted', os.path.join(remote_path, path)))
+            plan.mkdirs.append(os.path.join(remote_path, path))
+    for path in sorted(local_files):
+        dst_path = os.path.join(remote_path, path)
+        if path in remote_dirs:
+            if not delete:
+                raise IOError("Can't overwrite dir %s with file" % dst_path)
+            plan.removals.append(('removed', dst_path))
+            replaced.add(path)
+            plan.uploads.append((local.fullpath(os.path.join(local_path,
+                                                             path)),
+                                 dst_path))
+        elif remote_files.get(path) != local_files[path]:
+            plan.uploads.append((local.fullpath(os.path.join(local_path,
+                                                             path)),
+                                 dst_path))
+        else:
+            plan.skipped.append(dst_path)
+
+    gone = replaced | (remote_dirs - local_dirs - local_files.keys())
+    stale = [('removed', path) for path in remote_dirs - local_dirs
+             if path not in local_files] + \
+        [('deleted', path) for path in remote_files.keys() - local_files.keys()
+         if path not in local_dirs]
+    for category, path in sorted(stale, key=lambda item: item[1]):
+        if gone.isdisjoint(ancestors(path)):
+            target = plan.deletions if delete else plan.kept
+            target.append((category, os.path.join(remote_path, path)))
+    return plan
+
+
+def plan_from_changes(local, local_path, change_manifest, remote_path,
+                      delete=False):
+    """Returns the `TransferPlan` for uploading the local tree at
+    `local_path` to `remote_path`, where the remote tree is known to be in
+    the state on which the `change_manifest` (see module `changes`) is
+    based. Only the paths listed in the change manifest are considered.
+    """
+    plan = TransferPlan()
+    added, changed = change_manifest["added"], change_manifest["changed"]
+    added_dirs = change_manifest["added_dirs"]
+    removed = set(change_manifest["removed"])
+    removed_dirs = set(change_manifest["removed_dirs"])
+
+    def dst(path):
+        return os.path.join(remote_path, path)
+
+    replaced = {path for path in added_dirs if path in removed} | \
+        {path for path in added if path in removed_dirs}
+    if replaced and not delete:
+        raise IOError("Can't overwrite %s with an entry of another type"
+                      % dst(min(replaced)))
+    for path in sorted(replaced):
+        plan.removals.append(('removed' if path in removed_dirs
+                              else 'deleted', dst(path)))
+    plan.mkdirs = [dst(path) for path in added_dirs]
+    for path in sorted(added.keys() | changed.keys()):
+        plan.uploads.append((local.fullpath(os.path.join(local_path, path)),
+                             dst(path)))
+    plan.skipped = [dst(path)
+                    for path in sorted(change_manifest["state"]["files"])
+                    if path not in added and path not in changed]
+    stale = [('removed', path) for path in removed_dirs] + \
+        [('deleted', path) for path in removed]
+    for category, path in sorted(stale, key=lambda item: item[1]):
+        if path not in replaced and \
+                removed_dirs.isdisjoint(ancestors(path)):
+            target = plan.deletions if delete else plan.kept
+            target.append((category, dst(path)))
+    return plan
+
+
+def updated_manifest(plan, state, manifest, remote_path):
+    """Returns the manifest of the remote tree after `plan` has been
+    executed successfully: the local `state` plus the remote entries that
+    have been kept according to the former `manifest` (if known)."""
+    files = dict(state["files"])
+    dirs = set(state["dirs"])
+    old_files = manifest["files"] if manifest else {}
+    for category, path in plan.kept:
+        path = os.path.relpath(path, remote_path) if remote_path else path
+        if category == 'removed':
+            dirs.add(path)
+            if manifest:
+                dirs.update(d for d in manifest["dirs"]
+                            if d.startswith(path + "/"))
+                files.update((f, v) for f, v in old_files.items()
+                             if f.startswith(path + "/"))
+        else:
+            files[path] = old_files.get(path, [None, None])
+    return {"files": files, "dirs": sorted(dirs)}
+
+
+def download_manifest(remote, remote_path, local_copy):
+    """Downloads the manifest of the remote tree at `remote_path` to the
+    file `local_copy` and returns it or None, if there is no manifest."""
+    try:
+        remote.download(os.path.join(remote_path, REMOTE_MANIFEST),
+                        local_copy)
+    except (OSError, ftplib.Error):
+        return None
+    manifest = utility.load_json(local_copy)
+    if not isinstance(manifest, dict) or \
+            not {"files", "dirs"} <= manifest.keys():
+        return None
+    return manifest
+
+
+def upload_manifest(remote, remote_path, manifest, local_copy):
+    """Stores `manifest` in the file `local_copy` and uploads it to the
+    remote tree at `remote_path`."""
+    utility.save_json(local_copy, manifest)
+    remote.upload_file(local_copy,
+                       os.path.join(remote_path, REMOTE_MANIFEST))
+
+
+def invalidate_manifest(remote, remote_path):
+    """Removes the manifest of the remote tree at `remote_path`, so that a
+    deployment that is interrupted is followed by a full comparison."""
+    try:
+        remote.remove(os.path.join(remote_path, REMOTE_MANIFEST))
+    except (OSError, ftplib.Error):
+        pass
+
 
-    report = {"uploaded": set(),  # file uploaded
-              "skipped": set(),   # file skipped
-              "created": set(),   # directory created
-              "deleted": set(),   # file deleted
-              "removed": set()}   # directory removed
+class DeployCancelled(Exception):
+    """Raised when a deployment is cancelled, because the deployment to
+    another target has failed (see `upload_targets()`)."""
+
+
+def check_cancelled(cancel):
+    """Raises `DeployCancelled` if the `threading.Event` `cancel` is set."""
+    if cancel is not None and cancel.is_set():
+        raise DeployCancelled("cancelled after the failure of another target")
+
+
+def run_parallel(connections, operations, cancel=None):
+    """Runs the `operations`, i.e. functions that take a connection wrapper
+    as their single argument, on the pool of `connections`, so that each
+    connection is used by only one operation at a time. Yields the
+    operations in the order of their successful completion. After the first
+    failure, the operations that have not yet started are skipped, the
+    running ones are finished (and yielded, if successful) and then the
+    exception is passed on, so that exactly the yielded operations have
+    been executed. Once the `threading.Event` `cancel` is set, the
+    operations that have not yet started raise `DeployCancelled`."""
+    if len(connections) <= 1:
+        for operation in operations:
+            check_cancelled(cancel)
+            operation(connections[0])
+            yield operation
+        return
+
+    idle = queue.Queue()
+    for connection in connections:
+        idle.put(connection)
+
+    failed = threading.Event()
+
+    def run(operation):
+        connection = idle.get()
+        try:
+            if failed.is_set():
+                return None     # skipped after the failure of another one
+            check_cancelled(cancel)
+            operation(connection)
+        except Exception:
+            failed.set()
+            raise
+        finally:
+            idle.put(connection)
+        return operation
+
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(len(connections)) as executor:
+        futures = [executor.submit(run, operation)
+                   for operation in operations]
+        for future in concurrent.futures.as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                operation = future.result()
+            except Exception as e:
+                if error is None:
+                    error = e
+                    for pending in futures:
+                        pending.cancel()
+                continue
+            if operation is not None:
+                yield operation
+    if error is not None:
+        raise error
+
+
+# the largest number of files that are uploaded in one batch (see
+# `AbstractConnectionWrapper.upload_files()`)
+UPLOAD_BATCH = 32
+
+# files that are larger than this are uploaded one by one
+BATCH_FILE_SIZE = 256 * 1024
+
+
+def upload_batches(uploads, connections, limit=None):
+    """Splits the (local path, remote path) pairs in `uploads` into batches
+    of small files that are spread evenly over the given number of
+    `connections`, but contain at most `UPLOAD_BATCH` files. Files larger
+    than `limit` (by default the smaller one of `BATCH_FILE_SIZE` and
+    `RESUMABLE_SIZE`) form batches of their own."""
+    small, batches = [], []
+    if limit is None:
+        limit = min(BATCH_FILE_SIZE, RESUMABLE_SIZE)
+    for transfer in uploads:
+        if os.path.getsize(transfer[0]) > limit:
+            batches.append([transfer])
+        else:
+            small.append(transfer)
+    size = max(1, min(UPLOAD_BATCH, -(-len(small) // max(connections, 1))))
+    batches.extend(small[i:i + size] for i in range(0, len(small), size))
+    return batches
+
+
+def execute_plan(plan, remote, pool=(), logger=lambda msg: 0, record=None,
+                 signatures=None, cancel=None):
+    """Executes the `TransferPlan` `plan` on the connection wrapper `remote`
+    and returns the upload report. Removals and the creation of directories
+    are executed in order on `remote`, uploads and deletions are spread over
+    `remote` and the further connections to the same server in `pool`.
+    Small files are uploaded in batches (see `upload_batches()`), so that
+    connections that support it can pipeline the transfers. Files larger
+    than `RESUMABLE_SIZE` are uploaded in chunks that are recorded in the
+    `ResumeRecord` `record`, so that an interrupted upload can be resumed.
+    If a `SignatureCache` is passed as `signatures`, files larger than its
+    `min_size` are transferred as a delta to the version of the last upload
+    (see `AbstractConnectionWrapper.upload_delta()`). Once the
+    `threading.Event` `cancel` is set, the execution stops with
+    `DeployCancelled` before the next operation.
+    """
+    report = empty_report()
+    if record is None:
+        record = ResumeRecord()
+    limit = min(BATCH_FILE_SIZE, RESUMABLE_SIZE)
+    if signatures is not None:
+        limit = min(limit, signatures.min_size)
 
     def log(category, entry_name):
         report[category].add(entry_name)
         logger(category + " " + entry_name)
 
-    local_dict = {entry.filename: entry
-                  for entry in local.listdir_attr(local_path)}
-    remote_dict = {entry.filename: entry
-                   for entry in remote.listdir_attr(remote_path)}
-
-#    print("LOCAL:", [(k, v.st_mtime) for k, v in local_dict.items()])
-#    print("REMOTE:", [(k, v.st_mtime) for k, v in remote_dict.items()])
-
-    for entry in local_dict:
-        src_path = os.path.join(local_path, entry)
-        dst_path = os.path.join(remote_path, entry)
-        if stat.S_ISDIR(local_dict[entry].st_mode):
-            if entry not in remote_dict or not \
-                    stat.S_ISDIR(remote_dict[entry].st_mode):
-                if entry in remote_dict:
-                    if delete:
-                        remote.remove(dst_path)
-                        log('deleted', dst_path)
-                    else:
-                        for e in remote_dict:
-                            print(remote_dict[e])
-                        raise IOError("Can't overwrite file "
-                                      "%s with a directory" % dst_path)
-                remote.mkdir(dst_path)
-                log('created', dst_path)
-            result = upload_tree(local, src_path, remote, dst_path,
-                                 delete, logger)
-            for key in report:
-                report[key].update(result[key])
-        else:
-            if entry in remote_dict:
-                local_time = local_dict[entry].st_mtime
-                remote_time = remote_dict[entry].st_mtime
-                if local_time > remote_time or \
-                        (local_time == remote_time and
-                         local_dict[entry].st_size !=
-                         remote_dict[entry].st_size):
-                    if stat.S_ISDIR(remote_dict[entry].st_mode):
-                        if delete:
-                            remote.rmtree(dst_path)
-                            log('removed', dst_path)
-                        else:
-                            raise IOError("Can't overwrite dir %s with file" %
-                                          dst_path)
-                    remote.upload(local.fullpath(src_path), dst_path)
-                    log('uploaded', dst_path) 
-                        # + " %f %f %i %s" %
-                        # (local_time, remote_time, local_dict[entry].st_size,
-                        #  remote_dict[entry].st_size))
-                else:
-                    log('skipped', dst_path)
+    def removal(category, path):
+        def remove(connection):
+            if category == 'removed':
+                connection.rmtree(path)
             else:
-                remote.upload(local.fullpath(src_path), dst_path)
-                log('uploaded', dst_path)
-
-    if delete:
-        for entry in remote_dict.keys() - local_dict.keys():
-            dst_path = os.path.join(remote_path, entry)
-            if stat.S_ISDIR(remote_dict[entry].st_mode):
-                remote.rmtree(dst_path)
-                log('removed', dst_path)
+                connection.remove(path)
+        remove.entries = [(category, path)]
+        return remove
+
+    def upload(batch):
+        def put(connection):
+            size = os.path.getsize(batch[0][0]) if len(batch) == 1 else 0
+            if signatures is not None and size > signatures.min_size:
+                connection.upload_delta(batch[0][0], batch[0][1], signatures,
+                                        record)
+            elif size > RESUMABLE_SIZE:
+                connection.upload_resumable(batch[0][0], batch[0][1], record)
             else:
-                remote.remove(dst_path)
-                log('deleted', dst_path)
+                connection.upload_files(batch)
+        put.entries = [('uploaded', dst) for src, dst in batch]
+        return put
+
+    for category, path in plan.removals:
+        check_cancelled(cancel)
+        removal(category, path)(remote)
+        log(category, path)
+    check_cancelled(cancel)
+    remote.mkdirs(plan.mkdirs)
+    for path in plan.mkdirs:
+        log('created', path)
+    for path in plan.skipped:
+        log('skipped', path)
+    connections = [remote] + list(pool)
+    operations = [upload(batch) for batch in
+                  upload_batches(plan.uploads, len(connections), limit)] + \
+        [removal(category, path) for category, path in plan.deletions]
+    for operation in run_parallel(connections, operations, cancel):
+        for category, path in operation.entries:
+            log(category, path)
+    return report
 
-    logger("...leaving " + remote_path)
+
+def upload_tree(local, local_path, remote, remote_path, delete=False,
+                logger=lambda msg: 0, pool=(), verify=False,
+                manifest_copy=None, hashes=None, record=None,
+                signatures=None, change_manifest=None, plans=None,
+                cancel=None):
+    """Uploads the local directory tree at `local_path` to `remote_path` on
+    the connection wrapper `remote`. If `delete` is True, remote entries
+    that do not exist locally are deleted.
+
+    Files are compared by their content hashes, which are kept in the
+    local hash cache `hashes`, so that only files whose size or
+    modification time have changed need to be hashed again. The hashes and
+    sizes of the remote files are kept in a manifest file in `remote_path`
+    (see `REMOTE_MANIFEST`). The transfer is planned from this manifest
+    (see `plan_from_manifest()`) without listing any remote directories, so
+    that a deployment takes only one download and one upload of the
+    manifest in addition to the transfer itself. If there is no manifest
+    or if `verify` is True, the remote tree is listed (see
+    `plan_upload()`). The plan is executed by `execute_plan()`, where the
+    uploads are spread over `remote` and the further connections to the
+    same server in `pool` (see `connect_pool()`).
+
+    If the `change_manifest` of the build is given, the local tree is not
+    scanned at all. If the remote manifest shows that the server is still
+    in the state of the previous build, only the paths listed in the change
+    manifest are transferred (see `plan_from_changes()`); otherwise the
+    state of the build is compared with the remote manifest as usual.
+
+    Deployments of the same build to several servers (see
+    `upload_targets()`) share the plans that have been made from equal
+    remote manifests through the dictionary `plans`.
+
+    Args:
+        local (FileSystemWrapper): The local file system
+        local_path (str): The local directory tree
+        remote (AbstractConnectionWrapper): The remote connection
+        remote_path (str): The remote directory tree
+        delete (bool): Whether remote entries that do not exist locally
+            are deleted
+        logger (function): Receives the log messages
+        pool (list): Further connections to the same server
+        verify (bool): Whether the remote tree is listed even if there is
+            a manifest
+        manifest_copy (str): The local copy of the remote manifest or None,
+            in which case a temporary file is used
+        hashes (utility.HashCache): The cache of the hashes of local files
+            or None
+        record (ResumeRecord): The record of the chunks of large files
+            that have been sent or None, in which case interrupted uploads
+            are not resumed by the next run
+        signatures (SignatureCache): The signatures of the large files that
+            have been uploaded or None, in which case changed files are
+            always uploaded as a whole
+        change_manifest (dict): The change manifest of the build of the
+            local tree (see module `changes`) or None, in which case the
+            local tree is scanned
+        plans (dict): The plans shared with the deployments to other
+            servers or None
+        cancel (threading.Event): The event that cancels the upload or
+            None
+
+    Returns:
+        The upload report (see `UploadReport`), a dictionary that maps the
+        categories 'uploaded', 'skipped', 'created', 'deleted' and 'removed'
+        to the sets of affected remote paths.
+    """
+    if manifest_copy is None:
+        with tempfile.TemporaryDirectory() as tmp:
+            return upload_tree(local, local_path, remote, remote_path, delete,
+                               logger, pool, verify,
+                               os.path.join(tmp, REMOTE_MANIFEST), hashes,
+                               record, signatures,
+                               change_manifest, plans, cancel)
+    # the listing caches of the connections are only valid within one run,
+    # in particular because the connections of the pool do not see each
+    # other's changes
+    connections = [remote] + list(pool)
+    for connection in connections:
+        connection.clear_cache()
+    round_trips = sum(connection.round_trips for connection in connections)
+    if change_manifest is None:
+        state = scan_tree(local, local_path, hashes)
+        if hashes is not None:
+            hashes.save()
+    else:
+        state = change_manifest["state"]
+    check_cancelled(cancel)
+    manifest = download_manifest(remote, remote_path, manifest_copy)
+    if manifest is None or verify:
+        plan = plan_upload(local, local_path, remote, remote_path, delete,
+                           logger, state, manifest)
+    else:
+        key = (changes.state_id(manifest), remote_path, delete)
+        plan = plans.get(key) if plans is not None else None
+        if plan is not None:
+            logger("planning shared with another target")
+        elif change_manifest is not None and \
+                change_manifest["base"] == key[0]:
+            logger("planning from the change manifest")
+            plan = plan_from_changes(local, local_path, change_manifest,
+                                     remote_path, delete)
+        else:
+            plan = plan_from_manifest(local, local_path, state, manifest,
+                                      remote_path, delete)
+        if plans is not None:
+            plans.setdefault(key, plan)
+    check_cancelled(cancel)
+    if plan:
+        invalidate_manifest(remote, remote_path)
+    try:
+        report = execute_plan(plan, remote, pool, logger, record, signatures,
+                              cancel)
+    finally:
+        if signatures is not None:
+            signatures.save()
+    # a server without a (valid) manifest gets one even if nothing had to
+    # be transferred, so that the next run need not list the remote tree
+    if plan or manifest is None or verify:
+        upload_manifest(remote, remote_path,
+                        updated_manifest(plan, state, manifest, remote_path),
+                        manifest_copy)
+    report.round_trips = sum(connection.round_trips
+                             for connection in connections) - round_trips
+    for connection in connections:
+        connection.clear_cache()
+    logger("%i requests sent to the server" % report.round_trips)
     return report
 
 
+# the policies for a failed target of `upload_targets()`: 'continue' lets
+# the deployments to the other targets run to completion, 'abort' cancels
+# them before their next transfer operation
+FAILURE_POLICIES = ("continue", "abort")
+
+
+class Target:
+    """Class Target describes one of the servers of a deployment to several
+    servers (see `upload_targets()`): its `name` (usually the section of the
+    configuration file), the connection wrapper `remote`, the directory tree
+    `remote_path`, further connections to the same server in `pool` and the
+    `ResumeRecord` and the `SignatureCache` of the server, if any.
+    """
+
+    def __init__(self, name, remote, remote_path="", pool=(), record=None,
+                 signatures=None):
+        self.name = name
+        self.remote = remote
+        self.remote_path = remote_path
+        self.pool = list(pool)
+        self.record = record
+        self.signatures = signatures
+
+    def close(self):
+        """Closes all connections to the server."""
+        for connection in [self.remote] + self.pool:
+            connection.close()
+
+
+def upload_targets(local, local_path, targets, delete=False,
+                   logger=lambda msg: 0, verify=False, hashes=None,
+                   change_manifest=None, on_failure="continue"):
+    """Uploads the local directory tree at `local_path` to several servers
+    concurrently. The local tree is scanned and hashed only once (or not at
+    all, if the `change_manifest` of the build is given), and the servers
+    whose remote manifests are equal share the transfer plan (see
+    `upload_tree()`). The log messages of each target are prefixed with its
+    name in brackets.
+
+    If the deployment to a target fails, the deployments to the other
+    targets either continue or, if `on_failure` is 'abort', are cancelled
+    before their next transfer operation (see `FAILURE_POLICIES`). As the
+    remote manifest of an interrupted deployment has been invalidated, the
+    next run compares such a server with the local tree by listing it.
+
+    Args:
+        local (FileSystemWrapper): The local file system
+        local_path (str): The local directory tree
+        targets (list): The servers (see `Target`)
+        delete (bool): Whether remote entries that do not exist locally
+            are deleted
+        logger (function): Receives the log messages
+        verify (bool): Whether the remote trees are listed even if there
+            are manifests
+        hashes (utility.HashCache): The cache of the hashes of local files
+            or None
+        change_manifest (dict): The change manifest of the build of the
+            local tree or None
+        on_failure (str): 'continue' or 'abort'
+
+    Returns:
+        A dictionary that maps the names of the targets to their upload
+        reports (see `UploadReport`). The attribute `error` of a report is
+        the exception that has stopped the deployment or None, if it has
+        been successful.
+    """
+    if on_failure not in FAILURE_POLICIES:
+        raise ValueError("unknown failure policy %s. Should be one of %s" %
+                         (on_failure, str(list(FAILURE_POLICIES))))
+    if change_manifest is None:
+        state = scan_tree(local, local_path, hashes)
+        if hashes is not None:
+            hashes.save()
+        # a change manifest without a base shares the state, but never
+        # replaces the comparison with the remote manifests
+        change_manifest = changes.compare_states(None, state)
+    plans = {}
+    cancel = threading.Event()
+
+    def deploy(target):
+        def log(msg):
+            logger("[%s] %s" % (target.name, msg))
+
+        try:
+            report = upload_tree(local, local_path, target.remote,
+                                 target.remote_path, delete, log, target.pool,
+                                 verify, record=target.record,
+                                 signatures=target.signatures,
+                                 change_manifest=change_manifest,
+                                 plans=plans, cancel=cancel)
+            report.error = None
+        except Exception as error:
+            if on_failure == "abort":
+                cancel.set()
+            log("failed: %s" % error)
+            report = empty_report()
+            report.error = error
+        return target.name, report
+
+    with concurrent.futures.ThreadPoolExecutor(max(len(targets), 1)) \
+            as executor:
+        return dict(executor.map(deploy, targets))
+
+
 ##############################################################################
 #
 # connections
@@ -606,7 +2008,9 @@ PORTS = {"sftp": 22,
          "filesystem": 0}
 
 
-def connect(cfg_filename, cfg_section):
+def read_section(cfg_filename, cfg_section):
+    """Returns the section `cfg_section` ("default" if empty) of the
+    configuration file `cfg_filename`."""
     config = configparser.ConfigParser()
     config.read(cfg_filename)
     if cfg_section == "":
@@ -614,18 +2018,31 @@ def connect(cfg_filename, cfg_section):
     if cfg_section not in config:
         raise ValueError("Section %s not in config file %s" %
                          (cfg_section, cfg_filename))
-    section = config[cfg_section]
-    if "server" not in section:
-        raise ValueError('Key "host" missing in section %s of config file %s' %
-                         (cfg_section, cfg_filename))
-    host = section["server"]
+    return config[cfg_section]
+
+
+def port_and_protocol(section):
+    """Returns the port and the protocol configured in `section`, where
+    either of them may be inferred from the other."""
     port = int(section["port"] if "port" in section else
                PORTS[section["protocol"]] if "protocol" in section else 22)
     protocol = section["protocol"] if "protocol" in section \
         else PROTOCOLS[int(section["port"])] if "port" in section else "ftp"
+    return port, protocol
+
+
+def connect(cfg_filename, cfg_section, credentials=None):
+    section = read_section(cfg_filename, cfg_section)
+    if "server" not in section:
+        raise ValueError('Key "host" missing in section %s of config file %s' %
+                         (cfg_section, cfg_filename))
+    host = section["server"]
+    port, protocol = port_and_protocol(section)
     root = section["root"] if "root" in section else ""
     username = section["user"] if "user" in section else ""
     password = section["password"] if "password" in section else ""
+    if credentials:
+        username, password = credentials
 
     if protocol == "ftp":
         return FTPWrapper(root, FTP_connect(host, port, username, password))
@@ -637,7 +2054,45 @@ def connect(cfg_filename, cfg_section):
         raise ValueError("unknown protokol %s. Should be one of %" %
                          (protocol, str(list(PROTOCOLS.values()))))
 
-    
+
+def connect_pool(cfg_filename, cfg_section, size=None):
+    """Returns a list of `size` connections (see `connect()`) to the server
+    configured in section `cfg_section` of `cfg_filename`, e.g. for passing
+    the first one as `remote` and the others as `pool` to `upload_tree()`.
+    If `size` is None, the value of the key `connections` in the section is
+    used (1 by default). User name and password are queried only once, if
+    they are not configured.
+    """
+    section = read_section(cfg_filename, cfg_section)
+    if size is None:
+        size = int(section.get("connections", "1"))
+    credentials = None
+    if port_and_protocol(section)[1] != "filesystem":
+        credentials = query_if_necessary(section.get("user", ""),
+                                         section.get("password", ""))
+    return [connect(cfg_filename, cfg_section, credentials)
+            for i in range(size)]
+
+
+def connect_targets(cfg_filename, cfg_sections, remote_path="", size=None):
+    """Returns a list of `Target` objects for the servers configured in the
+    sections `cfg_sections` of `cfg_filename` (see `connect_pool()`). The
+    servers are connected one after the other, because user names and
+    passwords may have to be queried.
+    """
+    targets = []
+    try:
+        for cfg_section in cfg_sections:
+            connections = connect_pool(cfg_filename, cfg_section, size)
+            targets.append(Target(cfg_section, connections[0], remote_path,
+                                  connections[1:]))
+    except Exception:
+        for target in targets:
+            target.close()
+        raise
+    return targets
+
+
 def save_log(name, log):
     """Saves an upload log dictionary as YAML file.
     """
@@ -647,8 +2102,112 @@ def save_log(name, log):
     with open(filename, "w") as f:
         timestamp = str(datetime.datetime.now())
         f.write("# log created " + timestamp[:timestamp.find(".")] + "\n")
+        if hasattr(log, "round_trips"):
+            f.write("# requests sent to the server: %i\n" % log.round_trips)
+        if getattr(log, "error", None) is not None:
+            f.write("# failed: %s\n" % log.error)
         for key in log:
             f.write("\n" + key + ":\n")
             for entry in sorted(list(log[key])):
                 f.write("  - " + entry + "\n")
 
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Uploads a local directory tree to a server that is "
+                    "configured in a section of a configuration file.")
+    parser.add_argument("config", help="the configuration file")
+    parser.add_argument("section",
+                        help="the section of the server or the sections of "
+                             "several servers separated by commas, which are "
+                             "deployed to concurrently")
+    parser.add_argument("local_path", help="the local directory tree")
+    parser.add_argument("remote_path", nargs="?", default="",
+                        help="the remote directory (default: the root)")
+    parser.add_argument("--delete", action="store_true",
+                        help="delete remote files that do not exist locally")
+    parser.add_argument("--verify", action="store_true",
+                        help="list the remote tree instead of trusting the "
+                             "upload manifest")
+    parser.add_argument("--connections", type=int, default=None,
+                        help="number of parallel connections")
+    parser.add_argument("--hashes", default=None,
+                        help="the json file of the local hash cache")
+    parser.add_argument("--resume", default=None,
+                        help="the json file that records the chunks of "
+                             "large files, so that interrupted uploads can "
+                             "be resumed")
+    parser.add_argument("--signatures", default=None,
+                        help="the json file that keeps the signatures of "
+                             "large files, so that changed files can be "
+                             "transferred as a delta")
+    parser.add_argument("--delta-size", type=int, default=DELTA_SIZE,
+                        help="the size in bytes above which files are "
+                             "transferred as a delta (default: %i)" %
+                             DELTA_SIZE)
+    parser.add_argument("--changes", default=None,
+                        help="the change manifest of the build (usually "
+                             "__cache/changes.json), so that the local tree "
+                             "need not be scanned")
+    parser.add_argument("--on-failure", choices=FAILURE_POLICIES,
+                        default="continue",
+                        help="whether the deployments to the other servers "
+                             "continue or are aborted if one of several "
+                             "servers fails (default: continue)")
+    parser.add_argument("--log", default="",
+                        help="save the report to the log file LOG-<time>.log "
+                             "(LOG-<section>-<time>.log for several servers)")
+    args = parser.parse_args()
+    sections = [section.strip() for section in args.section.split(",")]
+    if len(sections) > 1:
+        def per_target(filename, section):
+            if not filename:
+                return filename
+            root, ext = os.path.splitext(filename)
+            return root + "-" + section + ext
+
+        targets = connect_targets(args.config, sections, args.remote_path,
+                                  args.connections)
+        for target in targets:
+            target.record = ResumeRecord(per_target(args.resume,
+                                                    target.name))
+            if args.signatures:
+                target.signatures = SignatureCache(
+                    per_target(args.signatures, target.name),
+                    args.delta_size)
+        try:
+            reports = upload_targets(
+                FileSystemWrapper(args.local_path), "", targets, args.delete,
+                print, args.verify, utility.HashCache(args.hashes),
+                changes.load_changes(args.changes) if args.changes else None,
+                args.on_failure)
+        finally:
+            for target in targets:
+                target.close()
+        for name, report in reports.items():
+            print("%s: %s" % (name, "failed: %s" % report.error
+                              if report.error is not None else
+                              "%i files uploaded" % len(report["uploaded"])))
+            if args.log:
+                save_log(per_target(args.log, name), report)
+        if any(report.error is not None for report in reports.values()):
+            sys.exit(1)
+    else:
+        connections = connect_pool(args.config, args.section, args.connections)
+        try:
+            report = upload_tree(FileSystemWrapper(args.local_path), "",
+                                 connections[0], args.remote_path, args.delete,
+                                 print, connections[1:], args.verify,
+                                 hashes=utility.HashCache(args.hashes),
+                                 record=ResumeRecord(args.resume),
+                                 signatures=SignatureCache(args.signatures,
+                                                           args.delta_size)
+                                 if args.signatures else None,
+                                 change_manifest=changes.load_changes(
+                                     args.changes) if args.changes else None)
+        finally:
+            for connection in connections:
+                connection.close()
+        if args.log:
+            save_log(args.log, report)
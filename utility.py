@@ -16,15 +16,25 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import concurrent.futures
 import contextlib
 import datetime
 import fnmatch
 import hashlib
+import json
+import multiprocessing
 import os
 import re
 import shutil
+import stat
+import threading
 from typing import Iterable
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 
 ##############################################################################
 #
@@ -166,29 +176,107 @@ def is_newer(src_file, dst_file):
     if src_name != dst_name:
         raise ValueError(("Source file %s does not have the same name " +
                           "as destination file %s") % (src_file, dst_file))
-    if (os.path.exists(dst_file) and not
-        ((os.path.isfile(src_file) and os.path.isfile(dst_file)) or
-         (os.path.isdir(src_file) and os.path.isdir(dst_file)))):
+    try:
+        dst_st = os.stat(dst_file)
+    except FileNotFoundError:
+        return True
+    src_st = os.stat(src_file)
+    if stat.S_ISDIR(src_st.st_mode) != stat.S_ISDIR(dst_st.st_mode):
         raise ValueError(("Source %s and destination %s are of different " +
                           "kind.") % (src_file, dst_file))
-    # > instead of >= to avaoid to much copying, could be dangerous in
-    # case of changes that were made within less than a second...
-    return (not os.path.exists(dst_file) or
-            os.path.getmtime(src_file) > os.path.getmtime(dst_file))
-    # or os.path.getsize(src_file) != os.path.getsize(dst_file)
+    # > instead of >= to avoid too much copying. Nanosecond timestamps keep
+    # this safe on file systems with a fine grained time resolution.
+    return src_st.st_mtime_ns > dst_st.st_mtime_ns
 
 
 def isodate(filename):
     return datetime.date.fromtimestamp(os.stat(filename).st_mtime).isoformat()
 
 
-def copy_on_condition(src, dst, cond, preprocessors={}, sitemap=[]):
+FICLONE = 0x40049409     # ioctl request code for reflinks on Linux
+
+LINK_STRATEGIES = {
+    "auto": ("reflink", "hardlink", "symlink", "copy"),
+    "reflink": ("reflink", "copy"),
+    "hardlink": ("hardlink", "copy"),
+    "symlink": ("symlink", "copy"),
+    "copy": ("copy",)
+}
+
+
+def reflink(src, dst):
+    """Creates a copy-on-write clone of file `src` at `dst`. Raises an
+    OSError if the platform or the file system does not support reflinks.
+    """
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def unlink_if_linked(src, dst):
+    """Removes `dst` if it is a symbolic link or a hard link to `src`, so
+    that writing to `dst` does not alter `src`. Returns True, if `dst` has
+    been removed."""
+    try:
+        dst_st = os.lstat(dst)
+    except FileNotFoundError:
+        return False
+    if stat.S_ISLNK(dst_st.st_mode) or \
+            (dst_st.st_nlink > 1 and os.path.samestat(dst_st, os.stat(src))):
+        os.remove(dst)
+        return True
+    return False
+
+
+def link_or_copy(src, dst, strategy="copy"):
+    """Places the file `src` at `dst`, either by cloning it ("reflink"),
+    creating a hard link ("hardlink"), a symbolic link ("symlink") or by
+    copying ("copy"). Each strategy falls back to copying if it is not
+    supported, "auto" tries all strategies in the order given above.
+    An already existing `dst` is replaced. Returns the strategy that has
+    actually been used.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    for method in LINK_STRATEGIES[strategy]:
+        try:
+            if method == "reflink":
+                reflink(src, dst)
+            elif method == "hardlink":
+                os.link(src, dst)
+            elif method == "symlink":
+                os.symlink(os.path.abspath(src), dst)
+            else:
+                shutil.copy2(src, dst)
+            return method
+        except OSError:
+            if method == "copy":
+                raise
+    assert False, "unknown link strategy %s" % strategy
+
+
+def copy_on_condition(src, dst, cond, preprocessors={}, sitemap=[],
+                      link_mode="copy"):
     """Copies src to dst, if cond(src, dst) returns True. If a preprocessor
     is given for the extentions of the file, the preprocessor function is
     called with the source and destination name instead of the system's
     copy function.
     Adds `dst` to sitemap if `dst` is an HTML or PDF file,
     otherwise an empty list is returned.
+
+    Files without preprocessor are placed at `dst` according to the
+    `link_mode` (see `link_or_copy()`). Preprocessors always write real
+    files: a link left at `dst` by an earlier build is removed before the
+    preprocessor is called. As links share the modification time of their
+    source, linked files are not placed again on subsequent builds as long
+    as the source does not change.
     """
     def add_to_sitemap(src, dst):
         ext = os.path.splitext(dst)[1].lower()
@@ -202,6 +290,7 @@ def copy_on_condition(src, dst, cond, preprocessors={}, sitemap=[]):
     if cond(src, dst):
         ext = os.path.splitext(src)[1]
         if ext in preprocessors:
+            unlink_if_linked(src, dst)
             new_dst = preprocessors[ext](src, dst)
             if not isinstance(new_dst, type(None)):
                 assert isinstance(new_dst, str), \
@@ -210,15 +299,17 @@ def copy_on_condition(src, dst, cond, preprocessors={}, sitemap=[]):
                     (preprocessors[ext], str(type(new_dst)), str(new_dst))
                 dst = new_dst
         else:
-            shutil.copy2(src, dst)
+            link_or_copy(src, dst, link_mode)
     add_to_sitemap(src, dst)
 
 
-def copytree_on_condition(src, dst, cond, preprocessors={}, sitemap=[]):
+def copytree_on_condition(src, dst, cond, preprocessors={}, sitemap=[],
+                          link_mode="copy"):
     """Copies all files and directories from src to dst. Files are only copied
     if cond(src, dst) is True. Copying may be channeled through a preprocessor.
     Adds files sitemap entries (dict) to `sitemap`, in case the destination
-    file name ends with '.html' or '.pdf'
+    file name ends with '.html' or '.pdf'. Directories are always created,
+    files are placed according to `link_mode` (see `copy_on_condition()`).
     """
 
     names = os.listdir(src)
@@ -229,12 +320,227 @@ def copytree_on_condition(src, dst, cond, preprocessors={}, sitemap=[]):
         if os.path.isdir(srcname):
             if not name.startswith('_'):    # TODO: this should already be excluded at tree scanning stage!
                 copytree_on_condition(srcname, dstname, cond, preprocessors,
-                                      sitemap)
+                                      sitemap, link_mode)
         else:
-            copy_on_condition(srcname, dstname, cond, preprocessors, sitemap)
+            copy_on_condition(srcname, dstname, cond, preprocessors, sitemap,
+                              link_mode)
     shutil.copystat(src, dst)
 
 
+BATCH_SIZE = 32     # maximum number of files per batch of a preprocessor
+
+
+def sync_tree(src, dst, preprocessors={}, sitemap=[], link_mode="copy",
+              manifest=None, trust_dir_mtimes=False, workers=None):
+    """Synchronises the file or directory `src` with `dst`. Other than
+    `copytree_on_condition()`, sync_tree does not compare source and
+    destination, but compares the sources with the records of the previous
+    run in `manifest` (a SyncManifest). An unchanged file costs a single
+    stat call (obtained via os.scandir()); of the destination only the
+    names are read, with one os.scandir() per directory, so that files that
+    have been deleted from the destination are placed again. Files are
+    considered changed if their size or modification time (in nanoseconds)
+    differ in any way from the record. Files that have
+    merely been touched are recognised by their hash and are not copied
+    again, unless they are linked (in which case hashing would cost more
+    than linking).
+
+    If `trust_dir_mtimes` is True, directories whose modification time has
+    not changed since the last run are not scanned at all and neither are
+    the files in them stat'ed. As editing a file in place does not change
+    the modification time of its directory, this must only be switched on,
+    if files are replaced (rather than overwritten) when they are changed.
+    The names in the destination directories are still read.
+
+    Changed files are copied, linked (see `link_or_copy()`) or preprocessed
+    in parallel by a pool of `workers` threads. Preprocessors that have a
+    `batch` attribute (a function that takes a list of (src, dst)-pairs and
+    returns the list of destinations) are called with batches of up to
+    BATCH_SIZE files instead of file by file. Sitemap entries for HTML
+    and PDF files are added to `sitemap` as by `copy_on_condition()`.
+    Subdirectories starting with an underscore are skipped.
+
+    Returns the number of files that have been copied or preprocessed.
+    """
+    if manifest is None:
+        manifest = SyncManifest()
+    jobs = []
+
+    def add_to_sitemap(dst, mtime):
+        ext = os.path.splitext(dst)[1].lower()
+        if ext == ".pdf" or ext == ".html":
+            sitemap.append({"loc": dst,
+                            "alt_locs": [],
+                            "lastmod": datetime.date.fromtimestamp(mtime).
+                            isoformat(),
+                            "changefreq": "yearly",
+                            "priority": "0.4"})
+
+    def dst_names(dst):
+        """Returns the set of names in the destination directory `dst`."""
+        try:
+            with os.scandir(dst) as it:
+                return {entry.name for entry in it}
+        except (FileNotFoundError, NotADirectoryError):
+            return set()
+
+    def exists(record, dst, present):
+        """Returns True if the destination of `record` exists. `present` is
+        the set of names in the directory of `dst` or None if it has not
+        been read."""
+        if present is not None and \
+                os.path.dirname(record[3]) == os.path.dirname(dst):
+            return os.path.basename(record[3]) in present
+        return os.path.exists(record[3])
+
+    def visit_file(src, dst, st, fresh, present=None):
+        if fresh:   # destination directory has just been created
+            jobs.append((src, dst, st))
+            return
+        record = manifest.old_files.get(src)
+        preprocessed = os.path.splitext(src)[1] in preprocessors
+        if record and (record[3] == dst or preprocessed) \
+                and exists(record, dst, present):
+            if record[0] == st.st_size and record[1] == st.st_mtime_ns:
+                manifest.files[src] = record
+                return
+            if record[2] and record[0] == st.st_size \
+                    and md5_file(src) == record[2]:
+                manifest.files[src] = [st.st_size, st.st_mtime_ns] + \
+                    record[2:]
+                return
+        elif not preprocessed:
+            # no record, yet: trust a destination that looks like a copy
+            try:
+                dst_st = os.stat(dst)
+                if dst_st.st_size == st.st_size and \
+                        dst_st.st_mtime_ns == st.st_mtime_ns:
+                    manifest.files[src] = [st.st_size, st.st_mtime_ns, None,
+                                           dst]
+                    return
+            except FileNotFoundError:
+                pass
+        jobs.append((src, dst, st))
+
+    def visit_trusted(src, dst):
+        """Checks whether the directory `src` and all of its subdirectories
+        are unchanged according to their modification times. Returns True
+        and takes over the records, if this is the case."""
+        record = manifest.old_dirs.get(src)
+        try:
+            if not record or os.stat(src).st_mtime_ns != record[0] \
+                    or not os.path.isdir(dst):
+                return False
+        except FileNotFoundError:
+            return False
+        files, dirs = {}, {src: record}
+        present = dst_names(dst)
+        for name in record[1]:
+            path = os.path.join(src, name)
+            if path in manifest.old_dirs:
+                if not visit_trusted(path, os.path.join(dst, name)):
+                    return False
+            elif path in manifest.old_files and exists(
+                    manifest.old_files[path], os.path.join(dst, name),
+                    present):
+                files[path] = manifest.old_files[path]
+            else:
+                return False
+        manifest.files.update(files)
+        manifest.dirs.update(dirs)
+        return True
+
+    def visit_dir(src, dst, st, fresh):
+        if trust_dir_mtimes and not fresh and visit_trusted(src, dst):
+            return
+        try:
+            os.mkdir(dst)
+            fresh = True
+        except FileExistsError:
+            pass
+        present = set() if fresh else dst_names(dst)
+        names = []
+        subdirs = []
+        with os.scandir(src) as it:
+            for entry in it:
+                if entry.is_dir():
+                    if not entry.name.startswith('_'):
+                        subdirs.append(entry)
+                        names.append(entry.name)
+                else:
+                    visit_file(entry.path, os.path.join(dst, entry.name),
+                               entry.stat(), fresh, present)
+                    names.append(entry.name)
+        manifest.dirs[src] = [st.st_mtime_ns, sorted(names)]
+        for entry in subdirs:
+            visit_dir(entry.path, os.path.join(dst, entry.name),
+                      entry.stat(), fresh)
+
+    def place(job):
+        src, dst, st = job
+        ext = os.path.splitext(src)[1]
+        digest = None
+        if ext in preprocessors:
+            unlink_if_linked(src, dst)
+            new_dst = preprocessors[ext](src, dst)
+            if new_dst is not None:
+                assert isinstance(new_dst, str), \
+                    "Preprocessor %s did not return a destination file " \
+                    "name but %s" % (preprocessors[ext], str(new_dst))
+                dst = new_dst
+            digest = md5_file(src)
+        elif link_or_copy(src, dst, link_mode) == "copy":
+            digest = md5_file(src)
+        return [st.st_size, st.st_mtime_ns, digest, dst]
+
+    st = os.stat(src)
+    parent = os.path.dirname(dst)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    if stat.S_ISDIR(st.st_mode):
+        visit_dir(src, dst, st, False)
+    else:
+        visit_file(src, dst, st, not os.path.exists(dst))
+
+    def place_batch(batch):
+        preprocessor = preprocessors.get(os.path.splitext(batch[0][0])[1])
+        if not hasattr(preprocessor, 'batch'):
+            return [place(job) for job in batch]
+        for src, dst, st in batch:
+            unlink_if_linked(src, dst)
+        dsts = preprocessor.batch([(src, dst) for src, dst, st in batch])
+        return [[st.st_size, st.st_mtime_ns, md5_file(src), new_dst or dst]
+                for (src, dst, st), new_dst in zip(batch, dsts)]
+
+    # Files for preprocessors with a `batch` attribute are grouped, so that
+    # the external tool is invoked once per batch rather than once per file.
+    batches, grouped = [], {}
+    for job in jobs:
+        preprocessor = preprocessors.get(os.path.splitext(job[0])[1])
+        if hasattr(preprocessor, 'batch'):
+            grouped.setdefault(preprocessor, []).append(job)
+        else:
+            batches.append([job])
+    for group in grouped.values():
+        for i in range(0, len(group), BATCH_SIZE):
+            batches.append(group[i:i + BATCH_SIZE])
+
+    if len(batches) > 1:
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(place_batch, batches))
+    else:
+        results = [place_batch(batch) for batch in batches]
+    for batch, records in zip(batches, results):
+        for job, record in zip(batch, records):
+            manifest.files[job[0]] = record
+
+    prefix = src if not stat.S_ISDIR(st.st_mode) else src + os.path.sep
+    for path, record in manifest.files.items():
+        if path == src or path.startswith(prefix):
+            add_to_sitemap(record[3], record[1] / 1e9)
+    return len(jobs)
+
+
 ##############################################################################
 #
 # HTML processing
@@ -243,6 +549,7 @@ def copytree_on_condition(src, dst, cond, preprocessors={}, sitemap=[]):
 
 RX_HTML_COMMENTS = re.compile("<!--.*?-->", re.DOTALL)
 RX_ATTRIBUTES = re.compile(' ([a-zA-Z]+?) *?= *?["\'](.*?)["\']')
+RX_EXTERNAL_URL = re.compile(r"[a-zA-Z][\w+.-]*:|//")  # scheme or host
 
 
 def segment_data(data, regexp):
@@ -344,3 +651,131 @@ def md5(*txt):
     for t in txt:
         md5_hash.update(t.encode('utf8'))
     return md5_hash.hexdigest()
+
+
+def md5_file(filename, blocksize=1 << 20):
+    """Returns the md5-checksum of the contents of file `filename`."""
+    md5_hash = hashlib.md5()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            md5_hash.update(block)
+    return md5_hash.hexdigest()
+
+
+##############################################################################
+#
+# worker processes
+#
+##############################################################################
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def process_pool():
+    """Returns a pool of worker processes (a ProcessPoolExecutor) that is
+    shared by all CPU bound build stages. The workers are started (rather
+    than forked), because the pool is usually called from several threads
+    at once."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def shutdown_process_pool():
+    """Shuts down the worker processes, if any have been started."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+
+
+##############################################################################
+#
+# persistent caches
+#
+##############################################################################
+
+
+def load_json(filename, default=None):
+    """Returns the data stored in the json file `filename` or `default`, if
+    the file does not exist or cannot be read."""
+    try:
+        with open(filename, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return default
+
+
+def save_json(filename, data):
+    """Writes `data` as json to `filename`. The file is replaced atomically,
+    so that an interrupted build never leaves a corrupted cache behind."""
+    tmp_name = filename + ".tmp"
+    with open(tmp_name, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp_name, filename)
+
+
+class HashCache(dict):
+    """Class HashCache is a persistent dictionary that maps absolute file
+    paths to a list [size, mtime_ns, md5-hash]. A file is only (re-)hashed
+    if its size or modification time has changed since it was last hashed.
+    If `filename` is None, the hashes are only kept in memory.
+    """
+
+    def __init__(self, filename):
+        super().__init__(load_json(filename, {}) if filename else {})
+        self.filename = filename
+
+    def hash(self, path, st=None):
+        """Returns the md5-hash of the file at `path`. `st` can be the
+        result of a previous os.stat() call on `path`, in which case the file
+        is not stat'ed again."""
+        path = os.path.abspath(path)
+        if st is None:
+            st = os.stat(path)
+        entry = self.get(path)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2]
+        digest = md5_file(path)
+        self[path] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def save(self):
+        if self.filename:
+            save_json(self.filename, self)
+
+
+class SyncManifest:
+    """Class SyncManifest is the persistent record of the files and
+    directories that have been synchronised by `sync_tree()`. The records
+    of the last run are kept in `old_files` and `old_dirs`, the records of
+    the current run are collected in `files` and `dirs`. Only the latter
+    are saved, so that records of deleted sources are dropped.
+
+    File records are lists [size, mtime_ns, md5-hash or None, destination],
+    directory records are lists [mtime_ns, sorted list of entry names].
+    All paths are absolute source paths. If the `settings` (any json
+    serialisable value, e.g. the configuration of the preprocessors) differ
+    from those of the last run, the old records are discarded.
+    """
+
+    def __init__(self, filename=None, settings=None):
+        data = load_json(filename, {}) if filename else {}
+        if data.get('settings') != settings:
+            data = {}   # files must be processed again with new settings
+        self.filename = filename
+        self.settings = settings
+        self.old_files = data.get('files', {})
+        self.old_dirs = data.get('dirs', {})
+        self.files = {}
+        self.dirs = {}
+
+    def save(self):
+        if self.filename:
+            save_json(self.filename, {'files': self.files, 'dirs': self.dirs,
+                                      'settings': self.settings})